@@ -1,6 +1,88 @@
 """AI"""
 import random
-from chess_engine import King, Queen, Pawn
+import time
+from chess_engine import Queen, PAWN, ROOK, QUEEN
+from bitboard import BitboardPosition
+from evaluation import Evaluation
+
+
+class TranspositionTable:
+    """
+    Stores search results keyed by the Zobrist hash of the position. The
+    number of slots is fixed by the memory limit. When two positions share a
+    slot, the result from the deeper search is kept, unless it was stored
+    during an earlier search.
+    """
+
+    EXACT = 0
+    LOWER_BOUND = 1
+    UPPER_BOUND = 2
+    ENTRY_SIZE = 256  # Approximate number of bytes used by a stored entry
+
+    def __init__(self, memory_limit_mb=16):
+        self.memory_limit_mb = memory_limit_mb
+        self.size = max(1, int(memory_limit_mb * 1024 * 1024) // self.ENTRY_SIZE)
+        self.clear()
+
+    def clear(self):
+        """Removes all entries and resets the statistics."""
+        self.entries = [None] * self.size
+        self.age = 0
+        self.used = 0
+        self.probes = 0
+        self.hits = 0
+        self.stores = 0
+        self.replacements = 0
+
+    def new_search(self):
+        """Marks the entries stored so far as being from an earlier search."""
+        self.age += 1
+
+    def probe(self, key):
+        """
+        Returns the entry for the position as a tuple of (key, depth, score,
+        bound, best move, age), or None if it is not in the table.
+        """
+        self.probes += 1
+        entry = self.entries[key % self.size]
+        if entry is not None and entry[0] == key:
+            self.hits += 1
+            return entry
+        return None
+
+    def store(self, key, depth, score, bound, best_move):
+        """
+        Stores a search result. An entry from the current search is only
+        replaced by a result from a search of at least the same depth.
+        """
+        index = key % self.size
+        entry = self.entries[index]
+        if entry is None:
+            self.used += 1
+        elif entry[5] == self.age and entry[1] > depth:
+            return
+        elif entry[0] != key:
+            self.replacements += 1
+
+        self.stores += 1
+        self.entries[index] = (key, depth, score, bound, best_move, self.age)
+
+    def hit_rate(self):
+        """Returns the fraction of probes which found their position."""
+        return self.hits / self.probes if self.probes else 0.0
+
+    def stats(self):
+        """Returns the table's size, usage and hit rate."""
+        return {
+            "memory_limit_mb": self.memory_limit_mb,
+            "size": self.size,
+            "used": self.used,
+            "probes": self.probes,
+            "hits": self.hits,
+            "hit_rate": self.hit_rate(),
+            "stores": self.stores,
+            "replacements": self.replacements,
+        }
 
 
 class AI:
@@ -10,189 +92,134 @@ class AI:
     BLACK_CHECKMATE = -10000
     STALEMATE = 0
     DEPTH = 2
-
-    def __init__(self):
+    KILLER_MOVES_PER_PLY = 2
+    TRANSPOSITION_TABLE_MB = 16
+    TIME_BUDGET_MS = 1000
+    MAX_DEPTH = 20
+    BACKEND = "object"
+    DELTA_MARGIN = 200  # Centipawns added to a capture's gain for delta pruning
+    CANCEL_CHECK_NODES = 1024  # Checking a cancelled event is slow across processes
+
+    def __init__(
+        self,
+        transposition_table_mb=None,
+        backend=None,
+        opening_book=None,
+        tablebase=None,
+    ):
+        """
+        The backend is the board representation that searches run on: either
+        "object" to search the Game itself, or "bitboard" to search a
+        BitboardPosition copied from it. If an OpeningBook is given, its moves
+        are played without searching while the game is in the book. If a
+        Tablebase is given, positions in its tables are scored exactly.
+        """
+        self.backend = backend or self.BACKEND
+        self.opening_book = opening_book
+        self.tablebase = tablebase
         self.minimax_best_moves = []
-
-    def evaluate_board(self, board, white_checkmate, black_checkmate, draw):
+        self.nodes = 0
+        self.cutoffs = 0
+        self.killer_moves = {}
+        self.history = {}
+        self.principal_variation = []
+        self.completed_depth = 0
+        self.deadline = None
+        self.cancelled = None
+        self.search_stopped = False
+        self.evaluation = Evaluation()
+        self.__pv_table = {}
+        self.__follow_pv = False
+        if transposition_table_mb is None:
+            transposition_table_mb = self.TRANSPOSITION_TABLE_MB
+        self.transposition_table = TranspositionTable(transposition_table_mb)
+
+    def reset(self):
         """
-        Returns the score for the board based on the pieces of the two players.
-        White pieces are worth positive points and black pieces are worth
-        negative points. Checkmate and stalemate are worth a constant value.
+        Forgets the transposition table entries, killer moves and history
+        scores from earlier searches, so that the next search does not depend
+        on them.
         """
+        self.transposition_table.clear()
+        self.killer_moves = {}
+        self.history = {}
 
-        score = 0
-        if white_checkmate:
-            return self.WHITE_CHECKMATE
-        if black_checkmate:
-            return self.BLACK_CHECKMATE
-        if draw:
-            return self.STALEMATE
-        for piece in board.white_pieces + board.black_pieces:
-            score += piece.get_value()
-
-        return score
+    def get_search_position(self, gamestate):
+        """
+        Returns the position that a search of the game should run on. When
+        searching the Game itself, the evaluation is set up from its pieces
+        so that it can be updated as moves are made.
+        """
+        if self.backend == "bitboard":
+            if isinstance(gamestate, BitboardPosition):
+                return gamestate
+            return BitboardPosition.from_game(gamestate)
+
+        self.evaluation = Evaluation()
+        for piece in gamestate.board.white_pieces + gamestate.board.black_pieces:
+            self.evaluation.add_piece(
+                piece.colour, piece.piece_type, piece.row * 8 + piece.column
+            )
+        return gamestate
 
     def get_random_move(self, valid_moves):
         """Returns a random valid move."""
         return random.choice(valid_moves)
 
     def get_greedy_ai_move(self, gamestate):
-        """Returns the best valid move for the current board state"""
-        multiplier = 1 if gamestate.ai_colour else -1
+        """
+        Returns the valid move which leaves the best position for the current
+        player, scored in centipawns by the evaluation without searching any
+        further.
+        """
+        current_player = gamestate.current_player_colour
+        gamestate = self.get_search_position(gamestate)
         best_moves = []
-        best_score = self.BLACK_CHECKMATE
+        best_score = None
         for move in gamestate.get_valid_moves():
-            # Execute the move
-            (current_row, current_column), (new_row, new_column) = move
-            current_piece = gamestate.board.board[current_row][current_column]
-            piece_at_new_square = gamestate.board.board[new_row][new_column]
-
-            gamestate.board.board[current_row][current_column] = None
-            gamestate.board.board[new_row][new_column] = current_piece
-
-            if piece_at_new_square:
-                if piece_at_new_square.colour:
-                    gamestate.board.white_pieces.remove(piece_at_new_square)
-                else:
-                    gamestate.board.black_pieces.remove(piece_at_new_square)
-
-            # Evaluate the new board state
-            score = (
-                self.evaluate_board(
-                    gamestate.board,
-                    gamestate.white_checkmate,
-                    gamestate.black_checkmate,
-                    gamestate.stalemate,
-                )
-                * multiplier
-            )
-
-            # Undo the move
-            gamestate.board.board[current_row][current_column] = current_piece
-            gamestate.board.board[new_row][new_column] = piece_at_new_square
-
-            if piece_at_new_square:
-                if piece_at_new_square.colour:
-                    gamestate.board.white_pieces.append(piece_at_new_square)
-                else:
-                    gamestate.board.black_pieces.append(piece_at_new_square)
+            undo = self.__make_search_move(gamestate, move)
+            score = self.__evaluate_leaf(gamestate, current_player)
+            self.__undo_search_move(gamestate, undo)
 
             # Check if best move
-            if score > best_score:
+            if best_score is None or score > best_score:
                 best_score = score
                 best_moves = [move]
             elif score == best_score:
                 best_moves.append(move)
 
-        # If there are no best moves, return a random move.
-        if best_moves:
-            return self.get_random_move(best_moves)
-        return self.get_random_move(gamestate.get_valid_moves())
+        return self.get_random_move(best_moves)
 
     def get_ai_move_minimax(self, gamestate, depth, current_player):
         """Performs the minimax algorithm to find the best move for the AI."""
-        multiplier = 1 if current_player else -1
+        if depth == self.DEPTH:
+            self.nodes = 0
+            gamestate = self.get_search_position(gamestate)
+        self.nodes += 1
+
+        # Drawn and repeated positions are scored as in get_ai_move_alphabeta
+        if depth < self.DEPTH and (gamestate.stalemate or gamestate.is_repetition()):
+            return self.STALEMATE
+
         # Base case
         if depth == 0:
-            return (
-                self.evaluate_board(
-                    gamestate.board,
-                    gamestate.white_checkmate,
-                    gamestate.black_checkmate,
-                    gamestate.stalemate,
-                )
-                * multiplier
+            return self.quiescence_search(
+                gamestate,
+                self.BLACK_CHECKMATE - 1,
+                self.WHITE_CHECKMATE + 1,
+                current_player,
             )
 
         best_score = self.BLACK_CHECKMATE
         for move in gamestate.get_valid_moves():
-            # Execute the move
-            (current_row, current_column), (new_row, new_column) = move
-            current_piece = gamestate.board.board[current_row][current_column]
-            piece_at_new_square = gamestate.board.board[new_row][new_column]
-
-            gamestate.board.board[current_row][current_column] = None
-            gamestate.board.board[new_row][new_column] = current_piece
-
-            # Update King's location
-            if isinstance(current_piece, King):
-                if current_player:
-                    gamestate.white_king_location = (new_row, new_column)
-                else:
-                    gamestate.black_king_location = (new_row, new_column)
-
-            # Execute pawn promotion
-            elif isinstance(current_piece, Pawn):
-                if current_piece.colour and new_row == 0:
-                    new_piece = Queen(new_row, new_column, True)
-                    gamestate.board.white_pieces.remove(current_piece)
-                    gamestate.board.white_pieces.append(new_piece)
-                    gamestate.board.board[new_row][new_column] = new_piece
-
-                elif not current_piece.colour and new_row == 7:
-                    new_piece = Queen(new_row, new_column, False)
-                    gamestate.board.black_pieces.remove(current_piece)
-                    gamestate.board.black_pieces.append(new_piece)
-                    gamestate.board.board[new_row][new_column] = new_piece
-
-            # Switch player
-            gamestate.current_player_colour = not gamestate.current_player_colour
-
-            if current_piece is None:
-                return self.BLACK_CHECKMATE
-
-            current_piece.row = new_row
-            current_piece.column = new_column
-
-            if piece_at_new_square:
-                if piece_at_new_square.colour:
-                    gamestate.board.white_pieces.remove(piece_at_new_square)
-                else:
-                    gamestate.board.black_pieces.remove(piece_at_new_square)
-
-            gamestate.is_checkmate_or_stalemate()
-            gamestate.check_draw()
+            undo = self.__make_search_move(gamestate, move)
 
             # Evaluate score for gamestate recursively
             score = -1 * self.get_ai_move_minimax(
                 gamestate, depth - 1, not current_player
             )
 
-            # Undo the move
-            gamestate.board.board[current_row][current_column] = current_piece
-            gamestate.board.board[new_row][new_column] = piece_at_new_square
-
-            if isinstance(current_piece, King):
-                if current_player:
-                    gamestate.white_king_location = (current_row, current_column)
-                else:
-                    gamestate.black_king_location = (current_row, current_column)
-
-            # Undo pawn promotion
-            elif isinstance(current_piece, Pawn):
-                if current_piece.colour and new_row == 0:
-                    gamestate.board.white_pieces.append(current_piece)
-                    gamestate.board.white_pieces.remove(new_piece)
-                elif not current_piece.colour and new_row == 7:
-                    gamestate.board.black_pieces.append(current_piece)
-                    gamestate.board.black_pieces.remove(new_piece)
-
-            # Switch player back
-            gamestate.current_player_colour = not gamestate.current_player_colour
-
-            current_piece.row = current_row
-            current_piece.column = current_column
-
-            if piece_at_new_square:
-                if piece_at_new_square.colour:
-                    gamestate.board.white_pieces.append(piece_at_new_square)
-                else:
-                    gamestate.board.black_pieces.append(piece_at_new_square)
-
-            gamestate.white_checkmate = False
-            gamestate.black_checkmate = False
-            gamestate.stalemate = False
+            self.__undo_search_move(gamestate, undo)
 
             # Check if best score and update list of best moves
             if score > best_score:
@@ -204,3 +231,550 @@ class AI:
                 self.minimax_best_moves.append(move)
 
         return best_score
+
+    def get_ai_move_alphabeta(
+        self, gamestate, depth, current_player, alpha=None, beta=None, ply=0
+    ):
+        """
+        Performs minimax with alpha-beta pruning. It returns the same score as
+        get_ai_move_minimax, but skips branches which cannot change the result.
+        Moves are ordered so that cutoffs happen early: the best move found
+        for the position in the transposition table, then captures (most
+        valuable victim, least valuable attacker), then killer moves, then
+        quiet moves by history score. The best root move is stored in
+        minimax_best_moves and the number of nodes searched in nodes.
+
+        If a deadline is set and it passes, or the cancelled event is set,
+        the search stops and returns straight away with search_stopped set.
+        The result should then be ignored.
+        """
+        table = self.transposition_table
+        if ply == 0:
+            self.nodes = 0
+            self.cutoffs = 0
+            self.minimax_best_moves = []
+            self.search_stopped = False
+            table.new_search()
+            gamestate = self.get_search_position(gamestate)
+        if alpha is None:
+            alpha = self.BLACK_CHECKMATE - 1
+        if beta is None:
+            beta = self.WHITE_CHECKMATE + 1
+        self.nodes += 1
+        self.__pv_table[ply] = []
+
+        if self.deadline is not None and (
+            time.perf_counter() >= self.deadline
+            or (
+                self.cancelled is not None
+                and self.nodes % self.CANCEL_CHECK_NODES == 0
+                and self.cancelled.is_set()
+            )
+        ):
+            self.search_stopped = True
+            return 0
+
+        # A position which has occurred before is scored as a draw, as the
+        # side to move could repeat it again, and so is one which is already
+        # drawn. This comes before the transposition table, whose scores do
+        # not depend on the moves which led to the position.
+        if ply > 0 and (gamestate.stalemate or gamestate.is_repetition()):
+            return self.STALEMATE
+
+        # Base case
+        if depth == 0:
+            return self.quiescence_search(gamestate, alpha, beta, current_player)
+
+        # Positions in the endgame tables do not need to be searched
+        if ply > 0 and self.tablebase is not None:
+            score = self.__probe_tablebase(gamestate)
+            if score is not None:
+                return score
+
+        # Use the result of an earlier search of this position if it was deep
+        # enough. At the root the search always runs to find the best move.
+        original_alpha = alpha
+        tt_move = None
+        entry = table.probe(gamestate.zobrist_hash)
+        if entry is not None:
+            _, entry_depth, entry_score, bound, tt_move, _ = entry
+            if ply > 0 and entry_depth >= depth:
+                if bound == table.EXACT:
+                    return entry_score
+                if bound == table.LOWER_BOUND:
+                    alpha = max(alpha, entry_score)
+                else:
+                    beta = min(beta, entry_score)
+                if alpha >= beta:
+                    return entry_score
+
+        best_score = self.BLACK_CHECKMATE
+        best_move = None
+        moves = self.order_moves(gamestate, gamestate.get_valid_moves(), ply, tt_move)
+        for move in moves:
+            victim = self.__get_piece_value(gamestate, move[1])
+            undo = self.__make_search_move(gamestate, move)
+
+            score = -1 * self.get_ai_move_alphabeta(
+                gamestate, depth - 1, not current_player, -beta, -alpha, ply + 1
+            )
+
+            self.__undo_search_move(gamestate, undo)
+
+            if self.search_stopped:
+                return 0
+
+            if score > best_score or best_move is None:
+                best_score = score
+                best_move = move
+            if best_score > alpha:
+                alpha = best_score
+                key = (tuple(move[0]), tuple(move[1]))
+                self.__pv_table[ply] = [key] + self.__pv_table.get(ply + 1, [])
+
+            if alpha >= beta:
+                self.cutoffs += 1
+                # Remember quiet moves which cause a cutoff for move ordering
+                if victim is None:
+                    self.__store_killer_move(move, ply)
+                    key = (tuple(move[0]), tuple(move[1]))
+                    self.history[key] = self.history.get(key, 0) + depth * depth
+                break
+
+        if best_move is not None:
+            if best_score <= original_alpha:
+                bound = table.UPPER_BOUND
+            elif best_score >= beta:
+                bound = table.LOWER_BOUND
+            else:
+                bound = table.EXACT
+            best_key = (tuple(best_move[0]), tuple(best_move[1]))
+            table.store(gamestate.zobrist_hash, depth, best_score, bound, best_key)
+
+            if ply == 0:
+                self.minimax_best_moves = [best_move]
+
+        return best_score
+
+    def quiescence_search(self, gamestate, alpha, beta, current_player):
+        """
+        Searches captures and promotions past the depth limit until the
+        position is quiet, so that the search does not stop in the middle of
+        an exchange. The side to move can "stand pat" on the static
+        evaluation instead of making a capture. Captures which could not
+        raise the score to alpha, even with DELTA_MARGIN added, are skipped.
+        """
+        self.nodes += 1
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            self.search_stopped = True
+            return 0
+
+        if self.tablebase is not None:
+            score = self.__probe_tablebase(gamestate)
+            if score is not None:
+                return score
+
+        stand_pat = self.__evaluate_leaf(gamestate, current_player)
+        if (
+            gamestate.white_checkmate
+            or gamestate.black_checkmate
+            or gamestate.stalemate
+        ):
+            return stand_pat
+        if stand_pat >= beta:
+            return stand_pat
+        alpha = max(alpha, stand_pat)
+        best_score = stand_pat
+
+        # Order the captures by MVV-LVA, leaving out those pruned by delta
+        captures = []
+        for move in gamestate.get_valid_moves():
+            victim = self.__get_piece_value(gamestate, move[1])
+            attacker = self.__get_piece_value(gamestate, move[0])
+            promotion = attacker == 1 and move[1][0] in (0, 7)
+            if victim is None and not promotion:
+                continue
+            gain = (victim or 0) * 100 + (800 if promotion else 0)
+            if stand_pat + gain + self.DELTA_MARGIN <= alpha:
+                continue
+            captures.append(((victim or 0) * 10 - attacker, move))
+        captures.sort(key=lambda capture: capture[0], reverse=True)
+
+        for _, move in captures:
+            undo = self.__make_search_move(gamestate, move)
+            score = -1 * self.quiescence_search(
+                gamestate, -beta, -alpha, not current_player
+            )
+            self.__undo_search_move(gamestate, undo)
+
+            if self.search_stopped:
+                return 0
+            if score > best_score:
+                best_score = score
+            if best_score > alpha:
+                alpha = best_score
+            if alpha >= beta:
+                self.cutoffs += 1
+                break
+
+        return best_score
+
+    def get_ai_move_iterative(
+        self, gamestate, time_budget_ms, max_depth=None, cancelled=None
+    ):
+        """
+        Runs alpha-beta searches of increasing depth until the time budget (in
+        milliseconds) runs out. The best move from the deepest search which
+        finished is stored in minimax_best_moves and its score is returned.
+        Each search starts with the principal variation of the previous one,
+        so its moves are searched first. The first search always finishes so
+        that there is a move to play.
+
+        If cancelled is given, it is an event, such as a multiprocessing
+        Event, which is checked every CANCEL_CHECK_NODES nodes. Once it is
+        set, the search stops as if the time budget had run out.
+        """
+        if max_depth is None:
+            max_depth = self.MAX_DEPTH
+        start = time.perf_counter()
+        deadline = start + time_budget_ms / 1000
+        current_player = gamestate.current_player_colour
+
+        best_moves = []
+        best_score = self.BLACK_CHECKMATE
+        total_nodes = 0
+        total_cutoffs = 0
+        self.principal_variation = []
+        self.completed_depth = 0
+
+        try:
+            for depth in range(1, max_depth + 1):
+                self.deadline = deadline if depth > 1 else None
+                self.cancelled = cancelled
+                self.__follow_pv = True
+                score = self.get_ai_move_alphabeta(gamestate, depth, current_player)
+                total_nodes += self.nodes
+                total_cutoffs += self.cutoffs
+                if self.search_stopped:
+                    break
+
+                best_moves = self.minimax_best_moves
+                best_score = score
+                self.principal_variation = self.__pv_table[0]
+                self.completed_depth = depth
+
+                # Stop if a forced mate has been found or if the next search
+                # is unlikely to finish within the budget
+                elapsed = time.perf_counter() - start
+                if (
+                    abs(score) == self.WHITE_CHECKMATE
+                    or elapsed > (deadline - start) / 2
+                ):
+                    break
+        finally:
+            self.deadline = None
+            self.cancelled = None
+
+        self.minimax_best_moves = best_moves
+        self.nodes = total_nodes
+        self.cutoffs = total_cutoffs
+        return best_score
+
+    def get_ai_move(self, gamestate, time_budget_ms, cancelled=None):
+        """
+        Returns the move to play from the opening book or the endgame
+        tablebase, or else after an iterative deepening search, which stops
+        early once the cancelled event is set. If several moves are equally
+        good, one of them is chosen at random.
+        """
+        move = self.get_book_move(gamestate)
+        if move is None:
+            move = self.get_tablebase_move(gamestate)
+        if move is not None:
+            return move
+        self.get_ai_move_iterative(gamestate, time_budget_ms, cancelled=cancelled)
+        if self.minimax_best_moves:
+            return self.get_random_move(self.minimax_best_moves)
+        return self.get_random_move(gamestate.get_valid_moves())
+
+    def get_book_move(self, gamestate):
+        """Returns a move from the opening book, or None if there is none."""
+        if self.opening_book is None or isinstance(gamestate, BitboardPosition):
+            return None
+        return self.opening_book.choose_move(gamestate)
+
+    def get_tablebase_move(self, gamestate):
+        """
+        Returns the move which wins soonest, or loses latest, according to the
+        endgame tablebase, or None if the position is not in the tables.
+        """
+        if (
+            self.tablebase is None
+            or isinstance(gamestate, BitboardPosition)
+            or self.tablebase.probe_game(gamestate) is None
+        ):
+            return None
+
+        best_moves = []
+        best_score = None
+        for move in gamestate.get_valid_moves():
+            gamestate.make_move(move, Queen)
+            result = self.tablebase.probe_game(gamestate)
+            gamestate.unmake_move()
+            if result is None:
+                return None
+            outcome, plies = result
+            score = -outcome * (self.WHITE_CHECKMATE - plies)
+            if best_score is None or score > best_score:
+                best_score = score
+                best_moves = [move]
+            elif score == best_score:
+                best_moves.append(move)
+        return self.get_random_move(best_moves) if best_moves else None
+
+    def search_root_moves(self, gamestate, moves, depth):
+        """
+        Searches only the given moves from the root position to the given
+        depth, and returns the best score and move among them. This allows
+        the root moves of one search to be split between processes.
+        """
+        current_player = gamestate.current_player_colour
+        self.nodes = 0
+        self.cutoffs = 0
+        self.search_stopped = False
+        self.transposition_table.new_search()
+        gamestate = self.get_search_position(gamestate)
+
+        alpha = self.BLACK_CHECKMATE - 1
+        beta = self.WHITE_CHECKMATE + 1
+        best_score = self.BLACK_CHECKMATE
+        best_move = None
+        for move in moves:
+            undo = self.__make_search_move(gamestate, move)
+            score = -1 * self.get_ai_move_alphabeta(
+                gamestate, depth - 1, not current_player, -beta, -alpha, ply=1
+            )
+            self.__undo_search_move(gamestate, undo)
+
+            if score > best_score or best_move is None:
+                best_score = score
+                best_move = move
+            alpha = max(alpha, best_score)
+
+        return best_score, best_move
+
+    def get_search_stats(self):
+        """
+        Returns the node and cutoff counts and transposition table statistics.
+        """
+        return {
+            "nodes": self.nodes,
+            "cutoffs": self.cutoffs,
+            "depth": self.completed_depth,
+            "principal_variation": self.principal_variation,
+            "transposition_table": self.transposition_table.stats(),
+        }
+
+    def order_moves(self, gamestate, moves, ply, tt_move=None):
+        """
+        Sorts the moves so that the ones most likely to be best are searched
+        first. While following the principal variation of the previous
+        iterative deepening search, its move for this ply comes first. Then
+        comes the move from the transposition table. Captures are ordered by
+        MVV-LVA, followed by the killer moves for this ply and then the
+        remaining moves by history score.
+        """
+        killers = self.killer_moves.get(ply, [])
+
+        # Only the first line searched can follow the principal variation
+        pv_move = None
+        if self.__follow_pv:
+            self.__follow_pv = False
+            if ply < len(self.principal_variation):
+                pv_move = self.principal_variation[ply]
+                self.__follow_pv = any(
+                    (tuple(move[0]), tuple(move[1])) == pv_move for move in moves
+                )
+
+        def move_priority(move):
+            (current_row, current_column), (new_row, new_column) = move
+            key = ((current_row, current_column), (new_row, new_column))
+            if key == pv_move:
+                return (4, 0)
+            if key == tt_move:
+                return (3, 0)
+
+            victim = self.__get_piece_value(gamestate, key[1])
+            if victim is not None:
+                attacker = self.__get_piece_value(gamestate, key[0])
+                return (2, victim * 10 - attacker)
+
+            if key in killers:
+                return (1, -killers.index(key))
+            return (0, self.history.get(key, 0))
+
+        return sorted(moves, key=move_priority, reverse=True)
+
+    def __store_killer_move(self, move, ply):
+        """Keeps the most recent quiet moves which caused a cutoff at a ply."""
+        key = (tuple(move[0]), tuple(move[1]))
+        killers = self.killer_moves.setdefault(ply, [])
+        if key not in killers:
+            killers.insert(0, key)
+            del killers[self.KILLER_MOVES_PER_PLY :]
+
+    def __evaluate_leaf(self, gamestate, current_player):
+        """
+        Evaluates a position from the point of view of the current player. The
+        material and piece-square scores are kept up to date as moves are
+        made, so this does not need to look at the pieces.
+        """
+        multiplier = 1 if current_player else -1
+        if gamestate.white_checkmate:
+            return self.WHITE_CHECKMATE * multiplier
+        if gamestate.black_checkmate:
+            return self.BLACK_CHECKMATE * multiplier
+        if gamestate.stalemate:
+            return self.STALEMATE
+        if self.backend == "bitboard":
+            return gamestate.evaluation.get_score() * multiplier
+        return self.evaluation.get_score() * multiplier
+
+    def __probe_tablebase(self, gamestate):
+        """
+        Returns the exact score of the position for the side to move from the
+        endgame tablebase, or None if it is not in the tables. Quicker wins
+        score higher.
+        """
+        if self.backend == "bitboard":
+            result = self.tablebase.probe_bitboard(gamestate)
+        else:
+            result = self.tablebase.probe_game(gamestate)
+        if result is None:
+            return None
+        outcome, plies = result
+        return outcome * (self.WHITE_CHECKMATE - plies)
+
+    def __get_piece_value(self, gamestate, square):
+        """Returns the value of the piece on a square, or None if it is empty."""
+        if self.backend == "bitboard":
+            return gamestate.get_piece_value(square)
+        row, column = square
+        piece = gamestate.board.board[row][column]
+        return None if piece is None else piece.value
+
+    def __make_search_move(self, gamestate, move):
+        """
+        Makes a move while searching, promoting pawns to queens, and sets the
+        checkmate, stalemate and draw flags for the new position. When
+        searching the Game itself, the evaluation is updated from the move's
+        undo record and its previous state is returned.
+        """
+        if self.backend == "bitboard":
+            gamestate.make_move(move)
+            gamestate.is_checkmate_or_stalemate()
+            gamestate.check_draw()
+            return None
+
+        evaluation = self.evaluation
+        evaluation_state = evaluation.get_state()
+        _, piece, captured, captured_square, new_piece, rook, *_ = gamestate.make_move(
+            move, Queen
+        )
+        (current_row, current_column), (new_row, new_column) = move
+        current_square = current_row * 8 + current_column
+        new_square = new_row * 8 + new_column
+
+        if new_piece is not None:
+            evaluation.remove_piece(piece.colour, PAWN, current_square)
+            evaluation.add_piece(piece.colour, QUEEN, new_square)
+        else:
+            evaluation.move_piece(
+                piece.colour, piece.piece_type, current_square, new_square
+            )
+        if captured is not None:
+            captured_row, captured_column = captured_square
+            evaluation.remove_piece(
+                captured.colour,
+                captured.piece_type,
+                captured_row * 8 + captured_column,
+            )
+        if rook is not None:
+            rook_column = 7 if new_column == 6 else 0
+            evaluation.move_piece(
+                rook.colour,
+                ROOK,
+                new_row * 8 + rook_column,
+                new_row * 8 + rook.column,
+            )
+
+        gamestate.is_checkmate_or_stalemate()
+        gamestate.check_draw()
+        return evaluation_state
+
+    def __undo_search_move(self, gamestate, undo):
+        """Undoes a move made by __make_search_move."""
+        gamestate.unmake_move()
+        if self.backend != "bitboard":
+            self.evaluation.set_state(undo)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    from chess_engine import Game
+
+    parser = argparse.ArgumentParser(description="Compare AI search modes.")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument(
+        "--time-ms", type=int, help="run an iterative deepening search instead"
+    )
+    parser.add_argument("--backend", choices=["object", "bitboard"], default="object")
+    parser.add_argument(
+        "--workers", type=int, help="split the root moves between processes"
+    )
+    args = parser.parse_args()
+
+    if args.workers is not None:
+        from ai_jobs import AIJobRunner
+        from chess_engine import START_FEN
+
+        RUNNER = AIJobRunner(args.workers, args.backend)
+        start = time.perf_counter()
+        SCORE, MOVE = RUNNER.search_parallel(START_FEN, args.depth)
+        elapsed = time.perf_counter() - start
+        RUNNER.shutdown()
+        print(
+            f"parallel ({args.workers} workers): score {SCORE}, "
+            f"nodes {RUNNER.nodes}, time {elapsed:.2f}s, move {MOVE}"
+        )
+        sys.exit()
+
+    if args.time_ms is not None:
+        GAME = Game()
+        GAME.board.initialise_board()
+        AI_PLAYER = AI(backend=args.backend)
+        start = time.perf_counter()
+        SCORE = AI_PLAYER.get_ai_move_iterative(GAME, args.time_ms, args.depth)
+        elapsed = time.perf_counter() - start
+        print(
+            f"iterative: score {SCORE}, depth {AI_PLAYER.completed_depth}, "
+            f"nodes {AI_PLAYER.nodes}, time {elapsed:.2f}s, "
+            f"moves {AI_PLAYER.minimax_best_moves}"
+        )
+        sys.exit()
+
+    for mode in ("minimax", "alphabeta"):
+        GAME = Game()
+        GAME.board.initialise_board()
+        AI_PLAYER = AI(backend=args.backend)
+        AI_PLAYER.DEPTH = args.depth
+        search = getattr(AI_PLAYER, f"get_ai_move_{mode}")
+        start = time.perf_counter()
+        SCORE = search(GAME, args.depth, GAME.current_player_colour)
+        elapsed = time.perf_counter() - start
+        print(
+            f"{mode}: score {SCORE}, nodes {AI_PLAYER.nodes}, "
+            f"time {elapsed:.2f}s, moves {AI_PLAYER.minimax_best_moves}"
+        )
+    print(AI_PLAYER.get_search_stats())
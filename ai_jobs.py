@@ -0,0 +1,293 @@
+"""AI jobs"""
+import multiprocessing
+import os
+import threading
+import uuid
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeoutError
+from chess_engine import Game
+from ai import AI
+from instrumentation import INSTRUMENTATION
+from tablebase import Tablebase
+
+# Each worker process keeps an AI for each combination of settings it is
+# asked for, so that their transposition tables are only allocated once and
+# are reused between the searches it runs
+WORKER_AIS = {}
+
+
+def get_worker_ai(
+    backend=None, tablebase_directory=None, transposition_table_mb=None, player=None
+):
+    """
+    Returns the worker process's AI with the given settings, creating it if
+    needed. Each worker maps the same tablebase files, so they share their
+    memory. AIs for different players, such as two variants playing each
+    other, are kept apart even if their settings are the same.
+    """
+    key = (backend, tablebase_directory, transposition_table_mb, player)
+    if key not in WORKER_AIS:
+        tablebase = None
+        if tablebase_directory is not None:
+            tablebase = Tablebase(tablebase_directory)
+        WORKER_AIS[key] = AI(
+            transposition_table_mb=transposition_table_mb,
+            backend=backend,
+            tablebase=tablebase,
+        )
+    return WORKER_AIS[key]
+
+
+def get_search_game(fen, hash_history=None):
+    """
+    Returns the game to search for a position given as a FEN string. If the
+    hashes of the game's positions since the last capture or pawn move are
+    given, ending with this one, the search can find repetitions of them.
+    """
+    game = Game.from_fen(fen)
+    if hash_history:
+        game.start_history(hash_history)
+    return game
+
+
+def search_position(
+    fen,
+    time_budget_ms,
+    backend=None,
+    tablebase_directory=None,
+    instrument=False,
+    hash_history=None,
+    cancelled=None,
+):
+    """
+    Runs an AI search on the position given as a FEN string, and the hashes
+    of the positions before it if given, and returns the chosen move and the
+    search statistics. This runs in a worker process. If instrument is set,
+    the statistics include the hot path timings of the search. The search
+    stops early once the cancelled event is set.
+    """
+    ai = get_worker_ai(backend, tablebase_directory)
+    if instrument:
+        INSTRUMENTATION.enable()
+        INSTRUMENTATION.reset()
+    move = ai.get_ai_move(get_search_game(fen, hash_history), time_budget_ms, cancelled)
+    stats = ai.get_search_stats()
+    if instrument:
+        stats["instrumentation"] = INSTRUMENTATION.stats()
+    return move, stats
+
+
+def search_root_moves(
+    fen, moves, depth, backend=None, tablebase_directory=None, hash_history=None
+):
+    """
+    Searches some of the root moves of the position given as a FEN string,
+    and the hashes of the positions before it if given. Returns the best
+    score and move among them and the number of nodes searched. This runs in
+    a worker process.
+    """
+    ai = get_worker_ai(backend, tablebase_directory)
+    game = get_search_game(fen, hash_history)
+    score, move = ai.search_root_moves(game, moves, depth)
+    return score, move, ai.nodes
+
+
+class AIJobRunner:
+    """
+    Runs AI searches in a pool of worker processes, so that they do not block
+    the webapp and several searches can use separate cores. A search is
+    submitted as a FEN string, with the hashes of the game's positions since
+    the last capture or pawn move so that it can find repetitions, and given
+    a job id. Its result can then be
+    polled for, or waited on with a timeout. The statistics of the last
+    search collected are kept in last_search_stats.
+
+    Each job has an event, shared with its worker through a manager process,
+    which is set when the job is cancelled or replaced. A search which has
+    already started then stops within a few thousand nodes, rather than
+    keeping its worker busy until its time budget runs out.
+    """
+
+    def __init__(
+        self,
+        max_workers=None,
+        backend=None,
+        tablebase_directory=None,
+        instrument=False,
+    ):
+        self.max_workers = max_workers
+        self.backend = backend
+        self.tablebase_directory = tablebase_directory
+        self.instrument = instrument
+        self.nodes = 0
+        self.searches = 0
+        self.reused = 0
+        self.last_search_stats = None
+        self.__executor = None
+        self.__manager = None
+        # Job id -> ((FEN string, hash history), future, cancelled event)
+        self.__jobs = {}
+        self.__lock = threading.Lock()
+
+    def submit(self, fen, time_budget_ms, job_id=None, hash_history=None):
+        """
+        Starts a search of the position and returns its job id. If the job id
+        is given and that job is already searching the same position with the
+        same history, no new search is started. A job with that id for another
+        position or history is cancelled and replaced.
+        """
+        hash_history = tuple(hash_history or ())
+        with self.__lock:
+            if job_id is None:
+                job_id = uuid.uuid4().hex
+            elif job_id in self.__jobs:
+                job_key, future, cancelled = self.__jobs[job_id]
+                if job_key == (fen, hash_history):
+                    self.reused += 1
+                    return job_id
+                cancelled.set()
+                future.cancel()
+            if self.__executor is None:
+                self.__executor = ProcessPoolExecutor(self.max_workers)
+            if self.__manager is None:
+                self.__manager = multiprocessing.Manager()
+            cancelled = self.__manager.Event()
+            self.__jobs[job_id] = (
+                (fen, hash_history),
+                self.__executor.submit(
+                    search_position,
+                    fen,
+                    time_budget_ms,
+                    self.backend,
+                    self.tablebase_directory,
+                    self.instrument,
+                    hash_history,
+                    cancelled,
+                ),
+                cancelled,
+            )
+        return job_id
+
+    def poll(self, job_id):
+        """
+        Returns the move found by a job if it has finished, or None if it is
+        still running. A finished job is forgotten once its result is
+        returned. Raises KeyError for an unknown job id.
+        """
+        return self.wait(job_id, timeout=0)
+
+    def wait(self, job_id, timeout=None):
+        """
+        Waits up to timeout seconds (or forever if it is None) for a job to
+        finish. Returns its move, or None if it is still running.
+        """
+        result = self.wait_for_result(job_id, timeout)
+        return None if result is None else result[0]
+
+    def wait_for_result(self, job_id, timeout=None):
+        """
+        Waits like wait, but returns the job's move together with its search
+        statistics, or None if it is still running.
+        """
+        with self.__lock:
+            _, future, _ = self.__jobs[job_id]
+        try:
+            move, stats = future.result(timeout=timeout)
+        except FutureTimeoutError:
+            return None
+        finally:
+            if future.done():
+                with self.__lock:
+                    # The job may have been replaced while waiting
+                    if self.__jobs.get(job_id, (None, None, None))[1] is future:
+                        del self.__jobs[job_id]
+        with self.__lock:
+            self.searches += 1
+            self.last_search_stats = stats
+        return move, stats
+
+    def cancel(self, job_id):
+        """
+        Forgets a job, cancelling it if it has not started yet, or else
+        stopping its search.
+        """
+        with self.__lock:
+            job = self.__jobs.pop(job_id, None)
+        if job is not None:
+            _, future, cancelled = job
+            cancelled.set()
+            future.cancel()
+
+    def search_parallel(self, fen, depth, hash_history=None):
+        """
+        Runs a fixed depth search with the root moves split between the
+        worker processes, and returns the best score and move. The moves are
+        ordered before being dealt out in turn, so that each worker searches
+        its most promising moves first and gets good alpha-beta bounds early.
+        The number of nodes searched by all the workers is stored in nodes.
+        """
+        game = get_search_game(fen, hash_history)
+        # A table is not needed just to order the moves
+        moves = AI(transposition_table_mb=0).order_moves(
+            game, game.get_valid_moves(), 0
+        )
+        if not moves:
+            return None, None
+
+        with self.__lock:
+            if self.__executor is None:
+                self.__executor = ProcessPoolExecutor(self.max_workers)
+        workers = self.max_workers or os.cpu_count() or 1
+        futures = [
+            self.__executor.submit(
+                search_root_moves,
+                fen,
+                moves[i::workers],
+                depth,
+                self.backend,
+                self.tablebase_directory,
+                hash_history,
+            )
+            for i in range(min(workers, len(moves)))
+        ]
+
+        best_score = None
+        best_move = None
+        self.nodes = 0
+        for future in futures:
+            score, move, nodes = future.result()
+            self.nodes += nodes
+            if best_score is None or score > best_score:
+                best_score = score
+                best_move = move
+        return best_score, best_move
+
+    def pending(self):
+        """Returns the number of jobs whose results have not been collected."""
+        return len(self.__jobs)
+
+    def stats(self):
+        """
+        Returns the number of searches collected, the number of submissions
+        which reused a search already started, and the last search's
+        statistics.
+        """
+        return {
+            "max_workers": self.max_workers,
+            "pending": self.pending(),
+            "searches": self.searches,
+            "reused": self.reused,
+            "last_search": self.last_search_stats,
+        }
+
+    def shutdown(self, wait=True):
+        """Stops the worker processes."""
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+            manager, self.__manager = self.__manager, None
+            for _, _, cancelled in self.__jobs.values():
+                cancelled.set()
+            self.__jobs.clear()
+        if executor is not None:
+            executor.shutdown(wait=wait, cancel_futures=True)
+        if manager is not None:
+            manager.shutdown()
@@ -0,0 +1,229 @@
+"""Batch analysis"""
+import json
+import os
+import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from chess_engine import KING, Game, get_promotion_classes, move_name
+from ai_jobs import get_worker_ai
+from pgn import parse_san, san_name
+
+def parse_position(line):
+    """
+    Returns the FEN string and the operations of a line holding either a FEN
+    string or an EPD record, or None for a blank line or a comment. An EPD
+    record has the first four fields of a FEN string followed by operations
+    ending in semicolons, e.g. bm Nf3; id "test 1"; The halfmove clock and
+    fullmove number are taken from its hmvc and fmvn operations if given.
+    """
+    fields = line.split(None, 4)
+    if not fields or fields[0].startswith("#"):
+        return None
+    if len(fields) < 5 or all(field.isdigit() for field in fields[4].split()):
+        return " ".join(line.split()), {}
+
+    operations = {}
+    for operation in fields[4].split(";"):
+        opcode, _, operand = operation.strip().partition(" ")
+        if opcode:
+            operations[opcode] = operand.strip().strip('"')
+    fen = " ".join(
+        fields[:4] + [operations.get("hmvc", "0"), operations.get("fmvn", "1")]
+    )
+    return fen, operations
+
+
+def _has_one_king_each(game):
+    """Checks that each player has exactly one king, which the search needs."""
+    return all(
+        sum(piece.piece_type == KING for piece in pieces) == 1
+        for pieces in (game.board.white_pieces, game.board.black_pieces)
+    )
+
+
+def _is_solved(fen, best_move, operations):
+    """
+    Checks a best move, in coordinate notation, against the moves in SAN of
+    an EPD record's bm (best move) and am (avoid move) operations. The move
+    must be one of the best moves and none of the moves to avoid. Raises
+    ValueError if a move of the operations is not legal.
+    """
+    game = Game.from_fen(fen)
+
+    def names(opcode):
+        return {move_name(*parse_san(game, san)) for san in operations[opcode].split()}
+
+    return ("bm" not in operations or best_move in names("bm")) and (
+        "am" not in operations or best_move not in names("am")
+    )
+
+
+def analyse_position(
+    fen, depth=None, time_budget_ms=None, backend=None, tablebase_directory=None
+):
+    """
+    Searches the position given as a FEN string to the given depth, or until
+    the time budget (in milliseconds) runs out, and returns the best move,
+    in coordinate notation and in SAN, its score for the side to move, the
+    principal variation and the number of nodes searched. With a depth and no time budget, the search always
+    reaches that depth. This runs in a worker process. The AI is reset first,
+    so that the result does not depend on the positions searched before.
+    """
+    ai = get_worker_ai(backend, tablebase_directory)
+    ai.reset()
+    game = Game.from_fen(fen)
+    if time_budget_ms is None:
+        time_budget_ms = float("inf") if depth is not None else ai.TIME_BUDGET_MS
+
+    start = time.perf_counter()
+    if game.get_valid_moves():
+        score = ai.get_ai_move_iterative(game, time_budget_ms, depth)
+        best_moves = ai.minimax_best_moves
+        variation = ai.principal_variation
+        nodes = ai.nodes
+    else:
+        score = ai.BLACK_CHECKMATE if game.in_check() else ai.STALEMATE
+        best_moves = []
+        variation = []
+        nodes = 0
+    elapsed = time.perf_counter() - start
+
+    best_move = best_move_san = None
+    if best_moves:
+        piece_class = get_promotion_classes(game, best_moves[0])[0]
+        best_move = move_name(best_moves[0], piece_class)
+        best_move_san = san_name(game, best_moves[0], piece_class)
+    # The search promotes pawns to queens, so the principal variation is
+    # played out to name its promotions
+    variation_names = []
+    for move in variation:
+        piece_class = get_promotion_classes(game, move)[0]
+        variation_names.append(move_name(move, piece_class))
+        game.make_move(move, piece_class)
+
+    return {
+        "best_move": best_move,
+        "best_move_san": best_move_san,
+        "score": score,
+        "depth": ai.completed_depth if best_moves else 0,
+        "principal_variation": variation_names,
+        "nodes": nodes,
+        "time_ms": round(elapsed * 1000),
+    }
+
+
+def analyse_positions(
+    lines,
+    depth=None,
+    time_budget_ms=None,
+    max_workers=None,
+    backend=None,
+    tablebase_directory=None,
+):
+    """
+    Analyses the positions in lines of FEN strings or EPD records across a
+    pool of worker processes, and yields a result for each position in the
+    order of the lines. Only a few positions per worker are read ahead, so
+    the lines can be streamed from a large file or a pipe. A line which
+    can't be read as a position gives a result with an error instead. The
+    result for an EPD record with bm or am operations says whether the best
+    move found solved it.
+    """
+    workers = max_workers or os.cpu_count() or 1
+    pending = deque()  # (result, future or None, operations) for each position
+
+    def collect():
+        result, future, operations = pending.popleft()
+        if future is not None:
+            result.update(future.result())
+            if "bm" in operations or "am" in operations:
+                try:
+                    result["solved"] = _is_solved(
+                        result["fen"], result["best_move"], operations
+                    )
+                except ValueError as error:
+                    result["error"] = str(error)
+        return result
+
+    with ProcessPoolExecutor(workers) as executor:
+        for line_number, line in enumerate(lines, 1):
+            position = parse_position(line)
+            if position is None:
+                continue
+            fen, operations = position
+            result = {"line": line_number, "fen": fen}
+            for opcode in ("id", "bm", "am"):
+                if opcode in operations:
+                    result[opcode] = operations[opcode]
+
+            try:
+                valid = _has_one_king_each(Game.from_fen(fen))
+            except (ValueError, KeyError, IndexError):
+                valid = False
+            if not valid:
+                result["error"] = "invalid position"
+                future = None
+            else:
+                future = executor.submit(
+                    analyse_position,
+                    fen,
+                    depth,
+                    time_budget_ms,
+                    backend,
+                    tablebase_directory,
+                )
+            pending.append((result, future, operations))
+
+            while len(pending) > 2 * workers or (
+                pending and (pending[0][1] is None or pending[0][1].done())
+            ):
+                yield collect()
+        while pending:
+            yield collect()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Analyse FEN or EPD positions, writing a JSON line for each."
+    )
+    parser.add_argument(
+        "input", nargs="?", default="-", help="file of positions, or - for stdin"
+    )
+    parser.add_argument("-o", "--output", default="-", help="file for the results")
+    parser.add_argument("--depth", type=int, help="search depth in plies")
+    parser.add_argument(
+        "--time-ms", type=int, help="time budget for each position in milliseconds"
+    )
+    parser.add_argument(
+        "--workers", type=int, help="number of worker processes (default: all cores)"
+    )
+    parser.add_argument("--backend", choices=("object", "bitboard"))
+    parser.add_argument("--tablebases", help="directory of endgame tables")
+    args = parser.parse_args()
+
+    INPUT = sys.stdin if args.input == "-" else open(args.input)
+    OUTPUT = sys.stdout if args.output == "-" else open(args.output, "w")
+    START = time.perf_counter()
+    POSITIONS = 0
+    NODES = 0
+    SOLVED = []
+    for RESULT in analyse_positions(
+        INPUT, args.depth, args.time_ms, args.workers, args.backend, args.tablebases
+    ):
+        OUTPUT.write(json.dumps(RESULT) + "\n")
+        OUTPUT.flush()
+        POSITIONS += 1
+        NODES += RESULT.get("nodes", 0)
+        if "solved" in RESULT:
+            SOLVED.append(RESULT["solved"])
+    ELAPSED = time.perf_counter() - START
+    print(
+        f"{POSITIONS} positions, {NODES} nodes in {ELAPSED:.2f}s "
+        f"({NODES / ELAPSED if ELAPSED else 0:.0f} nodes/s)",
+        file=sys.stderr,
+    )
+    if SOLVED:
+        print(f"{sum(SOLVED)}/{len(SOLVED)} solved", file=sys.stderr)
@@ -1,33 +1,111 @@
 """Flask webapp"""
 
 
-from flask import Flask, render_template, request, redirect
+import os
+from flask import Flask, render_template, request, redirect, session, jsonify
 from chess_engine import Game, Pawn, Queen, Rook, Bishop, Knight
 from ai import AI
+from ai_jobs import AIJobRunner
+from game_database import GameDatabase
+from game_store import GameStore
+from instrumentation import INSTRUMENTATION
+from opening_book import load_book
+from tablebase import Tablebase
 
 app = Flask(__name__)
 app.config["SECRET_KEY"] = "secretkey"
 
 
-GAME = Game()
-GAME.board.initialise_board()
-ai = AI()
+APP_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+# The opening book is built offline, with
+# python opening_book.py build openings.txt book.bin
+BOOK = load_book(os.path.join(APP_DIRECTORY, "book.bin"))
+
+# Endgame tables are built offline with tablebase.py
+TABLEBASE_DIRECTORY = os.path.join(APP_DIRECTORY, "tablebases")
+
+# Timing the engine's hot paths slows it down, so it is only done when the
+# CHESS_INSTRUMENTATION environment variable is set
+INSTRUMENT = bool(os.environ.get("CHESS_INSTRUMENTATION"))
+if INSTRUMENT:
+    INSTRUMENTATION.enable()
+
+# Games are saved to an SQLite database after each request, so that they
+# survive restarts and several webapp processes can serve the same games. The
+# CHESS_DATABASE environment variable gives its path.
+DATABASE_PATH = os.environ.get(
+    "CHESS_DATABASE", os.path.join(APP_DIRECTORY, "games.db")
+)
+STORE = GameStore(database=GameDatabase(DATABASE_PATH))
+ai = AI(opening_book=BOOK, tablebase=Tablebase(TABLEBASE_DIRECTORY))
+AI_JOBS = AIJobRunner(tablebase_directory=TABLEBASE_DIRECTORY, instrument=INSTRUMENT)
+AI_WAIT_SECONDS = 2  # How long /aimove waits for a search before the page polls
+
+
+def get_game():
+    """Returns the game for the current session, starting one if there is none."""
+    game = STORE.get(session.get("game_id"))
+    if game is None:
+        game = new_game()
+    return game
+
+
+@app.after_request
+def save_game(response):
+    """
+    Saves the changes the request made to the session's game. Static files
+    and the statistics don't touch the game, so they are skipped.
+    """
+    if "game_id" in session and request.endpoint not in ("static", "stats"):
+        STORE.save(session["game_id"])
+    return response
+
+
+def new_game():
+    """Starts a new game for the current session, replacing any old game."""
+    if "game_id" in session:
+        AI_JOBS.cancel(session["game_id"])  # Stop pondering on the old game
+    session["game_id"], game = STORE.new_game(session.get("game_id"))
+    return game
+
+
+def ponder(game, reply):
+    """
+    Starts searching the position after the reply that the AI expects from
+    the player, while the player is thinking. The search runs as the game's
+    job, so if the player makes that reply, /aimove submits the same position
+    and takes the search that is already running or finished. Any other reply
+    replaces it with a new search.
+    """
+    position = Game.from_fen(game.to_fen())
+    position.start_history(game.get_recent_history())
+    reply = [tuple(reply[0]), tuple(reply[1])]
+    if reply not in position.get_valid_moves():
+        return
+    position.make_move(reply, Queen)
+    AI_JOBS.submit(
+        position.to_fen(),
+        AI.TIME_BUDGET_MS,
+        session["game_id"],
+        position.get_recent_history(),
+    )
 
 
 @app.route("/")
 def play():
     """Renders the board template and allows the game to be played"""
+    game = get_game()
     return render_template(
         "board.html",
-        board=GAME.board.board,
-        current_move=GAME.current_move,
-        current_player=GAME.current_player_colour,
-        show_promotion=GAME.show_promotion_box,
-        white_pieces_taken=GAME.board.white_pieces_taken,
-        black_pieces_taken=GAME.board.black_pieces_taken,
-        result=(GAME.white_checkmate, GAME.black_checkmate, GAME.stalemate),
-        aimove=GAME.ai_colour == GAME.current_player_colour,
-        start_menu=not GAME.in_progress,
+        board=game.board.board,
+        current_move=game.current_move,
+        current_player=game.current_player_colour,
+        show_promotion=game.show_promotion_box,
+        white_pieces_taken=game.board.white_pieces_taken,
+        black_pieces_taken=game.board.black_pieces_taken,
+        result=(game.white_checkmate, game.black_checkmate, game.stalemate),
+        aimove=game.ai_colour == game.current_player_colour,
+        start_menu=not game.in_progress,
     )
 
 
@@ -38,42 +116,43 @@ def move():
     the row and column of the square that was clicked. After a second square
     is clicked the two squares form a move, which is validated and executed.
     """
-    if GAME.show_promotion_box:
+    game = get_game()
+    if game.show_promotion_box:
         return redirect("/")
 
     column = int(request.args.get("column")) - 1
     row = int(request.args.get("row")) - 1
     new_square = (row, column)
 
-    if len(GAME.current_move) == 1:  # The piece is being moved to the new square
-        current_square = GAME.current_move[0]
-        if GAME.validate_move(current_square, new_square):
-            GAME.execute_move(current_square, new_square)
-            piece = GAME.board.board[row][column]
+    if len(game.current_move) == 1:  # The piece is being moved to the new square
+        current_square = game.current_move[0]
+        if game.validate_move(current_square, new_square):
+            game.execute_move(current_square, new_square)
+            piece = game.board.board[row][column]
             # Promote pawn
             if isinstance(piece, Pawn) and (
                 piece.colour and row == 0 or not piece.colour and row == 7
             ):
-                GAME.show_promotion_box = True
-                GAME.promotion_square = (row, column)
+                game.show_promotion_box = True
+                game.promotion_square = (row, column)
                 return redirect("/")
 
-            GAME.is_checkmate_or_stalemate()
-            GAME.check_draw()
+            game.is_checkmate_or_stalemate()
+            game.check_draw()
 
             # Display result
-            if GAME.white_checkmate or GAME.black_checkmate or GAME.stalemate:
+            if game.white_checkmate or game.black_checkmate or game.stalemate:
                 return redirect("/")
 
-            GAME.current_move.append(new_square)
+            game.current_move.append(new_square)
         else:
-            GAME.current_move = []
-            if GAME.board.board[row][column]:
-                GAME.current_move.append(new_square)
+            game.current_move = []
+            if game.board.board[row][column]:
+                game.current_move.append(new_square)
 
     else:  # The piece to be moved is on the new square
-        GAME.current_move = []
-        GAME.current_move.append(new_square)
+        game.current_move = []
+        game.current_move.append(new_square)
 
     return redirect("/")
 
@@ -81,28 +160,16 @@ def move():
 @app.route("/promote", methods=["GET", "POST"])
 def promote():
     """Promotes a pawn to a new piece"""
-    row, column = GAME.promotion_square
-    colour = not GAME.current_player_colour
-    pawn = GAME.board.board[row][column]
-
-    # Create new piece object
+    game = get_game()
+    # Replace the pawn with the new piece
     piece_type = request.args.get("piece")
     piece_class = globals()[piece_type]
-    new_piece = piece_class(row, column, colour)
-    if colour:
-        GAME.board.white_pieces.remove(pawn)
-        GAME.board.white_pieces.append(new_piece)
-    else:
-        GAME.board.black_pieces.remove(pawn)
-        GAME.board.black_pieces.append(new_piece)
-
-    # Put piece on board
-    GAME.board.board[row][column] = new_piece
-    GAME.show_promotion_box = False
-    GAME.promotion_square = ()
-
-    if GAME.current_player_colour == GAME.ai_colour:
-        if GAME.white_checkmate or GAME.black_checkmate or GAME.stalemate:
+    game.promote_pawn(game.promotion_square, piece_class)
+    game.show_promotion_box = False
+    game.promotion_square = ()
+
+    if game.current_player_colour == game.ai_colour:
+        if game.white_checkmate or game.black_checkmate or game.stalemate:
             return redirect("/")
 
         return redirect("/aimove")
@@ -113,9 +180,7 @@ def promote():
 @app.route("/rematch")
 def rematch():
     """Restarts the game"""
-    global GAME
-    GAME = Game()
-    GAME.board.initialise_board()
+    new_game()
     return redirect("/")
 
 
@@ -126,13 +191,13 @@ def resign():
     made, returning the colour of the player resigning. If
     this player is the current player then they have lost.
     """
-
+    game = get_game()
     player = request.args.get("player")
-    if player == str(GAME.current_player_colour):
+    if player == str(game.current_player_colour):
         if player == "True":
-            GAME.black_checkmate = True
+            game.black_checkmate = True
         else:
-            GAME.white_checkmate = True
+            game.white_checkmate = True
 
     return redirect("/")
 
@@ -140,53 +205,89 @@ def resign():
 @app.route("/aimove")
 def aimove():
     """Allows the AI to make a move after the user."""
+    game = get_game()
+
+    # Play a book or tablebase move if there is one. Otherwise search for the
+    # best move in a worker process. If the search has not finished, the
+    # board is shown again and it requests /aimove until it has. After a
+    # searched move, the reply in the search's principal variation is
+    # pondered on.
+    # current_square, new_square = ai.get_greedy_ai_move(game)
+    variation = []
+    move = ai.get_book_move(game)
+    if move is None:
+        move = ai.get_tablebase_move(game)
+    if move is None:
+        job_id = AI_JOBS.submit(
+            game.to_fen(),
+            AI.TIME_BUDGET_MS,
+            session["game_id"],
+            game.get_recent_history(),
+        )
+        result = AI_JOBS.wait_for_result(job_id, AI_WAIT_SECONDS)
+        if result is None:
+            return redirect("/")
+        move, search_stats = result
+        variation = search_stats["principal_variation"]
+
+    current_square, new_square = move
+    while not game.validate_move(current_square, new_square):
+        current_square, new_square = ai.get_random_move(game.get_valid_moves())
 
-    # Call the AI method to get best move
-    # current_square, new_square = ai.get_greedy_ai_move(GAME)
-    ai.get_ai_move_minimax(GAME, AI.DEPTH, GAME.current_player_colour)
-    moves = ai.minimax_best_moves
-    if moves:
-        current_square, new_square = ai.get_random_move(moves)
-        while not GAME.validate_move(current_square, new_square):
-            current_square, new_square = ai.get_random_move(moves)
-    else:
-        current_square, new_square = ai.get_random_move(GAME.get_valid_moves())
-
-    GAME.execute_move(current_square, new_square)
+    game.execute_move(current_square, new_square)
     row, column = new_square
-    piece = GAME.board.board[row][column]
+    piece = game.board.board[row][column]
     # Pawn promotion
     if isinstance(piece, Pawn) and (
         piece.colour and row == 0 or not piece.colour and row == 7
     ):
-        GAME.promotion_square = (new_square[0], new_square[1])
+        game.promotion_square = (new_square[0], new_square[1])
         return redirect("/promote?piece=Queen")
 
-    GAME.is_checkmate_or_stalemate()
-    GAME.check_draw()
+    game.is_checkmate_or_stalemate()
+    game.check_draw()
 
-    GAME.current_move = [current_square, new_square]
+    game.current_move = [current_square, new_square]
+
+    if (
+        len(variation) > 1
+        and list(variation[0]) == [current_square, new_square]
+        and not (game.white_checkmate or game.black_checkmate or game.stalemate)
+    ):
+        ponder(game, variation[1])
 
     return redirect("/")
 
 
+@app.route("/stats")
+def stats():
+    """
+    Returns statistics of the game store and the AI searches as JSON. The
+    last search's statistics come from the worker process which ran it,
+    while the instrumentation totals are for the webapp's own process.
+    """
+    return jsonify(
+        store=STORE.stats(),
+        ai_jobs=AI_JOBS.stats(),
+        instrumentation=INSTRUMENTATION.stats(),
+    )
+
+
 @app.route("/setup", methods=["GET", "POST"])
 def setup():
     """Sets up the game."""
-    global GAME
     game_mode = request.args.get("mode")
-    GAME = Game()
-    GAME.board.initialise_board()
-    GAME.in_progress = True
+    game = new_game()
+    game.in_progress = True
     if game_mode == "2player":
-        GAME.ai_game = False
-        GAME.ai_colour = None
+        game.ai_game = False
+        game.ai_colour = None
     elif game_mode == "aiwhite":
-        GAME.ai_game = True
-        GAME.ai_colour = False
+        game.ai_game = True
+        game.ai_colour = False
     elif game_mode == "aiblack":
-        GAME.ai_game = True
-        GAME.ai_colour = True
+        game.ai_game = True
+        game.ai_colour = True
         return redirect("/aimove")
 
     return redirect("/")
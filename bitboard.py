@@ -0,0 +1,671 @@
+"""Bitboards"""
+
+from chess_engine import (
+    DIRECTIONS,
+    KING_ATTACKS as KING_SQUARES,
+    KNIGHT_ATTACKS as KNIGHT_SQUARES,
+    PAWN_ATTACKS as PAWN_SQUARES,
+    RAYS as SQUARE_RAYS,
+    PAWN,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    KING,
+    FIFTY_MOVE_PLIES,
+    WHITE_KING_SIDE,
+    WHITE_QUEEN_SIDE,
+    BLACK_KING_SIDE,
+    BLACK_QUEEN_SIDE,
+    ALL_CASTLING_RIGHTS,
+    CASTLING_RIGHTS_KEPT,
+    ZOBRIST_PIECE_KEYS,
+    ZOBRIST_BLACK_TO_MOVE,
+    ZOBRIST_CASTLING_KEYS,
+    ZOBRIST_EN_PASSANT_KEYS,
+)
+from evaluation import Evaluation
+
+# Squares are numbered row * 8 + column, using the same rows and columns as
+# Board.board: square 0 is a8 and square 63 is h1. Bit n of a bitboard is set
+# if square n is in the set.
+
+PIECE_VALUES = (1, 3, 3, 5, 9, 0)
+PROMOTION_TYPES = (QUEEN, ROOK, BISHOP, KNIGHT)
+
+ALL_SQUARES = (1 << 64) - 1
+SQUARES = [divmod(square, 8) for square in range(64)]
+
+# The mailbox stores these (colour, piece type) pairs so that no new tuples
+# are created while moves are made
+PIECE_CODES = {
+    colour: [(colour, piece_type) for piece_type in range(6)]
+    for colour in (True, False)
+}
+
+
+def _bitboard(squares):
+    """Returns the bitboard of some (row, column) squares."""
+    bitboard = 0
+    for row, column in squares:
+        bitboard |= 1 << (row * 8 + column)
+    return bitboard
+
+
+# The attack tables of the engine, as bitboards
+KNIGHT_ATTACKS = [_bitboard(squares) for squares in KNIGHT_SQUARES]
+KING_ATTACKS = [_bitboard(squares) for squares in KING_SQUARES]
+
+# Squares attacked by a pawn on each square, indexed by colour. White pawns
+# move up the board (towards row 0).
+PAWN_ATTACKS = [
+    [_bitboard(squares) for squares in PAWN_SQUARES[colour]] for colour in (False, True)
+]
+
+# The first four of DIRECTIONS are straight lines, the last four diagonals
+STRAIGHT_DIRECTIONS = range(4)
+DIAGONAL_DIRECTIONS = range(4, 8)
+
+# Whether the square numbers increase along each direction. The nearest
+# blocker on a ray is its lowest set bit if they do and its highest if not.
+INCREASING = [row_step * 8 + column_step > 0 for row_step, column_step in DIRECTIONS]
+
+# The squares along each direction from each square, to the edge
+RAYS = [
+    [_bitboard(square_rays[direction]) for square_rays in SQUARE_RAYS]
+    for direction in range(8)
+]
+
+
+def _between():
+    """Returns the squares strictly between each pair of squares on a line."""
+    between = [[0] * 64 for _ in range(64)]
+    for direction, direction_rays in enumerate(RAYS):
+        for square in range(64):
+            squares_passed = 0
+            ray = direction_rays[square]
+            while ray:
+                target = first_square(ray, INCREASING[direction])
+                between[square][target] = squares_passed
+                squares_passed |= 1 << target
+                ray ^= 1 << target
+    return between
+
+
+def first_square(bitboard, increasing=True):
+    """Returns the lowest (or highest) square in a non-empty bitboard."""
+    if increasing:
+        return (bitboard & -bitboard).bit_length() - 1
+    return bitboard.bit_length() - 1
+
+
+def iterate_squares(bitboard):
+    """Yields the squares in a bitboard from lowest to highest."""
+    while bitboard:
+        lowest_bit = bitboard & -bitboard
+        yield lowest_bit.bit_length() - 1
+        bitboard ^= lowest_bit
+
+
+def sliding_attacks(square, occupied, directions):
+    """
+    Returns the squares attacked along the directions from a square. Each ray
+    stops at (and includes) the first occupied square.
+    """
+    attacks = 0
+    for direction in directions:
+        ray = RAYS[direction][square]
+        blockers = ray & occupied
+        if blockers:
+            ray ^= RAYS[direction][first_square(blockers, INCREASING[direction])]
+        attacks |= ray
+    return attacks
+
+
+def rook_attacks(square, occupied):
+    """Returns the squares attacked by a rook on the square."""
+    return sliding_attacks(square, occupied, STRAIGHT_DIRECTIONS)
+
+
+def bishop_attacks(square, occupied):
+    """Returns the squares attacked by a bishop on the square."""
+    return sliding_attacks(square, occupied, DIAGONAL_DIRECTIONS)
+
+
+BETWEEN = _between()
+
+# Castling rights kept when a piece moves from or to each square
+CASTLING_MASKS = [
+    CASTLING_RIGHTS_KEPT.get(square, ALL_CASTLING_RIGHTS) for square in SQUARES
+]
+
+# For each castling move: the right needed, the king's start and end squares,
+# the rook's start and end squares, the squares which must be empty and the
+# squares which must not be attacked
+CASTLING_MOVES = {
+    True: [
+        (WHITE_KING_SIDE, 60, 62, 63, 61, (61, 62), (60, 61, 62)),
+        (WHITE_QUEEN_SIDE, 60, 58, 56, 59, (57, 58, 59), (60, 59, 58)),
+    ],
+    False: [
+        (BLACK_KING_SIDE, 4, 6, 7, 5, (5, 6), (4, 5, 6)),
+        (BLACK_QUEEN_SIDE, 4, 2, 0, 3, (1, 2, 3), (4, 3, 2)),
+    ],
+}
+CASTLING_ROOK_SQUARES = {
+    king_to: (rook_from, rook_to)
+    for colour in (True, False)
+    for _, _, king_to, rook_from, rook_to, _, _ in CASTLING_MOVES[colour]
+}
+
+# Zobrist keys, shared with Game so that both give the same hash
+PIECE_KEYS = {
+    colour: [ZOBRIST_PIECE_KEYS[piece_type, colour] for piece_type in range(6)]
+    for colour in (True, False)
+}
+
+
+def _castling_hashes():
+    """Returns the combined castling key for each set of castling rights."""
+    hashes = []
+    for rights in range(16):
+        castling_hash = 0
+        for index, key in enumerate(ZOBRIST_CASTLING_KEYS):
+            if rights & (1 << index):
+                castling_hash ^= key
+        hashes.append(castling_hash)
+    return hashes
+
+
+CASTLING_HASHES = _castling_hashes()
+
+
+def encode_move(current_square, new_square, promotion=0):
+    """
+    Packs a move into an integer: bits 0-5 hold the square the piece moves
+    from, bits 6-11 the square it moves to and bits 12-14 the type of piece a
+    pawn is promoted to (0 if the move is not a promotion).
+    """
+    return current_square | new_square << 6 | promotion << 12
+
+
+def decode_move(move):
+    """Returns the current square, new square and promotion type of a move."""
+    return move & 63, (move >> 6) & 63, move >> 12
+
+
+class BitboardPosition:
+    """
+    Represents a position with one 64-bit integer per piece type and colour,
+    plus a list of the piece on each square. Moves are made and unmade in
+    place, so the position can be used for searching instead of a Game.
+    """
+
+    def __init__(self):
+        self.pieces = {True: [0] * 6, False: [0] * 6}
+        self.occupied = {True: 0, False: 0}
+        self.mailbox = [None] * 64
+        self.current_player_colour = True
+        self.castling_rights = 0
+        self.en_passant_square = None
+        self.zobrist_hash = 0
+        self.halfmove_clock = 0
+        self.position_counts = {}  # Hash -> number of times it has occurred
+        self.evaluation = Evaluation()
+        self.white_checkmate = False
+        self.black_checkmate = False
+        self.stalemate = False
+        self.__history = []
+        self.__legal_moves = None
+
+    @classmethod
+    def from_game(cls, game):
+        """
+        Creates a position with the same pieces and state as a Game, including
+        the positions which have occurred in the game so far.
+        """
+        position = cls()
+        for piece in game.board.white_pieces + game.board.black_pieces:
+            position.put_piece(
+                piece.colour, piece.piece_type, piece.row * 8 + piece.column
+            )
+
+        position.current_player_colour = game.current_player_colour
+        position.castling_rights = game.castling_rights
+        en_passant_square = game.en_passant_square
+        if en_passant_square is not None:
+            row, column = en_passant_square
+            position.en_passant_square = row * 8 + column
+        position.zobrist_hash = position.compute_hash()
+        position.halfmove_clock = game.halfmove_clock
+        position.position_counts = dict(game.position_counts)
+        return position
+
+    def put_piece(self, colour, piece_type, square):
+        """Places a piece on an empty square (the hash is not updated)."""
+        bit = 1 << square
+        self.pieces[colour][piece_type] |= bit
+        self.occupied[colour] |= bit
+        self.mailbox[square] = PIECE_CODES[colour][piece_type]
+        self.evaluation.add_piece(colour, piece_type, square)
+
+    def compute_hash(self):
+        """Computes the Zobrist hash from scratch, in the same way as Game."""
+        zobrist_hash = CASTLING_HASHES[self.castling_rights]
+        if not self.current_player_colour:
+            zobrist_hash ^= ZOBRIST_BLACK_TO_MOVE
+        if self.en_passant_square is not None:
+            zobrist_hash ^= ZOBRIST_EN_PASSANT_KEYS[self.en_passant_square % 8]
+        for square, piece in enumerate(self.mailbox):
+            if piece is not None:
+                colour, piece_type = piece
+                zobrist_hash ^= PIECE_KEYS[colour][piece_type][square]
+        return zobrist_hash
+
+    def attackers(self, square, by_colour, occupied):
+        """
+        Returns the pieces of the given colour which attack the square, given
+        the set of occupied squares.
+        """
+        pieces = self.pieces[by_colour]
+        return (
+            (KNIGHT_ATTACKS[square] & pieces[KNIGHT])
+            | (KING_ATTACKS[square] & pieces[KING])
+            | (PAWN_ATTACKS[not by_colour][square] & pieces[PAWN])
+            | (bishop_attacks(square, occupied) & (pieces[BISHOP] | pieces[QUEEN]))
+            | (rook_attacks(square, occupied) & (pieces[ROOK] | pieces[QUEEN]))
+        )
+
+    def is_square_attacked(self, square, by_colour):
+        """Returns whether any piece of the given colour attacks the square."""
+        occupied = self.occupied[True] | self.occupied[False]
+        return bool(self.attackers(square, by_colour, occupied))
+
+    def in_check(self):
+        """Returns whether the current player's king is attacked."""
+        colour = self.current_player_colour
+        king_square = first_square(self.pieces[colour][KING])
+        return self.is_square_attacked(king_square, not colour)
+
+    def generate_legal_moves(self):
+        """
+        Returns all legal moves as encoded integers, including castling, en
+        passant and promotion to each type of piece. The pieces giving check
+        and the pinned pieces are found once, and each candidate is checked
+        against them rather than by making the move.
+        """
+        colour = self.current_player_colour
+        opponent = not colour
+        own = self.occupied[colour]
+        occupied = own | self.occupied[opponent]
+        pieces = self.pieces[colour]
+        opponent_pieces = self.pieces[opponent]
+        king_square = first_square(pieces[KING])
+        moves = []
+
+        # King moves, checking the new squares with the king removed so that
+        # it cannot step back along the line of a sliding attacker
+        without_king = occupied ^ (1 << king_square)
+        for new_square in iterate_squares(KING_ATTACKS[king_square] & ~own):
+            if not self.attackers(new_square, opponent, without_king):
+                moves.append(king_square | new_square << 6)
+
+        checkers = self.attackers(king_square, opponent, occupied)
+        if checkers & (checkers - 1):  # Only the king can move in double check
+            return moves
+
+        if checkers:
+            # Other pieces must take the checking piece or block its line
+            check_mask = checkers | BETWEEN[king_square][first_square(checkers)]
+        else:
+            check_mask = ALL_SQUARES
+            self.__add_castling_moves(moves, colour, occupied)
+
+        # Find pinned pieces. Each can only move along the line between the
+        # king and the piece pinning it.
+        pin_masks = {}
+        straight = opponent_pieces[ROOK] | opponent_pieces[QUEEN]
+        diagonal = opponent_pieces[BISHOP] | opponent_pieces[QUEEN]
+        for direction in range(8):
+            ray = RAYS[direction][king_square]
+            attackers = straight if direction < 4 else diagonal
+            if not ray & attackers:
+                continue
+            blockers = ray & occupied
+            increasing = INCREASING[direction]
+            first_blocker = first_square(blockers, increasing)
+            if not own & (1 << first_blocker):
+                continue
+            blockers ^= 1 << first_blocker
+            if blockers:
+                pinner = first_square(blockers, increasing)
+                if attackers & (1 << pinner):
+                    pin_masks[first_blocker] = (
+                        BETWEEN[king_square][pinner] | 1 << pinner
+                    )
+
+        targets = ~own & check_mask
+        opponent_occupied = self.occupied[opponent]
+
+        for square in iterate_squares(pieces[KNIGHT]):
+            allowed = targets & pin_masks.get(square, ALL_SQUARES)
+            for new_square in iterate_squares(KNIGHT_ATTACKS[square] & allowed):
+                moves.append(square | new_square << 6)
+
+        for square in iterate_squares(pieces[BISHOP] | pieces[QUEEN]):
+            allowed = targets & pin_masks.get(square, ALL_SQUARES)
+            for new_square in iterate_squares(
+                bishop_attacks(square, occupied) & allowed
+            ):
+                moves.append(square | new_square << 6)
+
+        for square in iterate_squares(pieces[ROOK] | pieces[QUEEN]):
+            allowed = targets & pin_masks.get(square, ALL_SQUARES)
+            for new_square in iterate_squares(rook_attacks(square, occupied) & allowed):
+                moves.append(square | new_square << 6)
+
+        # Pawns
+        step = -8 if colour else 8
+        start_row = 6 if colour else 1
+        last_row = 0 if colour else 7
+        for square in iterate_squares(pieces[PAWN]):
+            allowed = targets & pin_masks.get(square, ALL_SQUARES)
+            new_squares = PAWN_ATTACKS[colour][square] & opponent_occupied
+            forward = square + step
+            if not occupied & (1 << forward):
+                new_squares |= 1 << forward
+                double_forward = forward + step
+                if square // 8 == start_row and not occupied & (1 << double_forward):
+                    new_squares |= 1 << double_forward
+
+            for new_square in iterate_squares(new_squares & allowed):
+                if new_square // 8 == last_row:
+                    for promotion in PROMOTION_TYPES:
+                        moves.append(square | new_square << 6 | promotion << 12)
+                else:
+                    moves.append(square | new_square << 6)
+
+            # En passant is checked directly, as it removes two pieces from
+            # the capturing pawn's row
+            if self.en_passant_square is not None and PAWN_ATTACKS[colour][square] & (
+                1 << self.en_passant_square
+            ):
+                captured_square = self.en_passant_square - step
+                after = (
+                    occupied ^ (1 << square) ^ (1 << captured_square)
+                ) | 1 << self.en_passant_square
+                if not self.attackers(king_square, opponent, after) & ~(
+                    1 << captured_square
+                ):
+                    moves.append(square | self.en_passant_square << 6)
+
+        return moves
+
+    def __add_castling_moves(self, moves, colour, occupied):
+        """Adds the castling moves for a player who is not in check."""
+        for (
+            right,
+            king_from,
+            king_to,
+            _,
+            _,
+            empty_squares,
+            safe_squares,
+        ) in CASTLING_MOVES[colour]:
+            if not self.castling_rights & right:
+                continue
+            if any(occupied & (1 << square) for square in empty_squares):
+                continue
+            if any(
+                self.attackers(square, not colour, occupied) for square in safe_squares
+            ):
+                continue
+            moves.append(king_from | king_to << 6)
+
+    def make(self, move):
+        """Makes an encoded move, saving what is needed to unmake it."""
+        current_square, new_square, promotion = decode_move(move)
+        colour = self.current_player_colour
+        opponent = not colour
+        mailbox = self.mailbox
+        _, piece_type = mailbox[current_square]
+        captured_square = new_square
+        if piece_type == PAWN and new_square == self.en_passant_square:
+            captured_square = new_square + (8 if colour else -8)
+        captured = mailbox[captured_square]
+        zobrist_hash = self.zobrist_hash
+        evaluation = self.evaluation
+
+        self.__history.append(
+            (
+                move,
+                captured,
+                captured_square,
+                self.castling_rights,
+                self.en_passant_square,
+                zobrist_hash,
+                self.halfmove_clock,
+                evaluation.get_state(),
+                self.__legal_moves,
+                self.white_checkmate,
+                self.black_checkmate,
+                self.stalemate,
+            )
+        )
+
+        # Remove the old castling rights and en passant square from the hash
+        zobrist_hash ^= CASTLING_HASHES[self.castling_rights] ^ ZOBRIST_BLACK_TO_MOVE
+        if self.en_passant_square is not None:
+            zobrist_hash ^= ZOBRIST_EN_PASSANT_KEYS[self.en_passant_square % 8]
+
+        if captured is not None:
+            _, captured_type = captured
+            bit = 1 << captured_square
+            self.pieces[opponent][captured_type] ^= bit
+            self.occupied[opponent] ^= bit
+            mailbox[captured_square] = None
+            zobrist_hash ^= PIECE_KEYS[opponent][captured_type][captured_square]
+            evaluation.remove_piece(opponent, captured_type, captured_square)
+
+        # Move the piece, replacing a promoted pawn
+        own_pieces = self.pieces[colour]
+        keys = PIECE_KEYS[colour]
+        new_type = promotion or piece_type
+        own_pieces[piece_type] ^= 1 << current_square
+        own_pieces[new_type] ^= 1 << new_square
+        self.occupied[colour] ^= 1 << current_square | 1 << new_square
+        mailbox[current_square] = None
+        mailbox[new_square] = PIECE_CODES[colour][new_type]
+        zobrist_hash ^= keys[piece_type][current_square] ^ keys[new_type][new_square]
+        if promotion:
+            evaluation.remove_piece(colour, PAWN, current_square)
+            evaluation.add_piece(colour, promotion, new_square)
+        else:
+            evaluation.move_piece(colour, piece_type, current_square, new_square)
+
+        # Move the rook when castling
+        if piece_type == KING and abs(new_square - current_square) == 2:
+            rook_from, rook_to = CASTLING_ROOK_SQUARES[new_square]
+            own_pieces[ROOK] ^= 1 << rook_from | 1 << rook_to
+            self.occupied[colour] ^= 1 << rook_from | 1 << rook_to
+            mailbox[rook_from] = None
+            mailbox[rook_to] = PIECE_CODES[colour][ROOK]
+            zobrist_hash ^= keys[ROOK][rook_from] ^ keys[ROOK][rook_to]
+            evaluation.move_piece(colour, ROOK, rook_from, rook_to)
+
+        if piece_type == PAWN and abs(new_square - current_square) == 16:
+            self.en_passant_square = (current_square + new_square) // 2
+            zobrist_hash ^= ZOBRIST_EN_PASSANT_KEYS[current_square % 8]
+        else:
+            self.en_passant_square = None
+
+        self.castling_rights &= (
+            CASTLING_MASKS[current_square] & CASTLING_MASKS[new_square]
+        )
+        zobrist_hash ^= CASTLING_HASHES[self.castling_rights]
+
+        if piece_type == PAWN or captured is not None:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+
+        self.current_player_colour = opponent
+        self.zobrist_hash = zobrist_hash
+        self.position_counts[zobrist_hash] = (
+            self.position_counts.get(zobrist_hash, 0) + 1
+        )
+        self.__legal_moves = None
+        self.white_checkmate = False
+        self.black_checkmate = False
+        self.stalemate = False
+
+    def unmake(self):
+        """Unmakes the last move made."""
+        count = self.position_counts[self.zobrist_hash] - 1
+        if count:
+            self.position_counts[self.zobrist_hash] = count
+        else:
+            del self.position_counts[self.zobrist_hash]
+        (
+            move,
+            captured,
+            captured_square,
+            self.castling_rights,
+            self.en_passant_square,
+            self.zobrist_hash,
+            self.halfmove_clock,
+            evaluation_state,
+            self.__legal_moves,
+            self.white_checkmate,
+            self.black_checkmate,
+            self.stalemate,
+        ) = self.__history.pop()
+        self.evaluation.set_state(evaluation_state)
+        current_square, new_square, promotion = decode_move(move)
+        colour = not self.current_player_colour
+        self.current_player_colour = colour
+        mailbox = self.mailbox
+        own_pieces = self.pieces[colour]
+
+        _, new_type = mailbox[new_square]
+        piece_type = PAWN if promotion else new_type
+        own_pieces[new_type] ^= 1 << new_square
+        own_pieces[piece_type] ^= 1 << current_square
+        self.occupied[colour] ^= 1 << current_square | 1 << new_square
+        mailbox[new_square] = None
+        mailbox[current_square] = PIECE_CODES[colour][piece_type]
+
+        if piece_type == KING and abs(new_square - current_square) == 2:
+            rook_from, rook_to = CASTLING_ROOK_SQUARES[new_square]
+            own_pieces[ROOK] ^= 1 << rook_from | 1 << rook_to
+            self.occupied[colour] ^= 1 << rook_from | 1 << rook_to
+            mailbox[rook_to] = None
+            mailbox[rook_from] = PIECE_CODES[colour][ROOK]
+
+        if captured is not None:
+            _, captured_type = captured
+            bit = 1 << captured_square
+            self.pieces[not colour][captured_type] ^= bit
+            self.occupied[not colour] ^= bit
+            mailbox[captured_square] = captured
+
+    def get_valid_moves(self):
+        """
+        Returns the legal moves in the same format as Game.get_valid_moves:
+        a list of [current square, new square] pairs of (row, column) tuples.
+        A pawn reaching the last row is listed once, as in Game, and is
+        promoted to a queen by make_move.
+        """
+        if self.__legal_moves is None:
+            self.__legal_moves = self.generate_legal_moves()
+        return [
+            [SQUARES[move & 63], SQUARES[(move >> 6) & 63]]
+            for move in self.__legal_moves
+            if move >> 12 in (0, QUEEN)
+        ]
+
+    def make_move(self, move):
+        """
+        Makes a move given as a [current square, new square] pair, promoting
+        pawns to queens.
+        """
+        (current_row, current_column), (new_row, new_column) = move
+        current_square = current_row * 8 + current_column
+        new_square = new_row * 8 + new_column
+        promotion = 0
+        if self.mailbox[current_square][1] == PAWN and new_row in (0, 7):
+            promotion = QUEEN
+        self.make(encode_move(current_square, new_square, promotion))
+
+    def unmake_move(self):
+        """Unmakes the last move made with make_move."""
+        self.unmake()
+
+    def get_piece_value(self, square):
+        """Returns the value of the piece on a (row, column) square, or None."""
+        row, column = square
+        piece = self.mailbox[row * 8 + column]
+        if piece is None:
+            return None
+        return PIECE_VALUES[piece[1]]
+
+    def get_material(self):
+        """Returns the value of the white pieces minus the black pieces."""
+        white = self.pieces[True]
+        black = self.pieces[False]
+        return sum(
+            value * (white[piece_type].bit_count() - black[piece_type].bit_count())
+            for piece_type, value in enumerate(PIECE_VALUES)
+        )
+
+    def is_checkmate_or_stalemate(self):
+        """
+        Sets the checkmate or stalemate flag, in the same way as Game, if the
+        current player has no legal moves.
+        """
+        if self.__legal_moves is None:
+            self.__legal_moves = self.generate_legal_moves()
+        if self.__legal_moves:
+            return
+
+        if not self.in_check():
+            self.stalemate = True
+        elif self.current_player_colour:
+            self.black_checkmate = True
+        else:
+            self.white_checkmate = True
+
+    def is_repetition(self):
+        """Checks if the current position has occurred before, like Game."""
+        return self.position_counts.get(self.zobrist_hash, 0) > 1
+
+    def check_draw(self):
+        """
+        Sets the stalemate flag if neither player has enough material to
+        checkmate, the position has occurred three times or the fifty-move
+        rule applies, using the same rules as Game.check_draw.
+        """
+        if self.white_checkmate or self.black_checkmate:
+            return
+        if (
+            self.__has_insufficient_material()
+            or self.position_counts.get(self.zobrist_hash, 0) >= 3
+            or self.halfmove_clock >= FIFTY_MOVE_PLIES
+        ):
+            self.stalemate = True
+
+    def __has_insufficient_material(self):
+        """Checks if neither player has enough material to checkmate."""
+        if self.occupied[False] == self.pieces[False][KING]:
+            opponent = self.pieces[True]
+        elif self.occupied[True] == self.pieces[True][KING]:
+            opponent = self.pieces[False]
+        else:
+            return False
+
+        return not (
+            sum(bitboard.bit_count() for bitboard in opponent) > 2
+            or opponent[PAWN]
+            or opponent[ROOK]
+            or opponent[QUEEN]
+        )
@@ -1,4 +1,88 @@
 """Chess"""
+import random
+import time
+
+# (row, column) steps for the straight lines and then the diagonals
+DIRECTIONS = [(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+KNIGHT_SHIFTS = [(2, 1), (2, -1), (-2, 1), (-2, -1), (1, 2), (1, -2), (-1, 2), (-1, -2)]
+
+# Type tags of the pieces, also used to index the evaluation tables
+PAWN, KNIGHT, BISHOP, ROOK, QUEEN, KING = range(6)
+STRAIGHT_SLIDERS = (ROOK, QUEEN)
+DIAGONAL_SLIDERS = (BISHOP, QUEEN)
+# The directions a sliding piece moves in, as indices of DIRECTIONS
+SLIDER_DIRECTIONS = {BISHOP: range(4, 8), ROOK: range(4), QUEEN: range(8)}
+
+# Plies without a capture or pawn move after which the game is a draw
+FIFTY_MOVE_PLIES = 100
+
+# Castling rights are stored as bit flags, in the order white king-side, white
+# queen-side, black king-side, black queen-side
+WHITE_KING_SIDE = 1
+WHITE_QUEEN_SIDE = 2
+BLACK_KING_SIDE = 4
+BLACK_QUEEN_SIDE = 8
+ALL_CASTLING_RIGHTS = 0b1111
+# The castling rights kept when a piece moves from or to a king's or rook's
+# starting square, keyed by (row, column). The rights for other squares are
+# all kept.
+CASTLING_RIGHTS_KEPT = {
+    (7, 4): ALL_CASTLING_RIGHTS & ~(WHITE_KING_SIDE | WHITE_QUEEN_SIDE),
+    (7, 7): ALL_CASTLING_RIGHTS & ~WHITE_KING_SIDE,
+    (7, 0): ALL_CASTLING_RIGHTS & ~WHITE_QUEEN_SIDE,
+    (0, 4): ALL_CASTLING_RIGHTS & ~(BLACK_KING_SIDE | BLACK_QUEEN_SIDE),
+    (0, 7): ALL_CASTLING_RIGHTS & ~BLACK_KING_SIDE,
+    (0, 0): ALL_CASTLING_RIGHTS & ~BLACK_QUEEN_SIDE,
+}
+
+
+def _step_squares(shifts):
+    """
+    Returns the (row, column) of the squares one step away from each square
+    by the given shifts, indexed by row * 8 + column.
+    """
+    return [
+        tuple(
+            (row + vertical_shift, column + horizontal_shift)
+            for vertical_shift, horizontal_shift in shifts
+            if 0 <= row + vertical_shift < 8 and 0 <= column + horizontal_shift < 8
+        )
+        for row in range(8)
+        for column in range(8)
+    ]
+
+
+def _rays():
+    """
+    Returns the squares along each of DIRECTIONS from each square, nearest
+    first, indexed by row * 8 + column and then direction.
+    """
+    rays = []
+    for row in range(8):
+        for column in range(8):
+            square_rays = []
+            for vertical_shift, horizontal_shift in DIRECTIONS:
+                ray = []
+                new_row, new_column = row + vertical_shift, column + horizontal_shift
+                while 0 <= new_row < 8 and 0 <= new_column < 8:
+                    ray.append((new_row, new_column))
+                    new_row += vertical_shift
+                    new_column += horizontal_shift
+                square_rays.append(tuple(ray))
+            rays.append(square_rays)
+    return rays
+
+
+# Squares attacked from each square, indexed by row * 8 + column. A pawn of
+# one colour on a square attacks the squares that pawns of the other colour
+# attack it from.
+KNIGHT_ATTACKS = _step_squares(KNIGHT_SHIFTS)
+KING_ATTACKS = _step_squares(DIRECTIONS)
+PAWN_ATTACKS = {
+    True: _step_squares([(-1, -1), (-1, 1)]),
+    False: _step_squares([(1, -1), (1, 1)]),
+}
+RAYS = _rays()
 
 
 class Board:
@@ -49,8 +133,14 @@ class Piece:
     Represents a general piece on the board. The value is defined by the
     type of piece: Pawn = 1, Bishop, Knight = 3, Rook = 5, Queen = 9.
     The colour attribute is a Boolean: True = white, False = black.
+    The piece_type tag identifies the type of piece without an isinstance
+    check. Pieces use __slots__ rather than a __dict__, as the search makes
+    and looks at them very often.
     """
 
+    __slots__ = ("row", "column", "value", "colour")
+    piece_type = None
+
     def __init__(self, row, column, value, colour):
         self.row = row
         self.column = column
@@ -71,6 +161,37 @@ class Piece:
         it is moving downwards on the board.
         """
 
+    def generate_board_moves(self, board):
+        """
+        Generates the moves that the piece can make on the given board,
+        leaving out squares taken by pieces of its own colour. Sliding pieces
+        and pawns override this to account for pieces in their way.
+        """
+        moves = []
+        for row, column in self.generate_moves():
+            piece = board[row][column]
+            if piece is None or piece.colour != self.colour:
+                moves.append((row, column))
+        return moves
+
+    def generate_sliding_moves(self, board, directions):
+        """
+        Walks along each direction, given as indices of DIRECTIONS, until the
+        edge of the board or the first piece. The square of that piece is
+        included if it can be taken.
+        """
+        moves = []
+        rays = RAYS[self.row * 8 + self.column]
+        for direction in directions:
+            for new_row, new_column in rays[direction]:
+                piece = board[new_row][new_column]
+                if piece is not None:
+                    if piece.colour != self.colour:
+                        moves.append((new_row, new_column))
+                    break
+                moves.append((new_row, new_column))
+        return moves
+
     def __repr__(self):
         return str(self)
 
@@ -81,8 +202,6 @@ class Game:
     def __init__(self):
         self.board = Board()
         self.current_player_colour = True
-        self.white_check = False
-        self.black_check = False
         self.white_king_location = (7, 4)
         self.black_king_location = (0, 4)
         self.white_checkmate = False
@@ -94,8 +213,121 @@ class Game:
         self.ai_game = False
         self.ai_colour = None
         self.in_progress = False
-        self.__just_castled = False
-        self.__en_passant_move = False
+        self.undo_stack = []
+        # Moves played with execute_move and pawns promoted with promote_pawn,
+        # in order, as (current square, new square, promoted piece class). A
+        # promotion is logged with the pawn's square as both squares. Moves
+        # are removed from the log once a GameStore has saved them.
+        self.move_log = []
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+        # Kept up to date by make_move, as in BitboardPosition, so that moves
+        # don't need to look at the other pieces to find them
+        self.castling_rights = self.__find_castling_rights()
+        self.en_passant_square = None
+        self.zobrist_hash = self.compute_hash()
+        self.start_history()
+
+    @classmethod
+    def from_fen(cls, fen):
+        """
+        Creates a game from a FEN string. Castling rights are also stored as
+        the has_moved flags of the kings and rooks, and are only kept if the
+        king and rook are on their starting squares. Missing fields after the
+        piece placement take their default values.
+        """
+        fields = fen.split()
+        placement, side, castling, en_passant, halfmove_clock, fullmove_number = (
+            fields + ["w", "-", "-", "0", "1"][len(fields) - 1 :]
+        )
+
+        game = cls()
+        board = game.board
+        board.board = [[None for _ in range(8)] for _ in range(8)]
+        board.white_pieces = []
+        board.black_pieces = []
+
+        for row, rank in enumerate(placement.split("/")):
+            column = 0
+            for letter in rank:
+                if letter.isdigit():
+                    column += int(letter)
+                    continue
+                colour = letter.isupper()
+                piece = FEN_PIECES[letter.lower()](row, column, colour)
+                board.board[row][column] = piece
+                if colour:
+                    board.white_pieces.append(piece)
+                else:
+                    board.black_pieces.append(piece)
+
+                if isinstance(piece, King):
+                    if colour:
+                        game.white_king_location = (row, column)
+                    else:
+                        game.black_king_location = (row, column)
+                    piece.has_moved = not any(
+                        right in castling for right in ("KQ" if colour else "kq")
+                    )
+                elif isinstance(piece, Rook):
+                    right = {0: "Q", 7: "K"}.get(column, "-")
+                    piece.has_moved = (right if colour else right.lower()) not in (
+                        castling
+                    )
+                elif isinstance(piece, Pawn):
+                    piece.has_moved = row != (6 if colour else 1)
+                column += 1
+
+        game.current_player_colour = side == "w"
+        game.castling_rights = game.__find_castling_rights()
+        game.en_passant_square = None
+        if en_passant != "-":
+            row, column = parse_square(en_passant)
+            pawn = board.board[row - 1 if row == 5 else row + 1][column]
+            if isinstance(pawn, Pawn):
+                game.en_passant_square = (row, column)
+
+        game.halfmove_clock = int(halfmove_clock)
+        game.fullmove_number = int(fullmove_number)
+        game.zobrist_hash = game.compute_hash()
+        game.start_history()
+        return game
+
+    def to_fen(self):
+        """Returns the FEN string of the current position."""
+        ranks = []
+        for row in self.board.board:
+            rank = ""
+            empty = 0
+            for piece in row:
+                if piece is None:
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                letter = FEN_LETTERS[type(piece)]
+                rank += letter.upper() if piece.colour else letter
+            if empty:
+                rank += str(empty)
+            ranks.append(rank)
+
+        castling = "".join(
+            letter
+            for letter, allowed in zip("KQkq", self.get_castling_rights())
+            if allowed
+        )
+        en_passant_square = self.en_passant_square
+        return " ".join(
+            [
+                "/".join(ranks),
+                "w" if self.current_player_colour else "b",
+                castling or "-",
+                "-" if en_passant_square is None else square_name(en_passant_square),
+                str(self.halfmove_clock),
+                str(self.fullmove_number),
+            ]
+        )
 
     def play(self):
         """Allows the game to played in the terminal (without a GUI)."""
@@ -137,602 +369,648 @@ class Game:
 
     def validate_move(self, current_square, new_square):
         """
-        Validates a move by checking if the piece is allowed to move to the new
-        square and if the new square does not have another piece of the same
-        colour. It also checks if the move results in the player's own king
-        being in check, in which case the move is invalid.
+        Validates a move by checking that it is one of the legal moves for the
+        current player. Moves which leave the player's own king in check are
+        not legal.
         """
-        current_row, current_column = current_square
-        new_row, new_column = new_square
-
-        current_piece = self.board.board[current_row][current_column]
-        piece_at_new_square = self.board.board[new_row][new_column]
-
-        # Check if move is legal for that type of piece and if move is blocked
-        if not self.__is_move_legal(
-            current_square, new_square
-        ) or self.__is_move_blocked(current_square, new_square):
-            return False
-
-        # Check if there is a piece at the new square of the same colour
-        if piece_at_new_square is not None:
-            if current_piece.colour == piece_at_new_square.colour:
-                return False
-
-        self.__is_king_in_check()
-
-        # check if move is castle
-        if isinstance(current_piece, King):
-            if (
-                new_row == current_row
-                and new_column == current_column + 2
-                or new_column == current_column - 2
-            ):
-                return self.__validate_castling_move(current_square, new_square)
+        return [tuple(current_square), tuple(new_square)] in self.get_legal_moves()
 
-        # Check if the move puts the player's own king in check:
-
-        valid = True
-
-        # Execute the move
-        self.board.board[current_row][current_column] = None
-        self.board.board[new_row][new_column] = current_piece
-
-        if self.current_player_colour:  # The current player is white
-            if isinstance(current_piece, King):
-                self.white_king_location = (new_row, new_column)
-
-            self.__is_king_in_check()
-
-            if self.white_check:  # Move puts own king in check => invalid
-                valid = False
-
-            if isinstance(current_piece, King):
-                self.white_king_location = (current_row, current_column)
-
-        else:  # The current player is black
-            if isinstance(current_piece, King):
-                self.black_king_location = (new_row, new_column)
-
-            self.__is_king_in_check()
-
-            if self.black_check:
-                valid = False
-
-            if isinstance(current_piece, King):
-                self.black_king_location = (current_row, current_column)
-
-        # Undo the move
-        self.board.board[current_row][current_column] = current_piece
-        self.board.board[new_row][new_column] = piece_at_new_square
-
-        return valid
-
-    def __is_move_legal(self, current_square, new_square):
+    def execute_move(self, current_square, new_square):
         """
-        Checks if the move abides by the moving rules for that piece.
+        Plays a move in the game, logs it in move_log, and adds any piece it
+        takes to the pieces taken. Moves played in the game are not undone,
+        so their undo records are not kept, and after a capture or pawn move
+        the history of the earlier positions is dropped, as they can't occur
+        again.
         """
-        if self.__en_passant_move:  # Stops infinite recursion after en passant
-            self.__en_passant_move = False
-            return True
-
-        current_row, current_column = current_square
-        new_row, new_column = new_square
-        piece = self.board.board[current_row][current_column]
-        if piece is None or piece.colour != self.current_player_colour:
-            return False
-
-        # Allows castling moves
-        if isinstance(piece, King):
-            if (
-                new_row == current_row
-                and new_column == current_column + 2
-                or new_column == current_column - 2
-            ):
-                return True
-
-        # Allows diagonal attacks from pawns
-        if isinstance(piece, Pawn):
-            piece_at_square = self.board.board[new_row][new_column]
-            if (
-                piece_at_square
-                and piece_at_square.colour != self.current_player_colour
-                or self.__validate_en_passant(current_square, new_square)
-            ):
-                return new_square in piece.get_attacked_squares()
-
-        return new_square in piece.generate_moves()
+        self.make_move([current_square, new_square])
+        self.move_log.append((tuple(current_square), tuple(new_square), None))
+        if self.halfmove_clock == 0:
+            self.start_history()
+        captured = self.undo_stack.pop()[2]
+        if captured is not None:
+            if captured.colour:
+                self.board.white_pieces_taken.append(captured)
+            else:
+                self.board.black_pieces_taken.append(captured)
 
-    def __is_move_blocked(self, current_square, new_square):
+    def make_move(self, move, piece_class=None):
         """
-        Checks if a move is blocked by another piece. This is done by checking
-        if there are any pieces in the squares between the current and new
-        squares.
+        Makes a move, including castling, en passant and promotion, without
+        checking that it is legal. A pawn reaching the last row is replaced by
+        a piece of piece_class if one is given, otherwise it stays a pawn until
+        promote_pawn is called. A record of the changes is pushed onto
+        undo_stack, so that unmake_move can undo the move, and returned.
         """
-        current_row, current_column = current_square
-        piece = self.board.board[current_row][current_column]
-
-        if isinstance(piece, Knight):
-            return False
-
-        squares_passed = self.__get_passed_squares(current_square, new_square)
-        return any(
-            [self.board.board[square[0]][square[1]] for square in squares_passed]
+        board = self.board.board
+        (current_row, current_column), (new_row, new_column) = move
+        piece = board[current_row][current_column]
+        captured = board[new_row][new_column]
+        captured_square = (new_row, new_column)
+        new_piece = None
+        rook = None
+        had_moved = getattr(piece, "has_moved", None)
+        previous_state = (
+            self.castling_rights,
+            self.en_passant_square,
+            self.zobrist_hash,
+            self.halfmove_clock,
+            self.fullmove_number,
+            self.white_checkmate,
+            self.black_checkmate,
+            self.stalemate,
         )
-
-    def __get_passed_squares(self, current_square, new_square):
-        """Returns the squares which a piece moves over when a move is made."""
-
-        current_row, current_column = current_square
-        new_row, new_column = new_square
-        squares = []
-
-        if new_column > current_column:
-            if new_row > current_row:  # bottom right diagonal
-                squares = list(
-                    zip(
-                        range(current_row + 1, new_row + 1),
-                        range(current_column + 1, new_column),
-                    )
-                )
-
-            elif new_row == current_row:  # right
-                squares = [
-                    (current_row, current_column + i)
-                    for i in range(1, new_column - current_column)
-                ]
-
-            else:
-                squares = list(  # top right diagonal
-                    zip(
-                        range(current_row - 1, new_row, -1),
-                        range(current_column + 1, new_column),
-                    )
-                )
-
-        elif new_column == current_column:
-            if new_row > current_row:  # below
-                squares = [
-                    (current_row + i, current_column)
-                    for i in range(1, new_row - current_row)
-                ]
-
-            else:  # above
-                squares = [
-                    (current_row - i, current_column)
-                    for i in range(1, current_row - new_row, 1)
-                ]
-
+        if piece.colour:
+            pieces, opponent_pieces = self.board.white_pieces, self.board.black_pieces
         else:
-            if new_row > current_row:  # bottom left diagonal
-                squares = list(
-                    zip(
-                        range(current_row + 1, new_row),
-                        range(current_column - 1, new_column, -1),
-                    )
-                )
+            pieces, opponent_pieces = self.board.black_pieces, self.board.white_pieces
 
-            elif new_row == current_row:  # left
-                squares = [
-                    (current_row, current_column - i)
-                    for i in range(1, current_column - new_column)
-                ]
-
-            else:  # top left diagonal
-                squares = list(
-                    zip(
-                        range(current_row - 1, new_row, -1),
-                        range(current_column - 1, new_column, -1),
-                    )
-                )
+        # Removes the castling, en passant and side to move keys from the hash
+        # so that they can be added back once the move has been made
+        self.zobrist_hash ^= self.get_state_hash()
 
-        return squares
-
-    def execute_move(self, current_square, new_square):
-        """
-        Executes a move by moving the piece object's location in the board list
-        """
-        # Prevents move from being executed twice after castling
-        if self.__just_castled:
-            self.__just_castled = False
-            return
-
-        current_row, current_column = current_square
-        new_row, new_column = new_square
+        # A pawn moving diagonally to an empty square takes en passant
+        if (
+            piece.piece_type == PAWN
+            and new_column != current_column
+            and captured is None
+        ):
+            captured_square = (current_row, new_column)
+            captured = board[current_row][new_column]
+            board[current_row][new_column] = None
 
-        # Updates items in board list
-        piece = self.board.board[current_row][current_column]
-        piece_at_new_square = self.board.board[new_row][new_column]
+        if captured is not None:
+            opponent_pieces.remove(captured)
+            self.zobrist_hash ^= piece_hash(captured, *captured_square)
 
-        self.board.board[current_row][current_column] = None
-        self.board.board[new_row][new_column] = piece
+        board[current_row][current_column] = None
+        board[new_row][new_column] = piece
         piece.row = new_row
         piece.column = new_column
-
-        # Updates pieces currently on the board and pieces taken
-        if piece_at_new_square:
-            if piece_at_new_square.colour:
-                self.board.white_pieces.remove(piece_at_new_square)
-                self.board.white_pieces_taken.append(piece_at_new_square)
-            else:
-                self.board.black_pieces.remove(piece_at_new_square)
-                self.board.black_pieces_taken.append(piece_at_new_square)
-
-        self.__update_en_passant()
-
-        # Checks if pawn should be promoted, or if it can be taken en passant
-        # promote_pawn only called when playing the game without a GUI.
-        if isinstance(piece, Pawn):
-            if self.current_player_colour:
-                if new_row == 0:
-                    # self.__promote_pawn(piece)
-                    pass
-                elif current_row == 6 and new_row == 4:
-                    piece.en_passant_possible = True
-            else:
-                if new_row == 7:
-                    # self.__promote_pawn(piece)
-                    pass
-                elif current_row == 1 and new_row == 3:
-                    piece.en_passant_possible = True
-
-        if isinstance(piece, (Pawn, Rook, King)):
+        self.zobrist_hash ^= piece_hash(piece, current_row, current_column)
+        self.zobrist_hash ^= piece_hash(piece, new_row, new_column)
+        if had_moved is not None:
             piece.has_moved = True
 
-        if isinstance(piece, King):
+        if piece.piece_type == KING:
             if piece.colour:
                 self.white_king_location = (new_row, new_column)
             else:
                 self.black_king_location = (new_row, new_column)
 
+            # Moves the rook when castling
+            if abs(new_column - current_column) == 2:
+                rook_column, new_rook_column = (7, 5) if new_column == 6 else (0, 3)
+                rook = board[new_row][rook_column]
+                board[new_row][rook_column] = None
+                board[new_row][new_rook_column] = rook
+                rook.column = new_rook_column
+                rook.has_moved = True
+                self.zobrist_hash ^= piece_hash(rook, new_row, rook_column)
+                self.zobrist_hash ^= piece_hash(rook, new_row, new_rook_column)
+
+        elif piece.piece_type == PAWN:
+            if new_row in (0, 7):
+                if piece_class is not None:
+                    new_piece = piece_class(new_row, new_column, piece.colour)
+                    pieces.remove(piece)
+                    pieces.append(new_piece)
+                    board[new_row][new_column] = new_piece
+                    self.zobrist_hash ^= piece_hash(piece, new_row, new_column)
+                    self.zobrist_hash ^= piece_hash(new_piece, new_row, new_column)
+
+        # A pawn can only be taken en passant straight after moving two squares
+        if piece.piece_type == PAWN and abs(new_row - current_row) == 2:
+            self.en_passant_square = ((current_row + new_row) // 2, new_column)
+        else:
+            self.en_passant_square = None
+        self.castling_rights &= CASTLING_RIGHTS_KEPT.get(
+            (current_row, current_column), ALL_CASTLING_RIGHTS
+        ) & CASTLING_RIGHTS_KEPT.get((new_row, new_column), ALL_CASTLING_RIGHTS)
+
+        # Updates the move counters used in FEN strings
+        if piece.piece_type == PAWN or captured is not None:
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if not self.current_player_colour:
+            self.fullmove_number += 1
+
         # Switches current player
         self.current_player_colour = not self.current_player_colour
-
-    def __is_king_in_check(self):
-
-        """
-        Looks at all rows, columns and diagonals leading out from the king and
-        checks if there are any opponent pieces attacking the king.
-        """
-        self.white_check = False
-        self.black_check = False
-        current_colour = self.current_player_colour
-        if current_colour:
-            current_row, current_column = self.white_king_location
+        self.zobrist_hash ^= self.get_state_hash()
+        self.hash_history.append(self.zobrist_hash)
+        self.__count_position(self.zobrist_hash, 1)
+
+        record = (
+            move,
+            piece,
+            captured,
+            captured_square,
+            new_piece,
+            rook,
+            had_moved,
+        ) + previous_state
+        self.undo_stack.append(record)
+        return record
+
+    def unmake_move(self):
+        """Undoes the last move made with make_move."""
+        self.__count_position(self.hash_history.pop(), -1)
+        (
+            move,
+            piece,
+            captured,
+            captured_square,
+            new_piece,
+            rook,
+            had_moved,
+            self.castling_rights,
+            self.en_passant_square,
+            self.zobrist_hash,
+            self.halfmove_clock,
+            self.fullmove_number,
+            self.white_checkmate,
+            self.black_checkmate,
+            self.stalemate,
+        ) = self.undo_stack.pop()
+        board = self.board.board
+        (current_row, current_column), (new_row, new_column) = move
+        self.current_player_colour = not self.current_player_colour
+        if piece.colour:
+            pieces, opponent_pieces = self.board.white_pieces, self.board.black_pieces
         else:
-            current_row, current_column = self.black_king_location
-
-        directions = [
-            # Rook/Queen directions (straight lines):
-            (-1, 0),
-            (1, 0),
-            (0, -1),
-            (0, 1),
-            # Bishop/Queen/Pawn directions (diagonal lines):
-            (-1, -1),
-            (-1, 1),
-            (1, -1),
-            (1, 1),
-        ]
-
-        for i, direction in enumerate(directions):
-            for step in range(1, 8):
-                new_row = current_row + direction[0] * step
-                new_column = current_column + direction[1] * step
-                if 0 <= new_row < 8 and 0 <= new_column < 8:
-                    piece = self.board.board[new_row][new_column]
-                    if piece is None:
-                        continue
-                    # If there is a piece of the same colour in that direction,
-                    # then it will block any attacks from pieces behind it
-                    if piece.colour == self.current_player_colour:
-                        break
-                    # The king is in check if any of these types of pieces are
-                    # found in the directions in which they attack.
-                    if (0 <= i <= 3 and isinstance(piece, (Rook, Queen))) or (
-                        4 <= i <= 7
-                        and isinstance(piece, (Bishop, Queen))
-                        or (
-                            isinstance(piece, Pawn)
-                            and (current_row, current_column)
-                            in piece.get_attacked_squares()
-                        )
-                        or isinstance(piece, King)
-                        and (current_row, current_column) in piece.generate_moves()
-                    ):
-                        if self.current_player_colour:
-                            self.white_check = True
-                        else:
-                            self.black_check = True
-                break
+            pieces, opponent_pieces = self.board.black_pieces, self.board.white_pieces
 
-        # Look for knight checks:
-        knight_positions = [
-            (2, 1),
-            (2, -1),
-            (-2, 1),
-            (-2, -1),
-            (1, 2),
-            (1, -2),
-            (-1, 2),
-            (-1, -2),
-        ]
-
-        for vertical_shift, horizontal_shift in knight_positions:
-            new_row = current_row + vertical_shift
-            new_column = current_column + horizontal_shift
-            if 0 <= new_row < 8 and 0 <= new_column < 8:
-                piece = self.board.board[new_row][new_column]
-                if piece is None or piece.colour == self.current_player_colour:
-                    continue
-                if isinstance(piece, Knight):
-                    if self.current_player_colour:
-                        self.white_check = True
-                    else:
-                        self.black_check = True
+        if new_piece is not None:
+            pieces.remove(new_piece)
+            pieces.append(piece)
 
-    def is_checkmate_or_stalemate(self):
-        """
-        Determines whether the current player is in checkmate or stalemate.
-        This is done by checking if there are any possible moves for any of the
-        pieces on the board.
-        """
+        board[new_row][new_column] = None
+        board[current_row][current_column] = piece
+        piece.row = current_row
+        piece.column = current_column
+        if had_moved is not None:
+            piece.has_moved = had_moved
 
-        if self.current_player_colour:  # Current player is white
-            pieces = self.board.white_pieces
-        else:
-            pieces = self.board.black_pieces
+        if captured is not None:
+            board[captured_square[0]][captured_square[1]] = captured
+            opponent_pieces.append(captured)
 
-        # Check if there are any valid moves
-        for piece in pieces:
-            current_square = (piece.row, piece.column)
-            moves = piece.generate_moves()
-            if isinstance(piece, Pawn):
-                moves += piece.get_attacked_squares()
-            for new_square in moves:
-                if self.validate_move(current_square, new_square):
-                    return
-
-        if self.current_player_colour:  # Current player is white
-            self.__is_king_in_check()
-
-            if self.white_check:
-                self.black_checkmate = True
+        if piece.piece_type == KING:
+            if piece.colour:
+                self.white_king_location = (current_row, current_column)
             else:
-                self.stalemate = True
-
-        else:  # Current player is black
-            self.__is_king_in_check()
+                self.black_king_location = (current_row, current_column)
 
-            if self.black_check:
-                self.white_checkmate = True
-            else:
-                self.stalemate = True
+            if rook is not None:
+                rook_column = 7 if new_column == 6 else 0
+                board[new_row][rook.column] = None
+                board[new_row][rook_column] = rook
+                rook.column = rook_column
+                rook.has_moved = False
 
-    def __validate_castling_move(self, current_square, new_square):
+    def compute_hash(self):
         """
-        Determines whether a castling move is valid. The move is invalid if
-        there are any pieces between the king and rook, if either the king or
-        rook have moved previously, the king is in check or it moves over check
+        Computes the Zobrist hash of the position from scratch. The hash is
+        the XOR of a random key for each piece on its square, together with
+        the keys for the castling rights, en passant square and the side to
+        move. make_move keeps zobrist_hash up to date incrementally.
         """
-        current_row, current_column = current_square
-        _, new_column = new_square
-
-        king_piece = self.board.board[current_row][current_column]
-        passed_squares_columns = []
+        zobrist_hash = self.get_state_hash()
+        for piece in self.board.white_pieces + self.board.black_pieces:
+            zobrist_hash ^= piece_hash(piece, piece.row, piece.column)
+        return zobrist_hash
 
-        if new_column > current_column:  # King-side castle
-            end_column = 7
-            rook_piece = self.board.board[current_row][end_column]
-            passed_squares_columns = list(range(current_column, new_column + 1))
-            new_rook_column = new_column - 1
+    def get_state_hash(self):
+        """
+        Returns the part of the Zobrist hash which does not depend on piece
+        placement: the side to move, castling rights and en passant square.
+        """
+        state_hash = 0 if self.current_player_colour else ZOBRIST_BLACK_TO_MOVE
+        for index, key in enumerate(ZOBRIST_CASTLING_KEYS):
+            if self.castling_rights & (1 << index):
+                state_hash ^= key
+        if self.en_passant_square is not None:
+            state_hash ^= ZOBRIST_EN_PASSANT_KEYS[self.en_passant_square[1]]
+        return state_hash
+
+    def get_castling_rights(self):
+        """
+        Returns the castling rights in the order white king-side, white
+        queen-side, black king-side, black queen-side.
+        """
+        return tuple(bool(self.castling_rights & (1 << index)) for index in range(4))
 
-        else:  # Queen-side castle
-            end_column = 0
-            rook_piece = self.board.board[current_row][end_column]
-            passed_squares_columns = list(range(current_column, new_column - 1, -1))
-            new_rook_column = new_column + 1
+    def get_en_passant_square(self):
+        """
+        Returns the square that the current player could move a pawn to in
+        order to take an opponent's pawn en passant, or None.
+        """
+        return self.en_passant_square
 
-        # Move is invalid if it is blocked, either the king or rook have moved
-        # or if king is in check
-        if (
-            self.__is_move_blocked(current_square, (current_row, end_column))
-            or king_piece.has_moved
-            or rook_piece is None
-            or rook_piece.has_moved
-            or (self.current_player_colour and self.white_check)
-            or (not self.current_player_colour and self.black_check)
+    def __find_castling_rights(self):
+        """
+        Works out the castling rights from the pieces, as bit flags. A side
+        can still castle if the king and that rook are on their starting
+        squares and have not moved.
+        """
+        rights = 0
+        for index, (pieces, row) in enumerate(
+            ((self.board.white_pieces, 7), (self.board.black_pieces, 0))
         ):
-            return False
+            unmoved = {
+                (piece.piece_type, piece.column)
+                for piece in pieces
+                if piece.piece_type in (KING, ROOK)
+                and piece.row == row
+                and not piece.has_moved
+            }
+            if (KING, 4) in unmoved:
+                if (ROOK, 7) in unmoved:
+                    rights |= 1 << (2 * index)
+                if (ROOK, 0) in unmoved:
+                    rights |= 1 << (2 * index + 1)
+        return rights
+
+    def in_check(self):
+        """Checks if the current player's king is attacked."""
+        if self.current_player_colour:
+            return self.is_square_attacked(self.white_king_location, False)
+        return self.is_square_attacked(self.black_king_location, True)
 
-        # Check if king passes over attacked squares
-        valid = True
-        for column in passed_squares_columns:
-            self.board.board[current_row][column] = king_piece
+    def is_checkmate_or_stalemate(self):
+        """
+        Determines whether the current player is in checkmate or stalemate.
+        This is done by checking if there are any possible moves for any of the
+        pieces on the board.
+        """
 
-            if self.current_player_colour:  # The current player is white
-                self.white_king_location = (current_row, column)
+        # Check if there are any valid moves
+        if self.get_legal_moves():
+            return
 
-                self.__is_king_in_check()
+        if not self.in_check():
+            self.stalemate = True
+        elif self.current_player_colour:  # White is checkmated
+            self.black_checkmate = True
+        else:  # Black is checkmated
+            self.white_checkmate = True
 
-                if self.white_check:
-                    valid = False
+    def promote_pawn(self, square, piece_class):
+        """Replaces the pawn on the square with a new piece of the given type."""
+        row, column = square
+        pawn = self.board.board[row][column]
+        new_piece = piece_class(row, column, pawn.colour)
 
-                self.white_king_location = (current_row, current_column)
+        if pawn.colour:
+            self.board.white_pieces.remove(pawn)
+            self.board.white_pieces.append(new_piece)
+        else:
+            self.board.black_pieces.remove(pawn)
+            self.board.black_pieces.append(new_piece)
 
-            else:
-                self.black_king_location = (current_row, column)
+        self.board.board[row][column] = new_piece
+        self.__count_position(self.zobrist_hash, -1)
+        self.zobrist_hash ^= piece_hash(pawn, row, column)
+        self.zobrist_hash ^= piece_hash(new_piece, row, column)
+        self.hash_history[-1] = self.zobrist_hash
+        self.__count_position(self.zobrist_hash, 1)
+        self.move_log.append((tuple(square), tuple(square), piece_class))
+
+    def start_history(self, hash_history=None):
+        """
+        Starts the position history from the current position, or from the
+        hashes of earlier positions if they are given, ending with the current
+        one. The hashes of the positions reached are kept in hash_history, one
+        for each move made, and the number of times each has occurred in
+        position_counts, so that repetitions can be found without looking back
+        through the game.
+        """
+        if hash_history is None:
+            hash_history = [self.zobrist_hash]
+        self.hash_history = list(hash_history)
+        self.position_counts = {}
+        for zobrist_hash in self.hash_history:
+            self.__count_position(zobrist_hash, 1)
+
+    def __count_position(self, zobrist_hash, change):
+        """Changes the number of times a position has occurred."""
+        count = self.position_counts.get(zobrist_hash, 0) + change
+        if count:
+            self.position_counts[zobrist_hash] = count
+        else:
+            del self.position_counts[zobrist_hash]
 
-                self.__is_king_in_check()
+    def get_recent_history(self):
+        """
+        Returns the hashes of the positions since the last capture or pawn
+        move, ending with the current one. Only these positions can occur
+        again, so they are all a search of the position needs to find
+        repetitions.
+        """
+        return self.hash_history[-self.halfmove_clock - 1 :]
 
-                if self.black_check:
-                    valid = False
+    def get_repetitions(self):
+        """Returns the number of times the current position has occurred."""
+        return self.position_counts.get(self.zobrist_hash, 0)
 
-                self.black_king_location = (current_row, current_column)
+    def is_repetition(self):
+        """
+        Checks if the current position has occurred before. The search scores
+        such a position as a draw, as the side to move could repeat it again.
+        """
+        return self.position_counts.get(self.zobrist_hash, 0) > 1
 
-            self.board.board[current_row][current_column] = king_piece
-            self.board.board[current_row][column] = None
-
-        if valid:  # execute castle moves
-            self.execute_move(current_square, new_square)
-            self.current_player_colour = not self.current_player_colour
-            self.execute_move(
-                (current_row, rook_piece.column), (current_row, new_rook_column)
-            )
-            self.__just_castled = True
-            return True
-        return False
+    def get_draw_reason(self):
+        """
+        Returns why the game is a draw, other than by stalemate: "insufficient
+        material", "threefold repetition" or "fifty-move rule". Returns None
+        if it is not a draw.
+        """
+        if self.__has_insufficient_material():
+            return "insufficient material"
+        if self.get_repetitions() >= 3:
+            return "threefold repetition"
+        if self.halfmove_clock >= FIFTY_MOVE_PLIES:
+            return "fifty-move rule"
+        return None
 
-    def __promote_pawn(self, pawn):
+    def check_draw(self):
         """
-        Promotes the pawn to a new piece when it reaches the last row.
-        This method is only used when playing the game without a GUI.
+        Sets the stalemate flag if the game is a draw by insufficient
+        material, threefold repetition or the fifty-move rule. A checkmate on
+        the move which reaches the fifty-move limit still stands.
         """
-        row = pawn.row
-        column = pawn.column
-        colour = pawn.colour
+        if self.white_checkmate or self.black_checkmate:
+            return
+        if self.get_draw_reason() is not None:
+            self.stalemate = True
 
-        new_piece = None
-        while new_piece is None:
-            piece_name = input("New piece (Queen/Rook/Bishop/Knight): ").lower()
-            if piece_name == "queen":
-                new_piece = Queen(row, column, colour)
-            elif piece_name == "rook":
-                new_piece = Rook(row, column, colour)
-            elif piece_name == "bishop":
-                new_piece = Bishop(row, column, colour)
-            elif piece_name == "knight":
-                new_piece = Knight(row, column, colour)
+    def __has_insufficient_material(self):
+        """
+        Checks if both teams have insufficient material to result in a
+        checkmate. This is true for King vs King, King + Knight vs King, and
+        King + Bishop vs King.
+        """
 
-        if colour:
-            self.board.white_pieces.remove(pawn)
-            self.board.white_pieces.append(new_piece)
-        else:
-            self.board.black_pieces.remove(pawn)
-            self.board.black_pieces.append(new_piece)
+        opponent_pieces = []
+        if len(self.board.white_pieces) == 1:  # white only has the king
+            opponent_pieces = [piece.piece_type for piece in self.board.black_pieces]
 
-        self.board.board[row][column] = new_piece
+        if len(self.board.black_pieces) == 1:  # black only has the king
+            opponent_pieces = [piece.piece_type for piece in self.board.white_pieces]
 
-    def __update_en_passant(self):
+        return not (
+            len(opponent_pieces) == 0
+            or len(opponent_pieces) > 2
+            or PAWN in opponent_pieces
+            or ROOK in opponent_pieces
+            or QUEEN in opponent_pieces
+        )
+
+    def get_valid_moves(self):
+        """Returns the list of valid moves for the current player."""
+        return self.get_legal_moves()
+
+    def get_legal_moves(self):
         """
-        Sets the 'en passant possible' attribute for all pawns to false
-        after a move is made.
+        Returns the legal moves for the current player, including castling and
+        en passant. The pieces giving check and the pinned pieces are found
+        once for the position. Each candidate move is then checked against
+        them, rather than by making the move and looking for check.
         """
-        if self.current_player_colour:
+        colour = self.current_player_colour
+        board = self.board.board
+        if colour:
             pieces = self.board.white_pieces
+            king_row, king_column = self.white_king_location
         else:
             pieces = self.board.black_pieces
+            king_row, king_column = self.black_king_location
+        king_square = (king_row, king_column)
 
-        for piece in pieces:
-            if isinstance(piece, Pawn):
-                piece.en_passant_possible = False
+        checks, pins = self.__get_checks_and_pins(king_square)
+        moves = []
 
-    def __validate_en_passant(self, current_square, new_square):
-        """Checks if en passant move is valid"""
-        current_row, current_column = current_square
-        new_row, new_column = new_square
+        # The king can move to any square which is not attacked. It is taken
+        # off the board first so that it can't hide behind itself from an
+        # attack along a line.
+        king = board[king_row][king_column]
+        board[king_row][king_column] = None
+        for new_square in KING_ATTACKS[king_row * 8 + king_column]:
+            piece = board[new_square[0]][new_square[1]]
+            if (piece is None or piece.colour != colour) and not (
+                self.is_square_attacked(new_square, not colour)
+            ):
+                moves.append([king_square, new_square])
+        board[king_row][king_column] = king
 
-        if (
-            (self.current_player_colour and new_row != 2)
-            or (not self.current_player_colour and new_row != 5)
-            or new_column not in (current_column - 1, current_column + 1)
-        ):
-            return False
-
-        # Get pawn that would be captured
-        en_passant_piece = self.board.board[current_row][new_column]
-
-        if isinstance(en_passant_piece, Pawn):
-            if en_passant_piece.en_passant_possible:
-                self.__en_passant_move = True
-                if self.validate_move(current_square, new_square):
-                    # If AI is playing, you do not want the move to executed
-                    # while searching for valid moves
-                    if self.current_player_colour == self.ai_colour:
-                        return True
-                    self.__execute_en_passant_move(
-                        current_square, new_square, en_passant_piece
-                    )
-                    return True
+        if len(checks) > 1:  # Only the king can move out of a double check
+            return moves
 
-        return False
+        # When in check, other pieces must take the checking piece or block it
+        check_squares = checks[0] if checks else None
+        if not checks:
+            moves += self.__get_castling_moves(king_square)
 
-    def __execute_en_passant_move(self, current_square, new_square, piece):
-        """Executes an en passant move."""
-        current_row, _ = current_square
-        _, new_column = new_square
-
-        # Remove captured piece from board
-        self.board.board[current_row][new_column] = None
-        if self.current_player_colour: # Player is white
-            self.board.black_pieces.remove(piece)
-            self.board.black_pieces_taken.append(piece)
-        else: # Player is black
-            self.board.white_pieces.remove(piece)
-            self.board.white_pieces_taken.append(piece)
-        self.execute_move(current_square, new_square)
+        for piece in pieces:
+            if piece.piece_type == KING:
+                continue
+            current_square = (piece.row, piece.column)
+            pin_squares = pins.get(current_square)
+            for new_square in piece.generate_board_moves(board):
+                if (check_squares is None or new_square in check_squares) and (
+                    pin_squares is None or new_square in pin_squares
+                ):
+                    moves.append([current_square, new_square])
+
+        moves += self.__get_en_passant_moves(king_square)
+        return moves
 
-    def check_draw(self):
+    def __get_checks_and_pins(self, king_square):
         """
-        Checks if the game should be a draw due to both teams having 
-        insufficient material to result in a checkmate. This is true for
-        King vs King, King + Knight vs King, and King + Bishop vs King.
+        Looks along each ray and knight move from the king, and at the squares
+        a pawn could give check from. Returns a list of
+        the squares that would stop each check (the checking piece and the
+        squares between it and the king), and a dictionary mapping each pinned
+        piece's square to the squares it can move to without leaving the line
+        of the pin.
         """
+        board = self.board.board
+        colour = self.current_player_colour
+        king_row, king_column = king_square
+        checks = []
+        pins = {}
+
+        king_index = king_row * 8 + king_column
+        for i, ray in enumerate(RAYS[king_index]):
+            line = []
+            pinned_square = None
+            for row, column in ray:
+                line.append((row, column))
+                piece = board[row][column]
+                if piece is None:
+                    continue
+                if piece.colour == colour:
+                    if pinned_square is not None:
+                        break  # Two pieces in the way, so nothing is pinned
+                    pinned_square = (row, column)
+                    continue
 
-        opponent_pieces = []
-        if len(self.board.white_pieces) == 1:  # white only has the king
-            opponent_pieces = [type(piece) for piece in self.board.black_pieces]
+                if piece.piece_type in (
+                    STRAIGHT_SLIDERS if i < 4 else DIAGONAL_SLIDERS
+                ):
+                    if pinned_square is not None:
+                        pins[pinned_square] = set(line)
+                    else:
+                        checks.append(set(line))
+                break
 
-        if len(self.board.black_pieces) == 1:  # black only has the king
-            opponent_pieces = [type(piece) for piece in self.board.white_pieces]
+        for row, column in KNIGHT_ATTACKS[king_index]:
+            piece = board[row][column]
+            if (
+                piece is not None
+                and piece.piece_type == KNIGHT
+                and piece.colour != colour
+            ):
+                checks.append({(row, column)})
 
-        if (
-            len(opponent_pieces) == 0
-            or len(opponent_pieces) > 2
-            or Pawn in opponent_pieces
-            or Rook in opponent_pieces
-            or Queen in opponent_pieces
-        ):
-            return
+        for row, column in PAWN_ATTACKS[colour][king_index]:
+            piece = board[row][column]
+            if (
+                piece is not None
+                and piece.piece_type == PAWN
+                and piece.colour != colour
+            ):
+                checks.append({(row, column)})
 
-        self.stalemate = True
-        return
+        return checks, pins
 
-    def get_all_moves(self):
+    def __get_castling_moves(self, king_square):
         """
-        Returns list of all moves (not validated). This is done by iterating
-        through each piece on the board and generating moves for each piece.
+        Returns the castling moves for a player who is not in check. The
+        squares between the king and rook must be empty, and the squares the
+        king moves over must not be attacked.
         """
+        board = self.board.board
+        colour = self.current_player_colour
+        row, _ = king_square
+        if colour:
+            king_side = self.castling_rights & WHITE_KING_SIDE
+            queen_side = self.castling_rights & WHITE_QUEEN_SIDE
+        else:
+            king_side = self.castling_rights & BLACK_KING_SIDE
+            queen_side = self.castling_rights & BLACK_QUEEN_SIDE
 
         moves = []
-        for piece in self.board.white_pieces + self.board.black_pieces:
-            moves += [
-                [(piece.row, piece.column), new_square]
-                for new_square in piece.generate_moves()
-            ]
-            if isinstance(piece, Pawn):
-                moves += [
-                    [(piece.row, piece.column), new_square]
-                    for new_square in piece.get_attacked_squares()
-                ]
+        for allowed, empty_columns, passed_columns, new_column in (
+            (king_side, (5, 6), (5, 6), 6),
+            (queen_side, (1, 2, 3), (3, 2), 2),
+        ):
+            if (
+                allowed
+                and all(board[row][i] is None for i in empty_columns)
+                and not any(
+                    self.is_square_attacked((row, i), not colour)
+                    for i in passed_columns
+                )
+            ):
+                moves.append([king_square, (row, new_column)])
         return moves
 
-    def get_valid_moves(self):
-        """Filters the list of all moves by the ones which are valid"""
-        valid_moves = []
-        for current_square, new_square in self.get_all_moves():
-            if self.validate_move(current_square, new_square):
-                valid_moves.append([current_square, new_square])
-        return valid_moves
+    def __get_en_passant_moves(self, king_square):
+        """
+        Returns the legal en passant moves. These are checked by making the
+        capture on the board, because taking en passant removes two pieces
+        from the same row, which can expose the king along that row.
+        """
+        en_passant_square = self.en_passant_square
+        if en_passant_square is None:
+            return []
+
+        board = self.board.board
+        colour = self.current_player_colour
+        new_row, new_column = en_passant_square
+        current_row = new_row + (1 if colour else -1)
+        captured = board[current_row][new_column]
+
+        moves = []
+        for current_column in (new_column - 1, new_column + 1):
+            if not 0 <= current_column < 8:
+                continue
+            pawn = board[current_row][current_column]
+            if pawn is None or pawn.piece_type != PAWN or pawn.colour != colour:
+                continue
+
+            board[current_row][current_column] = None
+            board[current_row][new_column] = None
+            board[new_row][new_column] = pawn
+            attacked = self.is_square_attacked(king_square, not colour)
+            board[new_row][new_column] = None
+            board[current_row][new_column] = captured
+            board[current_row][current_column] = pawn
+
+            if not attacked:
+                moves.append([(current_row, current_column), en_passant_square])
+        return moves
+
+    def is_square_attacked(self, square, by_colour):
+        """
+        Checks if any piece of the given colour attacks the square, using the
+        precomputed attack tables. This is used for check detection, castling
+        and the king's moves.
+        """
+        board = self.board.board
+        index = square[0] * 8 + square[1]
+
+        for row, column in KNIGHT_ATTACKS[index]:
+            piece = board[row][column]
+            if (
+                piece is not None
+                and piece.piece_type == KNIGHT
+                and piece.colour == by_colour
+            ):
+                return True
+
+        for row, column in PAWN_ATTACKS[not by_colour][index]:
+            piece = board[row][column]
+            if (
+                piece is not None
+                and piece.piece_type == PAWN
+                and piece.colour == by_colour
+            ):
+                return True
+
+        for row, column in KING_ATTACKS[index]:
+            piece = board[row][column]
+            if (
+                piece is not None
+                and piece.piece_type == KING
+                and piece.colour == by_colour
+            ):
+                return True
+
+        for i, ray in enumerate(RAYS[index]):
+            sliders = STRAIGHT_SLIDERS if i < 4 else DIAGONAL_SLIDERS
+            for row, column in ray:
+                piece = board[row][column]
+                if piece is not None:
+                    if piece.colour == by_colour and piece.piece_type in sliders:
+                        return True
+                    break
+        return False
 
 
 class Pawn(Piece):
     """Piece with value 1."""
 
+    __slots__ = ("has_moved", "__direction")
+    piece_type = PAWN
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 1, colour)
         self.has_moved = False
-        self.en_passant_possible = False
         self.__direction = 1 if self.colour else -1
 
     def generate_moves(self):
@@ -748,21 +1026,36 @@ class Pawn(Piece):
 
         return moves
 
-    def get_attacked_squares(self):
+    def generate_board_moves(self, board):
         """
-        Pawns can move 1 square forward diagonally when they take an opponent's
-        piece.
+        Pawns can only move forward onto empty squares, and only move
+        diagonally when taking a piece. En passant is handled by the Game.
         """
         moves = []
         new_row = self.row - self.__direction
-        if 0 <= new_row < 8:
-            if self.column > 0:
-                moves.append((new_row, self.column - 1))
-            if self.column < 7:
-                moves.append((new_row, self.column + 1))
+        if 0 <= new_row < 8 and board[new_row][self.column] is None:
+            moves.append((new_row, self.column))
+            start_row = 6 if self.colour else 1
+            if (
+                self.row == start_row
+                and board[new_row - self.__direction][self.column] is None
+            ):
+                moves.append((new_row - self.__direction, self.column))
+
+        for row, column in self.get_attacked_squares():
+            piece = board[row][column]
+            if piece is not None and piece.colour != self.colour:
+                moves.append((row, column))
 
         return moves
 
+    def get_attacked_squares(self):
+        """
+        Pawns can move 1 square forward diagonally when they take an opponent's
+        piece.
+        """
+        return list(PAWN_ATTACKS[self.colour][self.row * 8 + self.column])
+
     def __str__(self):
         if self.colour:
             return "P"
@@ -772,6 +1065,9 @@ class Pawn(Piece):
 class Bishop(Piece):
     """Piece with value 3"""
 
+    __slots__ = ()
+    piece_type = BISHOP
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 3, colour)
 
@@ -795,6 +1091,10 @@ class Bishop(Piece):
 
         return moves
 
+    def generate_board_moves(self, board):
+        """Stops at the first piece on each line."""
+        return self.generate_sliding_moves(board, SLIDER_DIRECTIONS[BISHOP])
+
     def __str__(self):
         if self.colour:
             return "B"
@@ -804,30 +1104,15 @@ class Bishop(Piece):
 class Knight(Piece):
     """Piece with value 3"""
 
+    __slots__ = ()
+    piece_type = KNIGHT
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 3, colour)
 
     def generate_moves(self):
         """Knights move in an L shape."""
-        relative_moves = [
-            (2, 1),
-            (2, -1),
-            (-2, 1),
-            (-2, -1),
-            (1, 2),
-            (1, -2),
-            (-1, 2),
-            (-1, -2),
-        ]
-        moves = []
-
-        for vertical_shift, horizontal_shift in relative_moves:
-            new_row = self.row + vertical_shift
-            new_column = self.column + horizontal_shift
-            if 0 <= new_row < 8 and 0 <= new_column < 8:
-                moves.append((new_row, new_column))
-
-        return moves
+        return list(KNIGHT_ATTACKS[self.row * 8 + self.column])
 
     def __str__(self):
         if self.colour:
@@ -838,6 +1123,9 @@ class Knight(Piece):
 class Rook(Piece):
     """Piece with value 5"""
 
+    __slots__ = ("has_moved",)
+    piece_type = ROOK
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 5, colour)
         self.has_moved = False
@@ -858,6 +1146,10 @@ class Rook(Piece):
 
         return moves
 
+    def generate_board_moves(self, board):
+        """Stops at the first piece on each line."""
+        return self.generate_sliding_moves(board, SLIDER_DIRECTIONS[ROOK])
+
     def __str__(self):
         if self.colour:
             return "R"
@@ -867,6 +1159,9 @@ class Rook(Piece):
 class Queen(Piece):
     """Piece with value 9"""
 
+    __slots__ = ()
+    piece_type = QUEEN
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 9, colour)
 
@@ -898,6 +1193,10 @@ class Queen(Piece):
 
         return moves
 
+    def generate_board_moves(self, board):
+        """Stops at the first piece on each line."""
+        return self.generate_sliding_moves(board, SLIDER_DIRECTIONS[QUEEN])
+
     def __str__(self):
         if self.colour:
             return "Q"
@@ -910,31 +1209,16 @@ class King(Piece):
     legal moves, the game is over.
     """
 
+    __slots__ = ("has_moved",)
+    piece_type = KING
+
     def __init__(self, row, column, colour):
         super().__init__(row, column, 0, colour)
         self.has_moved = False
 
     def generate_moves(self):
         """Kings can move one square in any direction."""
-        relative_moves = [
-            (1, 1),
-            (1, 0),
-            (1, -1),
-            (0, 1),
-            (0, -1),
-            (-1, 1),
-            (-1, 0),
-            (-1, -1),
-        ]
-        moves = []
-
-        for vertical_shift, horizontal_shift in relative_moves:
-            new_row = self.row + vertical_shift
-            new_column = self.column + horizontal_shift
-            if 0 <= new_row < 8 and 0 <= new_column < 8:
-                moves.append((new_row, new_column))
-
-        return moves
+        return list(KING_ATTACKS[self.row * 8 + self.column])
 
     def __str__(self):
         if self.colour:
@@ -942,7 +1226,207 @@ class King(Piece):
         return "K'"
 
 
+def square_name(square):
+    """Returns the name of a square in algebraic notation, e.g. (6, 4) -> e2."""
+    row, column = square
+    return "abcdefgh"[column] + str(8 - row)
+
+
+def parse_square(name):
+    """Returns the (row, column) of a square in algebraic notation."""
+    return 8 - int(name[1]), "abcdefgh".index(name[0])
+
+
+def move_name(move, piece_class=None):
+    """
+    Returns a move in coordinate notation, e.g. e2e4, with the letter of the
+    promoted piece added for promotions, e.g. e7e8q.
+    """
+    current_square, new_square = move
+    name = square_name(current_square) + square_name(new_square)
+    if piece_class is not None:
+        name += FEN_LETTERS[piece_class]
+    return name
+
+
+def parse_move(name):
+    """
+    Returns the move and the class of the promoted piece (or None) for a move
+    in coordinate notation, e.g. e7e8q -> ([(1, 4), (0, 4)], Queen).
+    """
+    move = [parse_square(name[0:2]), parse_square(name[2:4])]
+    piece_class = FEN_PIECES[name[4].lower()] if len(name) > 4 else None
+    return move, piece_class
+
+
+def perft(game, depth):
+    """
+    Counts the positions reached by playing every sequence of legal moves of
+    the given length. The counts for well known positions are used to check
+    the move generator. Promotions are counted once for each piece.
+    """
+    if depth == 0:
+        return 1
+
+    nodes = 0
+    for move in game.get_legal_moves():
+        for piece_class in get_promotion_classes(game, move):
+            if depth == 1:
+                nodes += 1
+                continue
+            game.make_move(move, piece_class)
+            nodes += perft(game, depth - 1)
+            game.unmake_move()
+    return nodes
+
+
+def perft_divide(game, depth):
+    """Returns the perft count below each legal move, keyed by move name."""
+    counts = {}
+    for move in game.get_legal_moves():
+        for piece_class in get_promotion_classes(game, move):
+            game.make_move(move, piece_class)
+            counts[move_name(move, piece_class)] = perft(game, depth - 1)
+            game.unmake_move()
+    return counts
+
+
+def get_promotion_classes(game, move):
+    """
+    Returns the pieces a pawn can be promoted to if the move is a promotion,
+    or [None] for any other move.
+    """
+    (current_row, current_column), (new_row, _) = move
+    piece = game.board.board[current_row][current_column]
+    if piece.piece_type == PAWN and new_row in (0, 7):
+        return [Queen, Rook, Bishop, Knight]
+    return [None]
+
+
+def run_perft(fen, depth, divide=True):
+    """Prints the perft count for a position and the nodes per second."""
+    game = Game.from_fen(fen)
+    start = time.perf_counter()
+    if divide:
+        counts = perft_divide(game, depth)
+        for name in sorted(counts):
+            print(f"{name}: {counts[name]}")
+        nodes = sum(counts.values())
+    else:
+        nodes = perft(game, depth)
+    elapsed = time.perf_counter() - start
+    print(
+        f"depth {depth}: {nodes} nodes in {elapsed:.2f}s "
+        f"({nodes / elapsed:.0f} nodes/s)"
+    )
+    return nodes
+
+
+def run_perft_suite(max_depth):
+    """
+    Runs perft on the standard test positions up to the given depth and
+    checks the counts. Returns True if they are all correct.
+    """
+    passed = True
+    total_nodes = 0
+    start = time.perf_counter()
+    for name, fen, counts in PERFT_POSITIONS:
+        game = Game.from_fen(fen)
+        for depth, expected in enumerate(counts[:max_depth], 1):
+            position_start = time.perf_counter()
+            nodes = perft(game, depth)
+            elapsed = time.perf_counter() - position_start
+            total_nodes += nodes
+            result = "ok" if nodes == expected else f"FAILED, expected {expected}"
+            passed = passed and nodes == expected
+            print(f"{name} depth {depth}: {nodes} nodes in {elapsed:.2f}s, {result}")
+    elapsed = time.perf_counter() - start
+    print(
+        f"total: {total_nodes} nodes in {elapsed:.2f}s "
+        f"({total_nodes / elapsed:.0f} nodes/s)"
+    )
+    return passed
+
+
+def piece_hash(piece, row, column):
+    """Returns the Zobrist key for a piece standing on the given square."""
+    return ZOBRIST_PIECE_KEYS[piece.piece_type, piece.colour][row * 8 + column]
+
+
+# Random keys used for Zobrist hashing. A fixed seed means that hashes are the
+# same in every process, so they can be shared or stored.
+_ZOBRIST_RANDOM = random.Random(20200524)
+ZOBRIST_PIECE_KEYS = {
+    (piece_type, colour): [_ZOBRIST_RANDOM.getrandbits(64) for _ in range(64)]
+    for piece_type in range(6)
+    for colour in (True, False)
+}
+ZOBRIST_BLACK_TO_MOVE = _ZOBRIST_RANDOM.getrandbits(64)
+ZOBRIST_CASTLING_KEYS = [_ZOBRIST_RANDOM.getrandbits(64) for _ in range(4)]
+ZOBRIST_EN_PASSANT_KEYS = [_ZOBRIST_RANDOM.getrandbits(64) for _ in range(8)]
+
+FEN_PIECES = {"p": Pawn, "n": Knight, "b": Bishop, "r": Rook, "q": Queen, "k": King}
+FEN_LETTERS = {piece_class: letter for letter, piece_class in FEN_PIECES.items()}
+
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Positions with known perft counts for depths 1, 2, 3, ..., from
+# https://www.chessprogramming.org/Perft_Results
+PERFT_POSITIONS = [
+    ("start", START_FEN, [20, 400, 8902, 197281, 4865609]),
+    (
+        "kiwipete",
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        [48, 2039, 97862, 4085603],
+    ),
+    (
+        "en passant",
+        "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+        [14, 191, 2812, 43238, 674624],
+    ),
+    (
+        "promotion",
+        "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+        [6, 264, 9467, 422333],
+    ),
+    (
+        "castling",
+        "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+        [44, 1486, 62379, 2103487],
+    ),
+    (
+        "middlegame",
+        "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+        [46, 2079, 89890, 3894594],
+    ),
+]
+
+
 if __name__ == "__main__":
-    GAME = Game()
-    GAME.board.initialise_board()
-    GAME.play()
+    import argparse
+    import sys
+
+    if len(sys.argv) == 1:
+        GAME = Game()
+        GAME.board.initialise_board()
+        GAME.play()
+        sys.exit()
+
+    parser = argparse.ArgumentParser(description="Chess engine tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    perft_parser = subparsers.add_parser(
+        "perft", help="count the positions reached from a position"
+    )
+    perft_parser.add_argument("--depth", type=int, default=3)
+    perft_parser.add_argument("--fen", default=START_FEN)
+    perft_parser.add_argument(
+        "--no-divide", action="store_true", help="only print the total"
+    )
+    perft_parser.add_argument(
+        "--suite", action="store_true", help="check the standard test positions"
+    )
+    args = parser.parse_args()
+
+    if args.suite:
+        sys.exit(0 if run_perft_suite(args.depth) else 1)
+    run_perft(args.fen, args.depth, not args.no_divide)
@@ -0,0 +1,386 @@
+"""Game database"""
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+from bitboard import decode_move, encode_move
+from chess_engine import FEN_LETTERS, FEN_PIECES, Game
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS games (
+    game_id TEXT PRIMARY KEY,
+    start_fen TEXT NOT NULL,
+    state TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    moves INTEGER NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS moves (
+    game_id TEXT NOT NULL,
+    first_move INTEGER NOT NULL,
+    data BLOB NOT NULL,
+    PRIMARY KEY (game_id, first_move)
+);
+CREATE TABLE IF NOT EXISTS snapshots (
+    game_id TEXT NOT NULL,
+    moves INTEGER NOT NULL,
+    fen TEXT NOT NULL,
+    hash_history BLOB NOT NULL,
+    pieces_taken TEXT NOT NULL,
+    PRIMARY KEY (game_id, moves)
+);
+"""
+
+# The attributes of a Game which the webapp sets, rather than the moves
+STATE_FIELDS = (
+    "ai_game",
+    "ai_colour",
+    "in_progress",
+    "current_move",
+    "show_promotion_box",
+    "promotion_square",
+    "white_checkmate",
+    "black_checkmate",
+    "stalemate",
+)
+PROMOTION_CLASSES = {
+    piece_class.piece_type: piece_class for piece_class in FEN_PIECES.values()
+}
+
+
+def pack_moves(move_log):
+    """
+    Packs the entries of a game's move log into 2 bytes each, using the move
+    encoding of the bitboards. A promotion has the same square twice.
+    """
+    return struct.pack(
+        f"<{len(move_log)}H",
+        *(
+            encode_move(
+                current_row * 8 + current_column,
+                new_row * 8 + new_column,
+                0 if piece_class is None else piece_class.piece_type,
+            )
+            for (current_row, current_column), (new_row, new_column), piece_class in (
+                move_log
+            )
+        ),
+    )
+
+
+def unpack_moves(data):
+    """Returns the move log entries packed by pack_moves."""
+    move_log = []
+    for move in struct.unpack(f"<{len(data) // 2}H", data):
+        current_square, new_square, promotion = decode_move(move)
+        move_log.append(
+            (
+                divmod(current_square, 8),
+                divmod(new_square, 8),
+                PROMOTION_CLASSES[promotion] if promotion else None,
+            )
+        )
+    return move_log
+
+
+def replay_moves(game, move_log):
+    """Plays the entries of a move log in a game, as the webapp played them."""
+    for current_square, new_square, piece_class in move_log:
+        if current_square == new_square:
+            game.promote_pawn(current_square, piece_class)
+        else:
+            game.execute_move(current_square, new_square)
+
+
+def _get_state(game):
+    """Returns the webapp's settings and flags of a game as a JSON string."""
+    return json.dumps({field: getattr(game, field) for field in STATE_FIELDS})
+
+
+def _set_state(game, state):
+    """Sets the webapp's settings and flags of a game from a JSON string."""
+    for field, value in json.loads(state).items():
+        if field == "current_move":
+            value = [tuple(square) for square in value]
+        elif field == "promotion_square":
+            value = tuple(value)
+        setattr(game, field, value)
+
+
+def _format_pieces_taken(game):
+    """Returns the pieces taken in a game as FEN letters, e.g. PPn."""
+    return "".join(
+        FEN_LETTERS[type(piece)].upper() if piece.colour else FEN_LETTERS[type(piece)]
+        for piece in game.board.white_pieces_taken + game.board.black_pieces_taken
+    )
+
+
+def _set_pieces_taken(game, letters):
+    """Sets the pieces taken in a game from FEN letters."""
+    for letter in letters:
+        colour = letter.isupper()
+        piece = FEN_PIECES[letter.lower()](0, 0, colour)
+        if colour:
+            game.board.white_pieces_taken.append(piece)
+        else:
+            game.board.black_pieces_taken.append(piece)
+
+
+class GameDatabase:
+    """
+    Stores games in an SQLite file, so that they outlive the process and can
+    be shared by several webapp processes. A game is stored as the FEN string
+    of its starting position, its move log packed into 2 bytes a move, and
+    the webapp's settings, such as the AI's colour.
+
+    Each save updates the game's row with its new settings, and adds the
+    moves made since the last save as a new row of moves, in one transaction.
+    The webapp saves after every request, so a row usually holds one or two
+    moves. Every snapshot_moves moves, the position is stored as well, so
+    that loading a game only replays the moves made since its last snapshot,
+    and the rows of moves and the snapshots before it are deleted. A game
+    therefore never has more than about snapshot_moves rows.
+
+    Each save increments the game's version. A process can check that its
+    copy of a game is up to date by comparing versions, and a save made from
+    an out of date copy is refused.
+    """
+
+    SNAPSHOT_MOVES = 40
+
+    def __init__(self, path, snapshot_moves=None, timeout_seconds=10):
+        self.path = path
+        self.snapshot_moves = snapshot_moves or self.SNAPSHOT_MOVES
+        self.timeout_seconds = timeout_seconds
+        self.loads = 0
+        self.replayed_moves = 0
+        self.saves = 0
+        self.moves_written = 0
+        self.snapshots_written = 0
+        self.conflicts = 0
+        self.__connection = None
+        self.__pid = None
+        self.__lock = threading.Lock()
+
+    def get_version(self, game_id):
+        """Returns the version of a stored game, or None if it is not stored."""
+        with self.__lock:
+            row = (
+                self.__connect()
+                .execute("SELECT version FROM games WHERE game_id = ?", (game_id,))
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+    def save(self, game_id, game, saved=None):
+        """
+        Saves the changes made to a game since it was saved or loaded, given
+        by saved, and returns what has now been saved, to be passed in next
+        time. The moves saved are removed from the game's move log, so that
+        it only holds the moves made since. If saved is None, the game is
+        stored as a new game, replacing any game with the same id; it must
+        not have had any moves made yet. Returns None without saving if the
+        stored game has been changed since by another process.
+        """
+        state = _get_state(game)
+        move_log = game.move_log
+        if saved is None:
+            if move_log:
+                raise ValueError("a game must be saved before its moves are made")
+            version, saved_moves = 0, 0
+        else:
+            version, saved_moves, saved_state = saved
+            if not move_log and saved_state == state:
+                return saved
+        moves = saved_moves + len(move_log)
+
+        with self.__lock:
+            connection = self.__connect()
+            connection.execute("BEGIN IMMEDIATE")
+            try:
+                if saved is None:
+                    row = connection.execute(
+                        "SELECT version FROM games WHERE game_id = ?", (game_id,)
+                    ).fetchone()
+                    version = 0 if row is None else row[0]
+                    connection.execute(
+                        "DELETE FROM moves WHERE game_id = ?", (game_id,)
+                    )
+                    connection.execute(
+                        "DELETE FROM snapshots WHERE game_id = ?", (game_id,)
+                    )
+                    connection.execute(
+                        "INSERT OR REPLACE INTO games VALUES (?, ?, ?, ?, ?, ?)",
+                        (game_id, game.to_fen(), state, version + 1, 0, time.time()),
+                    )
+                else:
+                    cursor = connection.execute(
+                        "UPDATE games SET state = ?, version = ?, moves = ?, "
+                        "updated = ? WHERE game_id = ? AND version = ?",
+                        (
+                            state,
+                            version + 1,
+                            moves,
+                            time.time(),
+                            game_id,
+                            version,
+                        ),
+                    )
+                    if cursor.rowcount == 0:
+                        connection.execute("ROLLBACK")
+                        self.conflicts += 1
+                        return None
+
+                if move_log:
+                    connection.execute(
+                        "INSERT INTO moves VALUES (?, ?, ?)",
+                        (game_id, saved_moves, pack_moves(move_log)),
+                    )
+                    if (
+                        moves // self.snapshot_moves
+                        > saved_moves // self.snapshot_moves
+                    ):
+                        self.__save_snapshot(connection, game_id, game, moves)
+                connection.execute("COMMIT")
+            except BaseException:
+                connection.execute("ROLLBACK")
+                raise
+
+        self.saves += 1
+        self.moves_written += len(move_log)
+        del move_log[:]
+        return version + 1, moves, state
+
+    def load(self, game_id):
+        """
+        Loads a game, returning it together with what has been saved, to be
+        passed to save. Returns None if the game is not stored. The game is
+        set up from its last snapshot, or its starting position if it has
+        none, and only the moves made since are read and replayed. Its move
+        log is left empty, as all its moves are saved.
+        """
+        with self.__lock:
+            connection = self.__connect()
+            connection.execute("BEGIN")  # Read the rows from the same save
+            try:
+                game_row = connection.execute(
+                    "SELECT start_fen, state, version, moves FROM games "
+                    "WHERE game_id = ?",
+                    (game_id,),
+                ).fetchone()
+                if game_row is None:
+                    return None
+                snapshot = connection.execute(
+                    "SELECT moves, fen, hash_history, pieces_taken FROM snapshots "
+                    "WHERE game_id = ? ORDER BY moves DESC LIMIT 1",
+                    (game_id,),
+                ).fetchone()
+                # A snapshot is taken at the end of a save, so no row of moves
+                # spans it
+                rows = connection.execute(
+                    "SELECT data FROM moves WHERE game_id = ? AND first_move >= ? "
+                    "ORDER BY first_move",
+                    (game_id, 0 if snapshot is None else snapshot[0]),
+                ).fetchall()
+            finally:
+                connection.execute("COMMIT")
+
+        start_fen, state, version, saved_moves = game_row
+        replayed = []
+        for (data,) in rows:
+            replayed.extend(unpack_moves(data))
+
+        if snapshot is None:
+            game = Game.from_fen(start_fen)
+        else:
+            _, fen, hash_history, pieces_taken = snapshot
+            game = Game.from_fen(fen)
+            game.start_history(
+                struct.unpack(f"<{len(hash_history) // 8}Q", hash_history)
+            )
+            _set_pieces_taken(game, pieces_taken)
+        replay_moves(game, replayed)
+        game.move_log = []
+        _set_state(game, state)
+
+        self.loads += 1
+        self.replayed_moves += len(replayed)
+        return game, (version, saved_moves, state)
+
+    def remove(self, game_id):
+        """Removes a game if it is stored."""
+        with self.__lock:
+            connection = self.__connect()
+            connection.execute("BEGIN IMMEDIATE")
+            for table in ("games", "moves", "snapshots"):
+                connection.execute(f"DELETE FROM {table} WHERE game_id = ?", (game_id,))
+            connection.execute("COMMIT")
+
+    def stats(self):
+        """
+        Returns the number of games stored, and the numbers of loads, saves
+        and moves replayed and written by this process.
+        """
+        with self.__lock:
+            (games,) = self.__connect().execute("SELECT COUNT(*) FROM games").fetchone()
+        return {
+            "path": self.path,
+            "games": games,
+            "snapshot_moves": self.snapshot_moves,
+            "loads": self.loads,
+            "replayed_moves": self.replayed_moves,
+            "saves": self.saves,
+            "moves_written": self.moves_written,
+            "snapshots_written": self.snapshots_written,
+            "conflicts": self.conflicts,
+        }
+
+    def __save_snapshot(self, connection, game_id, game, moves):
+        """
+        Stores the game's position after the given number of moves, and
+        deletes the moves and snapshots which come before it, as loading the
+        game no longer reads them. Only the positions since the last capture
+        or pawn move are kept in its hash history, as the earlier ones can't
+        occur again.
+        """
+        hash_history = game.get_recent_history()
+        connection.execute(
+            "INSERT INTO snapshots VALUES (?, ?, ?, ?, ?)",
+            (
+                game_id,
+                moves,
+                game.to_fen(),
+                struct.pack(f"<{len(hash_history)}Q", *hash_history),
+                _format_pieces_taken(game),
+            ),
+        )
+        connection.execute(
+            "DELETE FROM moves WHERE game_id = ? AND first_move < ?", (game_id, moves)
+        )
+        connection.execute(
+            "DELETE FROM snapshots WHERE game_id = ? AND moves < ?", (game_id, moves)
+        )
+        self.snapshots_written += 1
+
+    def __connect(self):
+        """
+        Returns the connection to the database, opening it if needed. Each
+        process opens its own connection, as one can't be shared with a
+        process forked from it. Transactions are begun explicitly, and writes
+        wait up to timeout_seconds for another process's write to finish.
+        """
+        if self.__connection is None or self.__pid != os.getpid():
+            connection = sqlite3.connect(
+                self.path,
+                timeout=self.timeout_seconds,
+                isolation_level=None,
+                check_same_thread=False,
+            )
+            # Readers then don't block the writer, or the writer the readers
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self.__connection = connection
+            self.__pid = os.getpid()
+        return self.__connection
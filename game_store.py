@@ -0,0 +1,168 @@
+"""Game store"""
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from chess_engine import Game
+
+
+class GameStore:
+    """
+    Keeps the games being played by the webapp, keyed by game id. The memory
+    limit is an approximate cap: it is turned into a maximum number of games
+    using GAME_SIZE, and the memory the games actually use is not measured.
+    When the maximum is reached, the least recently used game is removed.
+    Games which have not been used for longer than the time to live are also
+    removed.
+
+    If a GameDatabase is given, the changes made to a game are saved to it
+    with save, and the games in memory act as a cache of the database: a game
+    which is not in memory, or which another process has saved since, is
+    loaded from it. Games removed from memory stay in the database.
+    """
+
+    # Estimated number of bytes used by a game in play, which sets the number
+    # of games kept for a memory limit. Most of it is the board and pieces.
+    # The position history only goes back to the last capture or pawn move,
+    # at most 100 plies while the game is in progress, and the move log is
+    # emptied each time the game is saved. The undo stack grows by an entry
+    # each move and the pieces taken lists by one each capture, so a long
+    # game uses more than this.
+    GAME_SIZE = 16 * 1024
+
+    def __init__(self, memory_limit_mb=64, ttl_seconds=3600, database=None):
+        self.memory_limit_mb = memory_limit_mb
+        self.ttl_seconds = ttl_seconds
+        self.max_games = max(1, int(memory_limit_mb * 1024 * 1024) // self.GAME_SIZE)
+        self.database = database
+        self.evictions = 0
+        self.loads = 0
+        # Game id -> (game, time last used, what the database has saved of it)
+        self.__games = OrderedDict()
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.__games)
+
+    def __contains__(self, game_id):
+        return game_id in self.__games
+
+    def new_game(self, game_id=None):
+        """
+        Creates a game with the pieces in their starting places and stores it.
+        A new game id is made if one is not given. Returns the game id and the
+        game.
+        """
+        if game_id is None:
+            game_id = uuid.uuid4().hex
+        game = Game()
+        game.board.initialise_board()
+        self.put(game_id, game)
+        return game_id, game
+
+    def get(self, game_id):
+        """Returns the game with the given id, or None if it is not stored."""
+        with self.__lock:
+            self.__remove_expired()
+            entry = self.__games.get(game_id)
+            if self.database is not None and game_id is not None:
+                entry = self.__check_database(game_id, entry)
+            if entry is None:
+                self.__games.pop(game_id, None)
+                return None
+            self.__games[game_id] = (entry[0], time.monotonic(), entry[2])
+            self.__games.move_to_end(game_id)
+            self.__remove_least_recently_used()
+            return entry[0]
+
+    def put(self, game_id, game):
+        """
+        Stores a game, replacing any game with the same id. It is saved to
+        the database as a new game, so it must not have had any moves made.
+        """
+        with self.__lock:
+            self.__games[game_id] = (game, time.monotonic(), None)
+            self.__games.move_to_end(game_id)
+            self.__remove_expired()
+            self.__remove_least_recently_used()
+
+    def save(self, game_id):
+        """
+        Saves the changes made to a game to the database, if there is one.
+        Returns False if another process saved the game first, in which case
+        this copy is dropped, so that the next get loads the other version.
+        Without a database, the game's move log is just emptied, as nothing
+        reads it.
+        """
+        with self.__lock:
+            entry = self.__games.get(game_id)
+            if entry is None:
+                return True
+            if self.database is None:
+                del entry[0].move_log[:]
+                return True
+            saved = self.database.save(game_id, entry[0], entry[2])
+            if saved is None:
+                del self.__games[game_id]
+                return False
+            self.__games[game_id] = (entry[0], entry[1], saved)
+            return True
+
+    def remove(self, game_id):
+        """Removes a game if it is stored."""
+        with self.__lock:
+            self.__games.pop(game_id, None)
+            if self.database is not None:
+                self.database.remove(game_id)
+
+    def stats(self):
+        """Returns the number of games stored and the limits of the store."""
+        return {
+            "games": len(self.__games),
+            "max_games": self.max_games,
+            "memory_limit_mb": self.memory_limit_mb,
+            "ttl_seconds": self.ttl_seconds,
+            "evictions": self.evictions,
+            "loads": self.loads,
+            "database": None if self.database is None else self.database.stats(),
+        }
+
+    def __check_database(self, game_id, entry):
+        """
+        Returns the entry for a game, loading the game from the database if
+        it is not in memory or another process has saved it since. Returns
+        None if the game is in neither.
+        """
+        if entry is not None and entry[2] is None:
+            return entry  # A new game which has not been saved yet
+        version = self.database.get_version(game_id)
+        if version is None:
+            return None
+        if entry is not None and entry[2][0] == version:
+            return entry
+        loaded = self.database.load(game_id)
+        if loaded is None:
+            return None
+        self.loads += 1
+        game, saved = loaded
+        return game, time.monotonic(), saved
+
+    def __remove_least_recently_used(self):
+        """Removes the least recently used games while there are too many."""
+        while len(self.__games) > self.max_games:
+            self.__games.popitem(last=False)
+            self.evictions += 1
+
+    def __remove_expired(self):
+        """
+        Removes the games which have not been used within the time to live.
+        The games are kept in order of last use, so only the oldest games need
+        to be checked.
+        """
+        expiry_time = time.monotonic() - self.ttl_seconds
+        while self.__games:
+            game_id, (_, last_used, _) = next(iter(self.__games.items()))
+            if last_used > expiry_time:
+                break
+            del self.__games[game_id]
+            self.evictions += 1
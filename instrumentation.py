@@ -0,0 +1,210 @@
+"""Instrumentation"""
+import cProfile
+import functools
+import threading
+import time
+from chess_engine import Game
+from bitboard import BitboardPosition
+from evaluation import Evaluation
+from ai import AI
+
+# The hot paths which are timed, as (class, method name, category). Private
+# methods are given by their mangled names.
+HOT_PATHS = [
+    (Game, "validate_move", "move_generation"),
+    (Game, "get_legal_moves", "move_generation"),
+    (BitboardPosition, "generate_legal_moves", "move_generation"),
+    (Game, "in_check", "check_detection"),
+    (Game, "is_square_attacked", "check_detection"),
+    (BitboardPosition, "in_check", "check_detection"),
+    (BitboardPosition, "is_square_attacked", "check_detection"),
+    (Game, "make_move", "make_move"),
+    (Game, "unmake_move", "make_move"),
+    (BitboardPosition, "make", "make_move"),
+    (BitboardPosition, "unmake", "make_move"),
+    (Evaluation, "get_score", "evaluation"),
+    (AI, "_AI__evaluate_leaf", "evaluation"),
+    (AI, "order_moves", "move_ordering"),
+    (AI, "get_ai_move_minimax", "search"),
+    (AI, "get_ai_move_alphabeta", "search"),
+    (AI, "quiescence_search", "search"),
+]
+
+
+class Instrumentation:
+    """
+    Counts the calls to the engine's hot paths and times them. The methods
+    are only wrapped while instrumentation is enabled, and the originals are
+    put back when it is disabled, so it costs nothing when it is off.
+
+    Each method's time is kept both in total and excluding the time spent in
+    the other timed methods it calls (its self time). The self times of a
+    category, such as move generation or evaluation, can then be compared
+    without counting any time twice. The total time of a recursive method
+    only counts its outermost calls.
+    """
+
+    def __init__(self, hot_paths=None):
+        self.hot_paths = HOT_PATHS if hot_paths is None else hot_paths
+        self.enabled = False
+        self.__originals = {}
+        self.__records = {}  # Name -> [calls, seconds, self seconds, active calls]
+        self.__local = threading.local()  # Holds each thread's stack of calls
+        self.reset()
+
+    def enable(self):
+        """Starts counting and timing the hot paths."""
+        if self.enabled:
+            return
+        for owner, name, _ in self.hot_paths:
+            function = owner.__dict__[name]
+            self.__originals[owner, name] = function
+            setattr(owner, name, self.__wrap(self.get_path_name(owner, name), function))
+        self.enabled = True
+
+    def disable(self):
+        """Stops counting and timing, restoring the original methods."""
+        for (owner, name), function in self.__originals.items():
+            setattr(owner, name, function)
+        self.__originals = {}
+        self.enabled = False
+
+    def reset(self):
+        """Sets all the counts and times back to zero."""
+        # The records are changed in place, as the wrapped methods use them,
+        # and the count of calls which are still running is kept
+        for owner, name, _ in self.hot_paths:
+            path_name = self.get_path_name(owner, name)
+            record = self.__records.setdefault(path_name, [0, 0.0, 0.0, 0])
+            record[:3] = [0, 0.0, 0.0]
+
+    @staticmethod
+    def get_path_name(owner, name):
+        """Returns the name a hot path is reported under, e.g. Game.make_move."""
+        return f"{owner.__name__}.{name.replace(f'_{owner.__name__}__', '__')}"
+
+    def stats(self):
+        """
+        Returns the calls, total time and self time of each hot path which
+        has been called, and the self time of each category.
+        """
+        functions = {}
+        categories = {}
+        for owner, name, category in self.hot_paths:
+            path_name = self.get_path_name(owner, name)
+            calls, seconds, self_seconds, _ = self.__records[path_name]
+            categories[category] = categories.get(category, 0.0) + self_seconds
+            if calls:
+                functions[path_name] = {
+                    "category": category,
+                    "calls": calls,
+                    "seconds": seconds,
+                    "self_seconds": self_seconds,
+                }
+        return {
+            "enabled": self.enabled,
+            "functions": functions,
+            "categories": categories,
+        }
+
+    def __wrap(self, path_name, function):
+        """Returns a function which counts and times calls to the given one."""
+        records = self.__records
+        local = self.__local
+
+        @functools.wraps(function)
+        def timed(*args, **kwargs):
+            # Time spent in timed calls below each of the thread's active calls
+            stack = local.__dict__.setdefault("stack", [])
+            record = records[path_name]
+            record[0] += 1
+            record[3] += 1
+            stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                record[2] += elapsed - stack.pop()
+                record[3] -= 1
+                if not record[3]:
+                    record[1] += elapsed
+                if stack:
+                    stack[-1] += elapsed
+
+        return timed
+
+
+INSTRUMENTATION = Instrumentation()
+
+
+def profile(function, path, *args, **kwargs):
+    """
+    Calls the function under cProfile, writes the statistics to the given
+    path in pstats format, and returns the function's result. The file can
+    be read with python -m pstats.
+    """
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(function, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
+
+
+if __name__ == "__main__":
+    import argparse
+    import pstats
+    import sys
+    from chess_engine import START_FEN
+
+    parser = argparse.ArgumentParser(
+        description="Search a position with the hot paths counted and timed."
+    )
+    parser.add_argument("--fen", default=START_FEN)
+    parser.add_argument("--depth", type=int, default=4)
+    parser.add_argument("--time-ms", type=int, help="time budget for the search")
+    parser.add_argument("--backend", choices=["object", "bitboard"], default="object")
+    parser.add_argument(
+        "--profile",
+        help="run the search under cProfile instead, writing pstats output here",
+    )
+    args = parser.parse_args()
+
+    AI_PLAYER = AI(backend=args.backend)
+    GAME = Game.from_fen(args.fen)
+    TIME_BUDGET_MS = float("inf") if args.time_ms is None else args.time_ms
+    if args.profile:
+        profile(
+            AI_PLAYER.get_ai_move_iterative,
+            args.profile,
+            GAME,
+            TIME_BUDGET_MS,
+            args.depth,
+        )
+        pstats.Stats(args.profile).sort_stats("tottime").print_stats(20)
+        sys.exit()
+
+    INSTRUMENTATION.enable()
+    START = time.perf_counter()
+    AI_PLAYER.get_ai_move_iterative(GAME, TIME_BUDGET_MS, args.depth)
+    ELAPSED = time.perf_counter() - START
+    INSTRUMENTATION.disable()
+
+    SEARCH = AI_PLAYER.get_search_stats()
+    STATS = INSTRUMENTATION.stats()
+    print(
+        f"depth {SEARCH['depth']}, {SEARCH['nodes']} nodes, "
+        f"{SEARCH['cutoffs']} cutoffs, "
+        f"{SEARCH['transposition_table']['hit_rate']:.1%} table hit rate "
+        f"in {ELAPSED:.2f}s"
+    )
+    print(f"{'hot path':38} {'calls':>10} {'total s':>9} {'self s':>9}")
+    for NAME, FUNCTION in sorted(
+        STATS["functions"].items(), key=lambda item: -item[1]["self_seconds"]
+    ):
+        print(
+            f"{NAME:38} {FUNCTION['calls']:10} {FUNCTION['seconds']:9.3f} "
+            f"{FUNCTION['self_seconds']:9.3f}"
+        )
+    for CATEGORY, SECONDS in STATS["categories"].items():
+        print(f"{CATEGORY:38} {'':10} {'':9} {SECONDS:9.3f}")
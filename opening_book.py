@@ -0,0 +1,236 @@
+"""Opening book"""
+import mmap
+import os
+import random
+import struct
+from collections import Counter
+from chess_engine import Game, KING, START_FEN, parse_move, move_name
+from pgn import read_games, replay_game
+
+# Each entry is 16 bytes laid out as in a Polyglot book: the position key,
+# the move, its weight and a learning value, all big-endian. Entries are
+# sorted by key. The keys are the engine's own Zobrist hashes rather than
+# Polyglot's, so Polyglot books can't be read, nor these books by Polyglot
+# tools. The first entry is a header with a key of 0 and the learning value
+# MAGIC, so that a Polyglot book is rejected rather than giving wrong moves.
+ENTRY = struct.Struct(">QHHI")
+KEY = struct.Struct(">Q")
+MAGIC = 0x43484B31
+HEADER = ENTRY.pack(0, 0, 0, MAGIC)
+
+
+def encode_move(game, move, piece_class=None):
+    """
+    Encodes a move of the game's position in the 16 bit Polyglot format. Rows
+    are counted up from white's side, and castling is stored as the king
+    moving onto its rook's square.
+    """
+    (current_row, current_column), (new_row, new_column) = move
+    piece = game.board.board[current_row][current_column]
+    if piece.piece_type == KING and abs(new_column - current_column) == 2:
+        new_column = 7 if new_column == 6 else 0
+    promotion = piece_class.piece_type if piece_class is not None else 0
+    return (
+        new_column
+        | (7 - new_row) << 3
+        | current_column << 6
+        | (7 - current_row) << 9
+        | promotion << 12
+    )
+
+
+def decode_move(game, code):
+    """Returns the move of the game's position encoded by encode_move."""
+    new_column = code & 7
+    new_row = 7 - (code >> 3 & 7)
+    current_column = code >> 6 & 7
+    current_row = 7 - (code >> 9 & 7)
+    piece = game.board.board[current_row][current_column]
+    if (
+        piece is not None
+        and piece.piece_type == KING
+        and abs(new_column - current_column) > 1
+    ):
+        new_column = 6 if new_column > current_column else 2
+    return [(current_row, current_column), (new_row, new_column)]
+
+
+class OpeningBook:
+    """
+    Looks up moves for known opening positions in a book file written by
+    build_book. The file is memory-mapped and its entries are binary searched
+    by the Zobrist hash of the position, so a lookup only reads a few entries
+    from disk and needs no search. Raises ValueError if the file is not such
+    a book, such as a Polyglot book.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as book_file:
+            if book_file.read(ENTRY.size) != HEADER:
+                raise ValueError(f"{path} is not a book written by build_book")
+            self.__data = mmap.mmap(book_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.size = len(self.__data) // ENTRY.size - 1  # Not counting the header
+
+    def __len__(self):
+        return self.size
+
+    def find_entries(self, key):
+        """
+        Returns the (move, weight) pairs stored for the position key, with the
+        encoded moves in the order they are stored.
+        """
+        low, high = 1, self.size + 1
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(self.__data, middle * ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+
+        entries = []
+        for index in range(low, self.size + 1):
+            entry_key, code, weight, _ = ENTRY.unpack_from(
+                self.__data, index * ENTRY.size
+            )
+            if entry_key != key:
+                break
+            entries.append((code, weight))
+        return entries
+
+    def get_moves(self, game):
+        """
+        Returns the book moves for the game's position as (move, weight)
+        pairs. Moves which are not legal in the position are left out, in
+        case of a hash collision.
+        """
+        entries = self.find_entries(game.zobrist_hash)
+        if not entries:
+            return []
+        legal_moves = game.get_legal_moves()
+        moves = []
+        for code, weight in entries:
+            move = decode_move(game, code)
+            if move in legal_moves:
+                moves.append((move, weight))
+        return moves
+
+    def choose_move(self, game, rng=random):
+        """
+        Returns a book move for the game's position, chosen at random with the
+        probability of each move given by its weight, or None if the position
+        is not in the book.
+        """
+        moves = self.get_moves(game)
+        if not moves:
+            return None
+        weights = [weight for _, weight in moves]
+        if not any(weights):
+            weights = None
+        return rng.choices([move for move, _ in moves], weights)[0]
+
+    def close(self):
+        """Closes the book file."""
+        self.__data.close()
+
+
+def build_book(lines, path):
+    """
+    Writes a book file from lines of moves in coordinate notation, each line
+    being one opening played from the starting position. Text after a # is
+    ignored. The weight of a move in a position is the number of lines which
+    play it. Returns the number of entries written.
+    """
+    counts = Counter()
+    for line_number, line in enumerate(lines, 1):
+        names = line.split("#")[0].split()
+        if not names:
+            continue
+        game = Game.from_fen(START_FEN)
+        for name in names:
+            move, piece_class = parse_move(name)
+            if move not in game.get_legal_moves():
+                raise ValueError(f"line {line_number}: illegal move {name}")
+            counts[game.zobrist_hash, encode_move(game, move, piece_class)] += 1
+            game.make_move(move, piece_class)
+
+    entries = sorted(
+        ((key, code, min(count, 0xFFFF)) for (key, code), count in counts.items()),
+        key=lambda entry: (entry[0], -entry[2], entry[1]),
+    )
+    # The book is written to a file of its own and then moved into place, so
+    # that other processes starting at the same time never map a part
+    # written book
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as book_file:
+        book_file.write(HEADER)
+        for key, code, weight in entries:
+            book_file.write(ENTRY.pack(key, code, weight, 0))
+    os.replace(temporary_path, path)
+    return len(entries)
+
+
+def read_pgn_openings(lines, plies=16):
+    """
+    Yields the first plies moves of each game in lines of PGN, in coordinate
+    notation, as the lines of openings for build_book. Games which start from
+    another position or have an illegal move are left out.
+    """
+    for pgn_game in read_games(lines):
+        if "FEN" in pgn_game.tags:
+            continue
+        names = []
+        try:
+            for _, move, piece_class in replay_game(pgn_game):
+                if len(names) == plies:
+                    break
+                names.append(move_name(move, piece_class))
+        except ValueError:
+            continue
+        if names:
+            yield " ".join(names)
+
+
+def load_book(path):
+    """
+    Opens the book file, or returns None if it is missing or can't be read.
+    The book is not built here, as that is done offline with the build
+    command.
+    """
+    try:
+        return OpeningBook(path)
+    except OSError:
+        return None
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Opening book tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser(
+        "build",
+        help="build a book from lines of coordinate moves, or from the openings "
+        "of the games in a .pgn file",
+    )
+    build_parser.add_argument("source")
+    build_parser.add_argument("book")
+    build_parser.add_argument(
+        "--plies", type=int, default=16, help="length of the openings from PGN"
+    )
+    probe_parser = subparsers.add_parser("probe", help="list the moves for a position")
+    probe_parser.add_argument("book")
+    probe_parser.add_argument("--fen", default=START_FEN)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        with open(args.source, errors="replace") as SOURCE:
+            LINES = SOURCE
+            if args.source.lower().endswith(".pgn"):
+                LINES = read_pgn_openings(SOURCE, args.plies)
+            print(f"{build_book(LINES, args.book)} entries written")
+    else:
+        BOOK = OpeningBook(args.book)
+        for MOVE, WEIGHT in BOOK.get_moves(Game.from_fen(args.fen)):
+            print(move_name(MOVE), WEIGHT)
+        BOOK.close()
@@ -0,0 +1,352 @@
+"""PGN"""
+import re
+import time
+from chess_engine import (
+    FEN_LETTERS,
+    FEN_PIECES,
+    KING,
+    PAWN,
+    START_FEN,
+    Game,
+    move_name,
+)
+
+TAG = re.compile(r'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# Comments, variations, NAGs, move numbers and then moves or results
+TOKEN = re.compile(r"\{[^}]*\}?|;|\(|\)|\$\d+|\d+\.+|[^\s{}();$]+")
+SAN = re.compile(r"([NBRQK])?([a-h])?([1-8])?x?([a-h][1-8])(?:=?([NBRQ]))?[+#]?[!?]*$")
+CASTLING = re.compile(r"([O0]-[O0])(-[O0])?[+#]?[!?]*$")
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+SAN_PIECE_TYPES = {
+    letter.upper(): piece_class.piece_type for letter, piece_class in FEN_PIECES.items()
+}
+
+
+class PGNGame:
+    """
+    A game read from a PGN file: its tag pairs, its moves in standard
+    algebraic notation (SAN) and its result. Comments and variations are
+    left out.
+    """
+
+    def __init__(self, line_number):
+        self.line_number = line_number
+        self.tags = {}
+        self.moves = []
+        self.result = None
+
+    def get_start_fen(self):
+        """Returns the FEN string of the position the game starts from."""
+        return self.tags.get("FEN", START_FEN)
+
+
+def read_games(lines):
+    """
+    Reads PGN games from an iterable of lines, such as an open file, and
+    yields them one at a time. Only the game being read is kept in memory,
+    so files with any number of games can be read.
+    """
+    game = None
+    in_comment = False
+    variation_depth = 0
+    for line_number, line in enumerate(lines, 1):
+        if in_comment:
+            end = line.find("}")
+            if end == -1:
+                continue
+            line = line[end + 1 :]
+            in_comment = False
+        elif line.startswith("%"):
+            continue  # Escaped line
+
+        stripped = line.strip()
+        if not stripped:
+            continue
+        if stripped.startswith("[") and variation_depth == 0:
+            match = TAG.match(stripped)
+            if match:
+                if game is not None and (game.moves or game.result):
+                    yield game  # A game without a result
+                    game = None
+                if game is None:
+                    game = PGNGame(line_number)
+                value = match.group(2).replace('\\"', '"').replace("\\\\", "\\")
+                game.tags[match.group(1)] = value
+                continue
+
+        for match in TOKEN.finditer(line):
+            token = match.group()
+            first = token[0]
+            if first == "{":
+                if token[-1] != "}":
+                    in_comment = True
+                    break
+            elif first == ";":
+                break
+            elif first == "(":
+                variation_depth += 1
+            elif first == ")":
+                variation_depth = max(0, variation_depth - 1)
+            elif variation_depth or first == "$" or token[-1] == ".":
+                continue
+            else:
+                if game is None:
+                    game = PGNGame(line_number)
+                if token in RESULTS:
+                    game.result = token
+                    yield game
+                    game = None
+                    variation_depth = 0
+                else:
+                    game.moves.append(token)
+
+    if game is not None:
+        yield game
+
+
+def parse_san(game, san):
+    """
+    Returns the move and the class of the promoted piece (or None) for a move
+    of the game's position in standard algebraic notation, e.g. Nbd7, exd5,
+    e8=Q or O-O. Raises ValueError if the move is not legal or is ambiguous.
+    Only the pieces of the type named are looked at, rather than generating
+    every legal move of the position.
+    """
+    board = game.board.board
+    castling = CASTLING.match(san)
+    if castling:
+        row, column = (
+            game.white_king_location
+            if game.current_player_colour
+            else game.black_king_location
+        )
+        move = [(row, column), (row, 2 if castling.group(2) else 6)]
+        if move in game.get_valid_moves():
+            return move, None
+        raise ValueError(f"illegal move {san}")
+
+    match = SAN.match(san)
+    if not match:
+        raise ValueError(f"unreadable move {san}")
+    piece_letter, file, rank, square, promotion = match.groups()
+    piece_type = SAN_PIECE_TYPES[piece_letter] if piece_letter else PAWN
+    new_square = (8 - int(square[1]), ord(square[0]) - ord("a"))
+    column = ord(file) - ord("a") if file else None
+    row = 8 - int(rank) if rank else None
+
+    colour = game.current_player_colour
+    pieces = game.board.white_pieces if colour else game.board.black_pieces
+    new_row, new_column = new_square
+    if piece_type == PAWN and column is None:
+        column = new_column  # Only captures name the pawn's file
+    moves = []
+    for piece in pieces:
+        if (
+            piece.piece_type != piece_type
+            or (column is not None and piece.column != column)
+            or (row is not None and piece.row != row)
+        ):
+            continue
+        move = [(piece.row, piece.column), new_square]
+        if (
+            piece_type == PAWN
+            and piece.column != new_column
+            and board[new_row][new_column] is None
+        ):
+            legal = move in game.get_valid_moves()  # En passant
+        else:
+            legal = new_square in piece.generate_board_moves(board) and (
+                not _exposes_king(game, piece, new_square)
+            )
+        if legal:
+            moves.append(move)
+    if len(moves) != 1:
+        raise ValueError(f"{'ambiguous' if moves else 'illegal'} move {san}")
+
+    piece_class = None
+    if piece_type == PAWN and new_row in (0, 7):
+        if promotion is None:
+            raise ValueError(f"missing promotion in {san}")
+        piece_class = FEN_PIECES[promotion.lower()]
+    elif promotion is not None:
+        raise ValueError(f"illegal move {san}")
+    return moves[0], piece_class
+
+
+def _exposes_king(game, piece, new_square):
+    """
+    Checks if moving the piece to the square would leave its king attacked.
+    The move is tried on the board alone, which is much quicker than
+    generating all the legal moves when only one move is wanted.
+    """
+    board = game.board.board
+    new_row, new_column = new_square
+    captured = board[new_row][new_column]
+    board[piece.row][piece.column] = None
+    board[new_row][new_column] = piece
+    if piece.piece_type == KING:
+        king_square = new_square
+    elif piece.colour:
+        king_square = game.white_king_location
+    else:
+        king_square = game.black_king_location
+    attacked = game.is_square_attacked(king_square, not piece.colour)
+    board[new_row][new_column] = captured
+    board[piece.row][piece.column] = piece
+    return attacked
+
+
+def san_name(game, move, piece_class=None):
+    """
+    Returns a move of the game's position in standard algebraic notation,
+    without a check or checkmate sign. This is the inverse of parse_san.
+    """
+    board = game.board.board
+    (current_row, current_column), (new_row, new_column) = move
+    piece_type = board[current_row][current_column].piece_type
+    if piece_type == KING and abs(new_column - current_column) == 2:
+        return "O-O" if new_column == 6 else "O-O-O"
+
+    square = move_name(move)[2:]
+    capture = "x" if board[new_row][new_column] is not None else ""
+    if piece_type == PAWN:
+        if current_column != new_column:
+            capture = "x"
+            square = move_name(move)[0] + capture + square
+        if piece_class is not None:
+            square += "=" + FEN_LETTERS[piece_class].upper()
+        return square
+
+    # Name the file, rank or both of the moving piece if another piece of the
+    # same type can move to the same square
+    others = [
+        other
+        for other, other_square in game.get_valid_moves()
+        if other_square == move[1]
+        and other != move[0]
+        and board[other[0]][other[1]].piece_type == piece_type
+    ]
+    origin = ""
+    if others:
+        name = move_name(move)
+        if all(other[1] != current_column for other in others):
+            origin = name[0]
+        elif all(other[0] != current_row for other in others):
+            origin = name[1]
+        else:
+            origin = name[:2]
+    return "NBRQK"[piece_type - 1] + origin + capture + square
+
+
+def format_game(tags, moves, result, fullmove_number=1, white_to_move=True):
+    """
+    Returns a game in PGN, from its tag pairs, its moves in SAN and its
+    result, with the movetext wrapped at 80 columns.
+    """
+    lines = []
+    for name, value in dict(tags, Result=result).items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"')
+        lines.append(f'[{name} "{value}"]')
+    lines.append("")
+
+    tokens = []
+    if not white_to_move and moves:
+        tokens.append(f"{fullmove_number}...")
+    for san in moves:
+        if white_to_move:
+            tokens.append(f"{fullmove_number}.")
+        else:
+            fullmove_number += 1
+        tokens.append(san)
+        white_to_move = not white_to_move
+    tokens.append(result)
+
+    line = ""
+    for token in tokens:
+        if line and len(line) + len(token) >= 80:
+            lines.append(line)
+            line = ""
+        line = f"{line} {token}" if line else token
+    lines.append(line)
+    return "\n".join(lines) + "\n"
+
+
+def replay_game(pgn_game):
+    """
+    Plays through the moves of a PGN game. Yields the game position before
+    each move together with the move and the class of its promoted piece (or
+    None); the move is made once the next item is asked for. Raises
+    ValueError, giving the move number, if a move can't be played.
+    """
+    game = Game.from_fen(pgn_game.get_start_fen())
+    for san in pgn_game.moves:
+        try:
+            move, piece_class = parse_san(game, san)
+        except ValueError as error:
+            number = game.fullmove_number
+            dots = "." if game.current_player_colour else "..."
+            raise ValueError(f"move {number}{dots} {error}") from None
+        yield game, move, piece_class
+        game.make_move(move, piece_class)
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(description="PGN tools.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    validate_parser = subparsers.add_parser(
+        "validate", help="replay every game, reporting errors and throughput"
+    )
+    validate_parser.add_argument("pgn")
+    moves_parser = subparsers.add_parser(
+        "moves",
+        help="print each game's moves in coordinate notation, one game per line, "
+        "e.g. as the source of an opening book",
+    )
+    moves_parser.add_argument("pgn")
+    moves_parser.add_argument("--plies", type=int, help="the most moves to print")
+    args = parser.parse_args()
+
+    GAMES = 0
+    MOVES = 0
+    ERRORS = 0
+    PARSE_TIME = 0
+    REPLAY_TIME = 0
+    with open(args.pgn, errors="replace") as PGN_FILE:
+        READER = read_games(PGN_FILE)
+        while True:
+            START = time.perf_counter()
+            PGN_GAME = next(READER, None)
+            PARSE_TIME += time.perf_counter() - START
+            if PGN_GAME is None:
+                break
+            GAMES += 1
+            if args.command == "moves" and "FEN" in PGN_GAME.tags:
+                continue  # The line would not start from the starting position
+
+            START = time.perf_counter()
+            NAMES = []
+            try:
+                for _, MOVE, PIECE_CLASS in replay_game(PGN_GAME):
+                    if args.command == "moves" and (
+                        args.plies is None or len(NAMES) < args.plies
+                    ):
+                        NAMES.append(move_name(MOVE, PIECE_CLASS))
+                    MOVES += 1
+            except ValueError as ERROR:
+                ERRORS += 1
+                NAMES = []  # A game with an illegal move is left out
+                print(f"game at line {PGN_GAME.line_number}: {ERROR}", file=sys.stderr)
+            REPLAY_TIME += time.perf_counter() - START
+            if args.command == "moves" and NAMES:
+                print(" ".join(NAMES))
+
+    print(
+        f"{GAMES} games, {MOVES} moves, {ERRORS} errors; "
+        f"parsed in {PARSE_TIME:.2f}s ({GAMES / PARSE_TIME if PARSE_TIME else 0:.0f}"
+        f" games/s), replayed in {REPLAY_TIME:.2f}s "
+        f"({MOVES / REPLAY_TIME if REPLAY_TIME else 0:.0f} moves/s)",
+        file=sys.stderr,
+    )
@@ -0,0 +1,612 @@
+"""Endgame tablebase"""
+import array
+import itertools
+import mmap
+import os
+import time
+from chess_engine import (
+    KING_ATTACKS,
+    KNIGHT_ATTACKS,
+    PAWN_ATTACKS,
+    RAYS as SQUARE_RAYS,
+    SLIDER_DIRECTIONS,
+    PAWN,
+    KNIGHT,
+    BISHOP,
+    ROOK,
+    QUEEN,
+    KING,
+    Game,
+    get_promotion_classes,
+    move_name,
+)
+
+# Squares are numbered row * 8 + column, so square 0 is a8 and square 63 is
+# h1. A table has one byte for each arrangement of its pieces with each side
+# to move, indexed by the squares of the pieces: white's pieces and then
+# black's, strongest first. The byte is 0 for a draw (or an impossible
+# arrangement), and otherwise the number of plies to checkmate plus one. An
+# odd number of plies means that the side to move wins.
+PIECE_LETTERS = "PNBRQK"
+PROMOTION_TYPES = (QUEEN, ROOK, BISHOP, KNIGHT)
+WIN = 1
+DRAW = 0
+LOSS = -1
+
+# Flags used while generating a table
+ILLEGAL = 1
+DRAW_EXIT = 2
+
+
+def _numbered(squares):
+    """Returns the square numbers of a table of (row, column) squares."""
+    return [
+        frozenset(row * 8 + column for row, column in targets) for targets in squares
+    ]
+
+
+# The attack tables of the engine, with squares numbered rather than paired
+KING_STEPS = _numbered(KING_ATTACKS)
+KNIGHT_STEPS = _numbered(KNIGHT_ATTACKS)
+PAWN_STEPS = {colour: _numbered(PAWN_ATTACKS[colour]) for colour in (True, False)}
+RAYS = [
+    [tuple(row * 8 + column for row, column in ray) for ray in square_rays]
+    for square_rays in SQUARE_RAYS
+]
+
+
+def _lines():
+    """
+    Returns, for each pair of squares on a line, the index of the direction
+    from the first to the second and the squares in between, or None.
+    """
+    lines = [[None] * 64 for _ in range(64)]
+    for square in range(64):
+        for direction, ray in enumerate(RAYS[square]):
+            for distance, other in enumerate(ray):
+                lines[square][other] = (direction, ray[:distance])
+    return lines
+
+
+LINES = _lines()
+
+
+def parse_material(name):
+    """
+    Returns the pieces of a table as (colour, piece type) pairs in index
+    order, e.g. KQKR -> white king, white queen, black king, black rook.
+    """
+    split = name.index("K", 1)
+    return tuple(
+        (index < split, PIECE_LETTERS.index(letter))
+        for index, letter in enumerate(name)
+    )
+
+
+def get_table_name(white_types, black_types):
+    """
+    Returns the name of the table for the material, and whether the colours
+    have to be swapped to find the position in it. Tables are named with the
+    stronger side as white.
+    """
+    white_types = sorted(white_types, reverse=True)
+    black_types = sorted(black_types, reverse=True)
+    swap = white_types < black_types
+    if swap:
+        white_types, black_types = black_types, white_types
+    name = "".join(
+        PIECE_LETTERS[piece_type] for piece_type in white_types + black_types
+    )
+    return name, swap
+
+
+def has_pawns_on_both_sides(name):
+    """
+    Checks whether both sides of a table have pawns. Generation leaves out en
+    passant captures, so the results of such a table could be wrong after a
+    pawn's first move of two squares, and it is not generated.
+    """
+    split = name.index("K", 1)
+    return "P" in name[:split] and "P" in name[split:]
+
+
+def get_table_names(max_pieces):
+    """
+    Returns the names of all the tables with three to max_pieces pieces,
+    except those with pawns on both sides.
+    """
+    names = set()
+    for count in range(1, max_pieces - 1):
+        for pieces in itertools.combinations_with_replacement(
+            [
+                (colour, piece_type)
+                for colour in (True, False)
+                for piece_type in range(5)
+            ],
+            count,
+        ):
+            white_types = [KING] + [t for colour, t in pieces if colour]
+            black_types = [KING] + [t for colour, t in pieces if not colour]
+            name = get_table_name(white_types, black_types)[0]
+            if not has_pawns_on_both_sides(name):
+                names.add(name)
+    return sorted(names, key=lambda name: (len(name), name))
+
+
+def get_subtable_names(name):
+    """
+    Returns the names of the tables reached from a table by a capture or a
+    promotion, leaving out those with only the kings.
+    """
+    material = parse_material(name)
+    names = set()
+    for slot, (colour, piece_type) in enumerate(material):
+        if piece_type == KING:
+            continue
+        others = material[:slot] + material[slot + 1 :]
+        variations = [others]
+        if piece_type == PAWN:
+            promoted = [
+                material[:slot] + ((colour, new_type),) + material[slot + 1 :]
+                for new_type in PROMOTION_TYPES
+            ]
+            variations += promoted
+            # A pawn can promote by capturing
+            for pieces in promoted:
+                variations += [
+                    pieces[:other] + pieces[other + 1 :]
+                    for other, (other_colour, other_type) in enumerate(pieces)
+                    if other_colour != colour and other_type != KING
+                ]
+        for pieces in variations:
+            if len(pieces) > 2:
+                names.add(
+                    get_table_name(
+                        [t for c, t in pieces if c], [t for c, t in pieces if not c]
+                    )[0]
+                )
+    return names
+
+
+def _is_attacked(square, attackers, squares, occupied, skip=None):
+    """
+    Checks if any of the attackers, given as (slot, colour, piece type),
+    attacks the square. The piece in slot skip has been captured, so it is
+    left out.
+    """
+    for slot, colour, piece_type in attackers:
+        if slot == skip:
+            continue
+        from_square = squares[slot]
+        if piece_type == KNIGHT:
+            if square in KNIGHT_STEPS[from_square]:
+                return True
+        elif piece_type == KING:
+            if square in KING_STEPS[from_square]:
+                return True
+        elif piece_type == PAWN:
+            if square in PAWN_STEPS[colour][from_square]:
+                return True
+        else:
+            line = LINES[from_square][square]
+            if (
+                line is not None
+                and line[0] in SLIDER_DIRECTIONS[piece_type]
+                and not any(between in occupied for between in line[1])
+            ):
+                return True
+    return False
+
+
+def _generate_moves(material, squares, occupants, colour):
+    """
+    Yields the moves of the pieces of the given colour as (slot, new square,
+    slot of the captured piece or None, promotion type or None). Moves which
+    leave the king in check are included.
+    """
+    for slot, (piece_colour, piece_type) in enumerate(material):
+        if piece_colour != colour:
+            continue
+        from_square = squares[slot]
+        if piece_type == PAWN:
+            step = -8 if colour else 8
+            targets = []
+            if from_square + step not in occupants:
+                targets.append((from_square + step, None))
+                start = from_square >= 48 if colour else from_square < 16
+                if start and from_square + 2 * step not in occupants:
+                    targets.append((from_square + 2 * step, None))
+            for new_square in PAWN_STEPS[colour][from_square]:
+                captured = occupants.get(new_square)
+                if captured is not None and material[captured][0] != colour:
+                    targets.append((new_square, captured))
+            for new_square, captured in targets:
+                if new_square < 8 or new_square >= 56:
+                    for promotion in PROMOTION_TYPES:
+                        yield slot, new_square, captured, promotion
+                else:
+                    yield slot, new_square, captured, None
+            continue
+
+        if piece_type == KNIGHT or piece_type == KING:
+            steps = KNIGHT_STEPS if piece_type == KNIGHT else KING_STEPS
+            rays = [(new_square,) for new_square in steps[from_square]]
+        else:
+            rays = [RAYS[from_square][i] for i in SLIDER_DIRECTIONS[piece_type]]
+        for ray in rays:
+            for new_square in ray:
+                captured = occupants.get(new_square)
+                if captured is None:
+                    yield slot, new_square, None, None
+                    continue
+                if material[captured][0] != colour:
+                    yield slot, new_square, captured, None
+                break
+
+
+def _generate_unmoves(material, squares, occupants, colour):
+    """
+    Yields the (slot, old square) of the moves that pieces of the given colour
+    could have just made without capturing or promoting.
+    """
+    for slot, (piece_colour, piece_type) in enumerate(material):
+        if piece_colour != colour:
+            continue
+        square = squares[slot]
+        if piece_type == PAWN:
+            step = 8 if colour else -8
+            old_square = square + step
+            if 8 <= old_square < 56 and old_square not in occupants:
+                yield slot, old_square
+                double_row = 4 if colour else 3
+                if square // 8 == double_row and old_square + step not in occupants:
+                    yield slot, old_square + step
+            continue
+
+        if piece_type == KNIGHT or piece_type == KING:
+            steps = KNIGHT_STEPS if piece_type == KNIGHT else KING_STEPS
+            rays = [(old_square,) for old_square in steps[square]]
+        else:
+            rays = [RAYS[square][i] for i in SLIDER_DIRECTIONS[piece_type]]
+        for ray in rays:
+            for old_square in ray:
+                if old_square in occupants:
+                    break
+                yield slot, old_square
+
+
+class Tablebase:
+    """
+    Looks up the exact result of positions with few pieces in endgame
+    tables, which are generated by retrograde analysis and stored one file
+    per set of pieces. The files are memory-mapped, so several processes
+    probing the same tables share their memory.
+    """
+
+    MAX_PIECES = 4
+    MAX_PLIES = 254
+    MISSING_RECHECK_SECONDS = 60
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.__tables = {}
+        self.__files = []
+        self.__missing = {}  # Name -> time a table was last found to be missing
+
+    def get_table(self, name):
+        """
+        Returns the contents of a table, or None if it has not been built. A
+        missing table is looked for again once MISSING_RECHECK_SECONDS have
+        passed, so that tables built while the process runs are found.
+        """
+        if name not in self.__tables:
+            checked = self.__missing.get(name)
+            if (
+                checked is not None
+                and time.monotonic() - checked < self.MISSING_RECHECK_SECONDS
+            ):
+                return None
+            path = os.path.join(self.directory, name + ".bin")
+            if not os.path.exists(path):
+                self.__missing[name] = time.monotonic()
+                return None
+            table_file = open(path, "rb")
+            self.__tables[name] = mmap.mmap(
+                table_file.fileno(), 0, access=mmap.ACCESS_READ
+            )
+            self.__files.append(table_file)
+            self.__missing.pop(name, None)
+        return self.__tables[name]
+
+    def probe_value(self, pieces, colour):
+        """
+        Returns the stored byte for the pieces, given as (colour, piece type,
+        square) tuples, with the given colour to move. Returns None if the
+        table has not been built.
+        """
+        if len(pieces) == 2:
+            return 0  # Only the kings are left
+        white = sorted((piece for piece in pieces if piece[0]), key=lambda p: -p[1])
+        black = sorted((piece for piece in pieces if not piece[0]), key=lambda p: -p[1])
+        name, swap = get_table_name([p[1] for p in white], [p[1] for p in black])
+        if swap:
+            white, black = black, white
+            colour = not colour
+        table = self.get_table(name)
+        if table is None:
+            return None
+
+        index = 0
+        for piece in white + black:
+            index = index * 64 + (piece[2] ^ 56 if swap else piece[2])
+        if not colour:
+            index += 64 ** len(pieces)
+        return table[index]
+
+    def probe(self, pieces, colour):
+        """
+        Returns the result for the side to move as (WIN, DRAW or LOSS, number
+        of plies to checkmate), or None if the position is not in the tables.
+        """
+        value = self.probe_value(pieces, colour)
+        if value is None:
+            return None
+        if value == 0:
+            return DRAW, 0
+        return (WIN if value % 2 == 0 else LOSS), value - 1
+
+    def probe_game(self, game):
+        """
+        Returns the result for the side to move in a Game, as probe does.
+        Positions where castling or taking en passant is possible are not in
+        the tables.
+        """
+        board = game.board
+        if len(board.white_pieces) + len(board.black_pieces) > self.MAX_PIECES:
+            return None
+        if any(game.get_castling_rights()):
+            return None
+        pieces = [
+            (piece.colour, piece.piece_type, piece.row * 8 + piece.column)
+            for piece in board.white_pieces + board.black_pieces
+        ]
+        en_passant_square = game.get_en_passant_square()
+        if en_passant_square is not None:
+            row, column = en_passant_square
+            en_passant_square = row * 8 + column
+        return self.__probe_position(
+            pieces, game.current_player_colour, en_passant_square
+        )
+
+    def probe_bitboard(self, position):
+        """Returns the result for the side to move in a BitboardPosition."""
+        occupied = position.occupied[True] | position.occupied[False]
+        if bin(occupied).count("1") > self.MAX_PIECES or position.castling_rights:
+            return None
+        pieces = [
+            (piece[0], piece[1], square)
+            for square, piece in enumerate(position.mailbox)
+            if piece is not None
+        ]
+        return self.__probe_position(
+            pieces, position.current_player_colour, position.en_passant_square
+        )
+
+    def build(self, names):
+        """
+        Generates the named tables that have not been built yet, along with
+        the tables they depend on. Raises ValueError for a table with pawns
+        on both sides.
+        """
+        for name in names:
+            if has_pawns_on_both_sides(name):
+                raise ValueError(f"{name} has pawns on both sides")
+            if self.get_table(name) is not None:
+                continue
+            self.build(sorted(get_subtable_names(name)))
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory, name + ".bin")
+            with open(path + ".tmp", "wb") as table_file:
+                table_file.write(self.__generate(name))
+            os.replace(path + ".tmp", path)
+            self.__missing.pop(name, None)
+
+    def close(self):
+        """Closes the table files."""
+        for table in self.__tables.values():
+            table.close()
+        for table_file in self.__files:
+            table_file.close()
+        self.__tables = {}
+        self.__files = []
+        self.__missing = {}
+
+    def __probe_position(self, pieces, colour, en_passant_square):
+        """
+        Probes the pieces unless a pawn of the side to move can take en
+        passant, which the tables do not allow for.
+        """
+        if en_passant_square is not None and any(
+            piece_type == PAWN
+            and piece_colour == colour
+            and en_passant_square in PAWN_STEPS[colour][square]
+            for piece_colour, piece_type, square in pieces
+        ):
+            return None
+        return self.probe(pieces, colour)
+
+    def __generate(self, name):
+        """
+        Generates a table by retrograde analysis. First every position is
+        looked at once: checkmates are lost in 0 plies, and captures and
+        promotions are looked up in the smaller tables. Then, in order of
+        the number of plies, the positions which lead to each lost position
+        are won, and those whose moves all lead to won positions are lost.
+        """
+        material = parse_material(name)
+        count = len(material)
+        size = 64**count
+        weights = [64 ** (count - 1 - slot) for slot in range(count)]
+        kings = {colour: material.index((colour, KING)) for colour in (True, False)}
+        sides = {
+            colour: [
+                (slot, colour, piece_type)
+                for slot, (piece_colour, piece_type) in enumerate(material)
+                if piece_colour == colour
+            ]
+            for colour in (True, False)
+        }
+        pawn_slots = [slot for slot, (_, t) in enumerate(material) if t == PAWN]
+
+        results = bytearray(2 * size)
+        flags = bytearray(2 * size)
+        remaining = bytearray(2 * size)  # Moves in the table not known to lose
+        win_plies = bytearray(2 * size)  # Quickest win found so far
+        loss_plies = bytearray(2 * size)  # Slowest loss by a capture or promotion
+        # Positions to be resolved, by their number of plies to checkmate
+        buckets = [array.array("I") for _ in range(self.MAX_PLIES + 1)]
+
+        for position, squares in enumerate(itertools.product(range(64), repeat=count)):
+            occupants = {square: slot for slot, square in enumerate(squares)}
+            if len(occupants) < count or any(
+                squares[slot] < 8 or squares[slot] >= 56 for slot in pawn_slots
+            ):
+                flags[position] = flags[position + size] = ILLEGAL
+                continue
+
+            for colour, index in ((True, position), (False, position + size)):
+                if _is_attacked(
+                    squares[kings[not colour]], sides[colour], squares, occupants
+                ):
+                    flags[index] = ILLEGAL
+                    continue
+
+                moves = 0
+                exits = 0
+                for slot, new_square, captured, promotion in _generate_moves(
+                    material, squares, occupants, colour
+                ):
+                    new_squares = list(squares)
+                    new_squares[slot] = new_square
+                    occupied = set(new_squares)
+                    occupied.discard(squares[slot])
+                    if _is_attacked(
+                        new_squares[kings[colour]],
+                        sides[not colour],
+                        new_squares,
+                        occupied,
+                        captured,
+                    ):
+                        continue
+                    if captured is None and promotion is None:
+                        moves += 1
+                        continue
+
+                    exits += 1
+                    value = self.probe_value(
+                        [
+                            (c, promotion if s == slot and promotion else t, square)
+                            for s, ((c, t), square) in enumerate(
+                                zip(material, new_squares)
+                            )
+                            if s != captured
+                        ],
+                        not colour,
+                    )
+                    if value is None:
+                        raise ValueError(f"{name} needs a table which is not built")
+                    if value == 0:
+                        flags[index] |= DRAW_EXIT
+                    elif value % 2:  # The opponent loses
+                        if not win_plies[index] or value < win_plies[index]:
+                            win_plies[index] = value
+                    else:
+                        loss_plies[index] = max(loss_plies[index], value)
+
+                remaining[index] = moves
+                if win_plies[index]:
+                    buckets[win_plies[index]].append(index)
+                elif moves == 0 and exits == 0:
+                    if _is_attacked(
+                        squares[kings[colour]], sides[not colour], squares, occupants
+                    ):
+                        buckets[0].append(index)  # Checkmate
+                elif moves == 0 and not flags[index] & DRAW_EXIT:
+                    buckets[loss_plies[index]].append(index)
+
+        for plies, bucket in enumerate(buckets):
+            for index in bucket:
+                if results[index]:
+                    continue
+                results[index] = plies + 1
+                colour = index < size
+                position = index if colour else index - size
+                squares = [position // weight % 64 for weight in weights]
+                occupants = {square: slot for slot, square in enumerate(squares)}
+                previous_offset = size if colour else 0
+                for slot, old_square in _generate_unmoves(
+                    material, squares, occupants, not colour
+                ):
+                    previous = (
+                        previous_offset
+                        + position
+                        + (old_square - squares[slot]) * weights[slot]
+                    )
+                    if flags[previous] & ILLEGAL or results[previous]:
+                        continue
+                    if plies + 1 > self.MAX_PLIES:
+                        raise ValueError(f"{name} has a checkmate too long to store")
+                    if plies % 2 == 0:  # A move into a lost position wins
+                        if not win_plies[previous] or win_plies[previous] > plies + 1:
+                            win_plies[previous] = plies + 1
+                            buckets[plies + 1].append(previous)
+                        continue
+                    remaining[previous] -= 1
+                    if (
+                        remaining[previous] == 0
+                        and not flags[previous] & DRAW_EXIT
+                        and not win_plies[previous]
+                    ):
+                        buckets[max(plies + 1, loss_plies[previous])].append(previous)
+
+        return results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Endgame tablebase tools.")
+    parser.add_argument(
+        "--directory",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "tablebases"),
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="generate tables")
+    build_parser.add_argument("names", nargs="*", help="e.g. KQK KRK KPK")
+    build_parser.add_argument(
+        "--pieces", type=int, default=3, help="build every table with this many pieces"
+    )
+    probe_parser = subparsers.add_parser("probe", help="look up a position")
+    probe_parser.add_argument("fen")
+    args = parser.parse_args()
+
+    TABLEBASE = Tablebase(args.directory)
+    if args.command == "build":
+        for NAME in args.names or get_table_names(args.pieces):
+            start = time.perf_counter()
+            TABLEBASE.build([NAME])
+            print(f"{NAME}: {time.perf_counter() - start:.1f}s")
+    else:
+        GAME = Game.from_fen(args.fen)
+        RESULT = TABLEBASE.probe_game(GAME)
+        if RESULT is None:
+            print("not in the tables")
+        else:
+            print({WIN: "win", DRAW: "draw", LOSS: "loss"}[RESULT[0]], RESULT[1])
+            for MOVE in GAME.get_legal_moves():
+                for PIECE_CLASS in get_promotion_classes(GAME, MOVE):
+                    GAME.make_move(MOVE, PIECE_CLASS)
+                    print(move_name(MOVE, PIECE_CLASS), TABLEBASE.probe_game(GAME))
+                    GAME.unmake_move()
+    TABLEBASE.close()
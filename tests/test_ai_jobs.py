@@ -0,0 +1,67 @@
+"""AI job tests"""
+import time
+import pytest
+from chess_engine import Game, parse_move
+from ai_jobs import AIJobRunner, search_position
+
+# Black to move can only draw by moving the king back to h8, repeating a
+# position, which it only knows of if it is given the game's history
+FEN = "7k/8/8/8/8/8/8/KQ6 w - - 0 1"
+MOVES = ["b1b2", "h8g8", "b2b1", "g8h8", "b1b2", "h8g8", "b2b1"]
+REPEATING_MOVE = [(0, 6), (0, 7)]
+
+
+@pytest.fixture
+def game():
+    game = Game.from_fen(FEN)
+    for name in MOVES:
+        game.execute_move(*parse_move(name)[0])
+    return game
+
+
+@pytest.fixture
+def runner():
+    runner = AIJobRunner(max_workers=1)
+    yield runner
+    runner.shutdown()
+
+
+def test_search_uses_history(game):
+    """A search given the history scores the repetition as a draw."""
+    move, _ = search_position(
+        game.to_fen(), 300, hash_history=game.get_recent_history()
+    )
+    assert move == REPEATING_MOVE
+
+
+def test_worker_search_uses_history(game, runner):
+    """The history is sent to the worker process with the position."""
+    job_id = runner.submit(game.to_fen(), 300, hash_history=game.get_recent_history())
+    assert runner.wait(job_id, timeout=30) == REPEATING_MOVE
+
+
+def test_parallel_search_uses_history(game, runner):
+    """Each worker searching some of the root moves is sent the history."""
+    score, move = runner.search_parallel(game.to_fen(), 2, game.get_recent_history())
+    assert (score, move) == (0, REPEATING_MOVE)
+
+
+def test_job_reused_only_for_same_history(game, runner):
+    """A job is only reused for the same position with the same history."""
+    history = game.get_recent_history()
+    runner.submit(game.to_fen(), 300, "game", history)
+    runner.submit(game.to_fen(), 300, "game", history)
+    assert runner.reused == 1
+    runner.submit(game.to_fen(), 300, "game")
+    assert runner.reused == 1
+    assert runner.wait("game", timeout=30) is not None
+
+
+def test_cancel_stops_started_search(runner):
+    """A cancelled search frees its worker for the next job."""
+    fen = "r1bq1rk1/pp2bppp/2n1pn2/3p4/2PP4/2N1PN2/PP3PPP/R2QKB1R w KQ - 0 8"
+    runner.submit(fen, 60000, "ponder")
+    time.sleep(1)  # Let the search start
+    runner.cancel("ponder")
+    job_id = runner.submit(fen, 100)
+    assert runner.wait(job_id, timeout=30) is not None
@@ -0,0 +1,108 @@
+"""Chess engine tests"""
+import pytest
+from chess_engine import (
+    FIFTY_MOVE_PLIES,
+    PERFT_POSITIONS,
+    START_FEN,
+    Game,
+    parse_move,
+    perft,
+)
+
+# Deeper counts take minutes; run chess_engine.py perft --suite for those
+PERFT_DEPTH = 3
+
+
+@pytest.mark.parametrize(
+    "fen, counts",
+    [(fen, counts) for _, fen, counts in PERFT_POSITIONS],
+    ids=[name for name, _, _ in PERFT_POSITIONS],
+)
+def test_perft(fen, counts):
+    """The move generator reaches the known number of positions."""
+    game = Game.from_fen(fen)
+    for depth, expected in enumerate(counts[:PERFT_DEPTH], 1):
+        assert perft(game, depth) == expected
+    assert game.to_fen() == Game.from_fen(fen).to_fen()
+
+
+def play(game, names):
+    """Plays moves given in coordinate notation, as the webapp does."""
+    for name in names:
+        game.execute_move(*parse_move(name)[0])
+        game.is_checkmate_or_stalemate()
+        game.check_draw()
+
+
+def test_threefold_repetition():
+    """Knights moving out and back repeat the start position."""
+    game = Game.from_fen(START_FEN)
+    play(game, ["g1f3", "g8f6", "f3g1", "f6g8"])
+    assert game.is_repetition()
+    assert game.get_draw_reason() is None
+    play(game, ["g1f3", "g8f6", "f3g1", "f6g8"])
+    assert game.get_repetitions() == 3
+    assert game.get_draw_reason() == "threefold repetition"
+    assert game.stalemate
+
+
+def test_repetition_history_dropped_after_pawn_move():
+    """Positions before a pawn move can't occur again, so aren't kept."""
+    game = Game.from_fen(START_FEN)
+    play(game, ["g1f3", "g8f6", "f3g1", "f6g8", "e2e4"])
+    assert game.get_recent_history() == [game.zobrist_hash]
+    assert not game.is_repetition()
+
+
+def test_unmake_restores_history():
+    """Unmaking moves removes the positions they added."""
+    game = Game.from_fen(START_FEN)
+    for name in ["g1f3", "g8f6", "f3g1", "f6g8"]:
+        game.make_move(parse_move(name)[0])
+    assert game.is_repetition()
+    for _ in range(4):
+        game.unmake_move()
+    assert game.position_counts == {game.zobrist_hash: 1}
+    assert game.hash_history == [game.zobrist_hash]
+
+
+def test_fifty_move_rule():
+    """The game is drawn once 100 plies pass without a capture or pawn move."""
+    game = Game.from_fen(f"8/8/4k3/8/8/3QK3/8/8 w - - {FIFTY_MOVE_PLIES - 1} 80")
+    assert game.get_draw_reason() is None
+    play(game, ["d3d4"])
+    assert game.halfmove_clock == FIFTY_MOVE_PLIES
+    assert game.get_draw_reason() == "fifty-move rule"
+    assert game.stalemate
+
+
+def test_fifty_move_rule_reset_by_capture():
+    """A capture resets the count of plies."""
+    game = Game.from_fen(f"8/8/4k3/3p4/8/3QK3/8/8 w - - {FIFTY_MOVE_PLIES - 1} 80")
+    play(game, ["d3d5"])
+    assert game.halfmove_clock == 0
+    assert not game.stalemate
+
+
+def test_checkmate_on_fiftieth_move_stands():
+    """A checkmate reaching the limit is not turned into a draw."""
+    game = Game.from_fen(f"6k1/5ppp/8/8/8/8/8/R5K1 w - - {FIFTY_MOVE_PLIES - 1} 80")
+    play(game, ["a1a8"])
+    assert game.white_checkmate
+    assert not game.stalemate
+
+
+@pytest.mark.parametrize(
+    "fen",
+    [
+        START_FEN,
+        "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+        "rnbqkbnr/ppp1p1pp/8/3pPp2/8/8/PPPP1PPP/RNBQKBNR w KQkq f6 0 3",
+        "r3k3/8/8/8/8/8/8/4K2R b Kq - 5 40",
+    ],
+)
+def test_fen_round_trip(fen):
+    """Castling rights and the en passant square survive FEN."""
+    game = Game.from_fen(fen)
+    assert game.to_fen() == fen
+    assert game.zobrist_hash == game.compute_hash()
@@ -0,0 +1,125 @@
+"""Game database tests"""
+import sqlite3
+import pytest
+from chess_engine import Game, Queen, parse_move
+from game_database import GameDatabase, pack_moves, unpack_moves
+from game_store import GameStore
+
+
+def new_store(path, fen, snapshot_moves):
+    """Returns a store holding a game set up from a FEN string, saved."""
+    store = GameStore(database=GameDatabase(path, snapshot_moves))
+    store.put("game", Game.from_fen(fen))
+    assert store.save("game")
+    return store
+
+
+def play(store, names):
+    """
+    Plays moves given in coordinate notation as the webapp does, saving the
+    game after each request. A pawn reaching the last row is promoted to the
+    piece given by the move's fifth letter in a request of its own.
+    """
+    game = store.get("game")
+    for name in names:
+        (current_square, new_square), piece_class = parse_move(name)
+        assert game.validate_move(current_square, new_square)
+        game.execute_move(current_square, new_square)
+        if piece_class is not None:
+            game.show_promotion_box = True
+            game.promotion_square = new_square
+            assert store.save("game")
+            game.promote_pawn(new_square, piece_class)
+            game.show_promotion_box = False
+        game.current_move = [current_square, new_square]
+        game.is_checkmate_or_stalemate()
+        game.check_draw()
+        assert store.save("game")
+    return game
+
+
+def load(path, snapshot_moves):
+    """Loads the game with a new store, as another webapp process would."""
+    return GameStore(database=GameDatabase(path, snapshot_moves)).get("game")
+
+
+def test_pack_moves_round_trip():
+    """Move log entries, including promotions, are packed into 2 bytes."""
+    move_log = [
+        ((6, 4), (4, 4), None),
+        ((1, 0), (0, 1), None),
+        ((0, 1), (0, 1), Queen),
+    ]
+    assert unpack_moves(pack_moves(move_log)) == move_log
+    assert len(pack_moves(move_log)) == 2 * len(move_log)
+
+
+@pytest.mark.parametrize("snapshot_moves", [4, 1000])
+def test_promotions_across_snapshots(tmp_path, snapshot_moves):
+    """
+    Promotions and captures are restored whether or not a snapshot is used.
+    With snapshots every 4 moves, one is taken while the promotion of h8 is
+    waiting for the piece to be chosen.
+    """
+    path = str(tmp_path / "games.db")
+    store = new_store(path, "1n2k3/P6P/8/8/8/8/8/4K3 w - - 0 1", snapshot_moves)
+    game = play(
+        store, ["a7b8q", "e8e7", "h7h8n", "e7e6", "e1e2", "e6f5", "b8b5", "f5f4"]
+    )
+
+    loaded = load(path, snapshot_moves)
+    assert loaded.to_fen() == game.to_fen() == "7N/8/8/1Q6/5k2/8/4K3/8 w - - 5 5"
+    assert [str(piece) for piece in loaded.board.black_pieces_taken] == [
+        str(piece) for piece in game.board.black_pieces_taken
+    ]
+    assert len(loaded.board.black_pieces_taken) == 1
+    assert loaded.current_move == game.current_move
+    assert loaded.move_log == []
+
+    snapshots = store.database.stats()["snapshots_written"]
+    assert snapshots == (0 if snapshot_moves == 1000 else 2)
+
+
+@pytest.mark.parametrize("snapshot_moves", [3, 1000])
+def test_repetition_across_save_and_load(tmp_path, snapshot_moves):
+    """A loaded game still knows which positions have occurred."""
+    path = str(tmp_path / "games.db")
+    store = new_store(path, "4k3/8/8/8/8/8/8/R3K3 w - - 0 1", snapshot_moves)
+    game = play(store, ["a1a2", "e8d8", "a2a1", "d8e8"])
+    assert game.get_repetitions() == 2
+
+    other_store = GameStore(database=GameDatabase(path, snapshot_moves))
+    loaded = other_store.get("game")
+    assert loaded.get_repetitions() == 2
+    assert loaded.is_repetition()
+
+    loaded = play(other_store, ["a1a2", "e8d8", "a2a1", "d8e8"])
+    assert loaded.get_draw_reason() == "threefold repetition"
+    assert loaded.stalemate
+    assert load(path, snapshot_moves).get_repetitions() == 3
+
+
+def test_old_moves_pruned_at_snapshot(tmp_path):
+    """Only the moves since the latest snapshot are kept."""
+    path = str(tmp_path / "games.db")
+    store = new_store(path, "4k3/8/8/8/8/8/8/R3K3 w - - 0 1", 3)
+    play(store, ["a1a2", "e8d8", "a2a3", "d8e8", "a3a4"])
+    connection = sqlite3.connect(path)
+    assert connection.execute("SELECT moves FROM snapshots").fetchall() == [(3,)]
+    assert connection.execute("SELECT first_move FROM moves").fetchall() == [
+        (3,),
+        (4,),
+    ]
+
+
+def test_out_of_date_save_refused(tmp_path):
+    """A save from a copy which another process has changed is refused."""
+    path = str(tmp_path / "games.db")
+    store = new_store(path, "4k3/8/8/8/8/8/8/R3K3 w - - 0 1", 40)
+    game = store.get("game")
+    other_store = GameStore(database=GameDatabase(path))
+    play(other_store, ["a1a2"])
+
+    game.execute_move((7, 0), (5, 0))
+    assert not store.save("game")
+    assert store.get("game").to_fen() == other_store.get("game").to_fen()
@@ -0,0 +1,55 @@
+"""PGN tests"""
+import random
+import pytest
+from chess_engine import START_FEN, Game, get_promotion_classes
+from pgn import format_game, parse_san, read_games, replay_game, san_name
+
+
+def random_game(seed, plies=120):
+    """
+    Plays random moves from the start, promoting to random pieces, and
+    returns the moves as (move, promoted piece class) pairs and in SAN.
+    """
+    rng = random.Random(seed)
+    game = Game.from_fen(START_FEN)
+    moves = []
+    names = []
+    for _ in range(plies):
+        legal_moves = game.get_legal_moves()
+        if not legal_moves:
+            break
+        move = rng.choice(legal_moves)
+        piece_class = rng.choice(get_promotion_classes(game, move))
+        names.append(san_name(game, move, piece_class))
+        assert parse_san(game, names[-1]) == (move, piece_class)
+        moves.append((move, piece_class))
+        game.make_move(move, piece_class)
+    return moves, names
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_san_round_trip(seed):
+    """Moves named in SAN are read back as the same moves."""
+    moves, names = random_game(seed)
+    pgn_games = list(read_games(format_game({"Event": "test"}, names, "*").split("\n")))
+    assert len(pgn_games) == 1
+    assert pgn_games[0].moves == names
+    assert [
+        (move, piece_class) for _, move, piece_class in replay_game(pgn_games[0])
+    ] == moves
+
+
+def test_read_games_skips_comments_and_variations():
+    """Comments, variations and NAGs are left out of the moves."""
+    text = '[Event "x"]\n\n1. e4 {best by test} e5 (1... c5 2. Nf3) 2. Nf3 $1 Nc6 1-0\n'
+    (pgn_game,) = read_games(text.split("\n"))
+    assert pgn_game.tags == {"Event": "x"}
+    assert pgn_game.moves == ["e4", "e5", "Nf3", "Nc6"]
+    assert pgn_game.result == "1-0"
+
+
+def test_illegal_move_gives_move_number():
+    """A move which can't be played is reported with its move number."""
+    (pgn_game,) = read_games(["1. e4 e5 2. Ke3 *"])
+    with pytest.raises(ValueError, match="move 2."):
+        list(replay_game(pgn_game))
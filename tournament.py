@@ -0,0 +1,402 @@
+"""Tournament"""
+import math
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from chess_engine import (
+    START_FEN,
+    Game,
+    get_promotion_classes,
+    move_name,
+    parse_move,
+)
+from ai_jobs import get_worker_ai
+from pgn import format_game, san_name
+
+# The settings a variant can have, with their defaults. The mode is "search"
+# for the iterative deepening search, or "greedy" or "random".
+VARIANT_DEFAULTS = {
+    "mode": "search",
+    "depth": None,
+    "time_ms": None,
+    "backend": None,
+    "tt_mb": None,
+}
+MODES = ("search", "greedy", "random")
+
+
+def parse_variant(spec):
+    """
+    Returns the settings of a variant given as comma separated key=value
+    pairs, e.g. "depth=3,backend=bitboard". Settings which are not given
+    take their default values. Raises ValueError for an unknown setting.
+    """
+    variant = dict(VARIANT_DEFAULTS)
+    for pair in filter(None, spec.split(",")):
+        key, _, value = (part.strip() for part in pair.partition("="))
+        if key not in variant:
+            raise ValueError(f"unknown setting {key}")
+        variant[key] = int(value) if value.isdigit() else value
+    if variant["mode"] not in MODES:
+        raise ValueError(f"unknown mode {variant['mode']}")
+    return variant
+
+
+def get_variant_name(variant):
+    """Returns the settings of a variant which differ from the defaults."""
+    settings = [
+        f"{key}={value}"
+        for key, value in variant.items()
+        if value != VARIANT_DEFAULTS[key]
+    ]
+    return ",".join(settings) or "default"
+
+
+def get_openings(count, rng, lines=None, plies=8):
+    """
+    Returns count openings as lists of moves in coordinate notation. They are
+    chosen from the first moves of the given lines of an openings file, or
+    else are random moves from the starting position.
+    """
+    if lines:
+        openings = sorted(
+            {
+                tuple(line.split("#")[0].split()[:plies])
+                for line in lines
+                if line.split("#")[0].strip()
+            }
+        )
+        return [list(rng.choice(openings)) for _ in range(count)]
+
+    openings = []
+    while len(openings) < count:
+        game = Game.from_fen(START_FEN)
+        names = []
+        for _ in range(plies):
+            moves = game.get_legal_moves()
+            if not moves:
+                break
+            move = rng.choice(moves)
+            piece_class = get_promotion_classes(game, move)[0]
+            names.append(move_name(move, piece_class))
+            game.make_move(move, piece_class)
+        if game.get_legal_moves():  # The opening must not end the game
+            openings.append(names)
+    return openings
+
+
+def get_variant_ai(variant):
+    """Returns the worker process's AI for a variant, creating it if needed."""
+    return get_worker_ai(
+        variant["backend"],
+        transposition_table_mb=variant["tt_mb"],
+        player=get_variant_name(variant),
+    )
+
+
+def choose_move(game, variant):
+    """
+    Returns the move chosen by a variant, its score for the side to move (or
+    None if the variant does not search) and the number of nodes searched.
+    """
+    ai = get_variant_ai(variant)
+    if variant["mode"] == "random":
+        return ai.get_random_move(game.get_valid_moves()), None, 0
+    if variant["mode"] == "greedy":
+        game.ai_colour = game.current_player_colour
+        return ai.get_greedy_ai_move(game), None, 0
+
+    time_budget_ms = variant["time_ms"]
+    if time_budget_ms is None:
+        time_budget_ms = float("inf") if variant["depth"] else ai.TIME_BUDGET_MS
+    score = ai.get_ai_move_iterative(game, time_budget_ms, variant["depth"])
+    if ai.minimax_best_moves:
+        move = ai.get_random_move(ai.minimax_best_moves)
+    else:
+        move = ai.get_random_move(game.get_valid_moves())
+    return move, score, ai.nodes
+
+
+def play_game(
+    opening,
+    white,
+    black,
+    seed=None,
+    max_plies=300,
+    adjudicate_score=1000,
+    adjudicate_plies=8,
+):
+    """
+    Plays a game between two variants after the opening moves, and returns
+    its result, how it ended, its moves in SAN, and the search time, nodes
+    and number of moves of each side. This runs in a worker process. The
+    seed makes the choices between equally good moves repeatable.
+
+    A game is adjudicated as a win once every search over the last
+    adjudicate_plies plies has scored the position at least adjudicate_score
+    for the same side. It is a draw once it reaches max_plies plies.
+    """
+    random.seed(seed)
+    for variant in (white, black):
+        get_variant_ai(variant).reset()
+
+    game = Game.from_fen(START_FEN)
+    moves = []
+    for name in opening:
+        move, piece_class = parse_move(name)
+        moves.append(san_name(game, move, piece_class))
+        game.make_move(move, piece_class)
+
+    stats = {True: [0.0, 0, 0], False: [0.0, 0, 0]}  # Time, nodes, moves
+    white_scores = []
+    result, termination = "1/2-1/2", "move limit"
+    while len(moves) < max_plies:
+        colour = game.current_player_colour
+        start = time.perf_counter()
+        move, score, nodes = choose_move(game, white if colour else black)
+        side_stats = stats[colour]
+        side_stats[0] += time.perf_counter() - start
+        side_stats[1] += nodes
+        side_stats[2] += 1
+
+        piece_class = get_promotion_classes(game, move)[0]
+        san = san_name(game, move, piece_class)
+        game.make_move(move, piece_class)
+        game.is_checkmate_or_stalemate()
+        game.check_draw()
+        if game.white_checkmate or game.black_checkmate:
+            moves.append(san + "#")
+            result = "1-0" if game.white_checkmate else "0-1"
+            termination = "checkmate"
+            break
+        moves.append(san + "+" if game.in_check() else san)
+        if game.stalemate:
+            termination = game.get_draw_reason() or "stalemate"
+            break
+
+        white_scores.append(None if score is None else (score if colour else -score))
+        recent = white_scores[-adjudicate_plies:]
+        if len(recent) == adjudicate_plies and None not in recent:
+            if all(score >= adjudicate_score for score in recent):
+                result, termination = "1-0", "adjudication"
+                break
+            if all(score <= -adjudicate_score for score in recent):
+                result, termination = "0-1", "adjudication"
+                break
+
+    return {
+        "result": result,
+        "termination": termination,
+        "moves": moves,
+        "white": stats[True],
+        "black": stats[False],
+    }
+
+
+def get_elo_difference(wins, draws, losses):
+    """
+    Returns the Elo difference implied by a match score, and the margin of
+    its 95% confidence interval from the spread of the game results. Either
+    is infinite when the score or its interval reaches 0% or 100%.
+    """
+    games = wins + draws + losses
+    score = (wins + draws / 2) / games
+    variance = (
+        wins * (1 - score) ** 2 + draws * (0.5 - score) ** 2 + losses * score**2
+    ) / games
+    margin = 1.96 * math.sqrt(variance / games)
+
+    def elo(fraction):
+        if fraction <= 0:
+            return -math.inf
+        if fraction >= 1:
+            return math.inf
+        return 400 * math.log10(fraction / (1 - fraction))
+
+    if score in (0, 1):
+        return elo(score), math.inf
+    return elo(score), (elo(score + margin) - elo(score - margin)) / 2
+
+
+class Tournament:
+    """
+    Plays a match between two AI variants, A and B, in a pool of worker
+    processes. Each opening is played twice, with the variants swapping
+    colours, so that neither gains from a good opening. Results are kept
+    from A's point of view.
+    """
+
+    def __init__(
+        self,
+        first,
+        second,
+        max_workers=None,
+        max_plies=300,
+        adjudicate_score=1000,
+        adjudicate_plies=8,
+    ):
+        self.variants = {"A": first, "B": second}
+        self.max_workers = max_workers
+        self.max_plies = max_plies
+        self.adjudicate_score = adjudicate_score
+        self.adjudicate_plies = adjudicate_plies
+        self.games = []
+        self.wins = 0
+        self.draws = 0
+        self.losses = 0
+        self.terminations = {}
+        self.time = {"A": 0.0, "B": 0.0}
+        self.nodes = {"A": 0, "B": 0}
+        self.moves = {"A": 0, "B": 0}
+
+    def play(self, openings, seed=None, callback=None):
+        """
+        Plays each opening twice and records the results. The callback, if
+        given, is called with each game as it finishes.
+        """
+        rng = random.Random(seed)
+        with ProcessPoolExecutor(self.max_workers) as executor:
+            futures = {}
+            for number, opening in enumerate(openings):
+                for white in ("A", "B"):
+                    black = "B" if white == "A" else "A"
+                    future = executor.submit(
+                        play_game,
+                        opening,
+                        self.variants[white],
+                        self.variants[black],
+                        rng.getrandbits(32),
+                        self.max_plies,
+                        self.adjudicate_score,
+                        self.adjudicate_plies,
+                    )
+                    futures[future] = (number + 1, white, black)
+
+            for future in as_completed(futures):
+                game = future.result()
+                game["round"], game["white_name"], game["black_name"] = futures[future]
+                self.__record(game)
+                if callback is not None:
+                    callback(game)
+
+    def __record(self, game):
+        """Adds a finished game to the results."""
+        self.games.append(game)
+        score = {"1-0": 1, "0-1": 0}.get(game["result"], 0.5)
+        if game["white_name"] == "B":
+            score = 1 - score
+        if score == 1:
+            self.wins += 1
+        elif score == 0:
+            self.losses += 1
+        else:
+            self.draws += 1
+        self.terminations[game["termination"]] = (
+            self.terminations.get(game["termination"], 0) + 1
+        )
+        for colour in ("white", "black"):
+            name = game[f"{colour}_name"]
+            elapsed, nodes, moves = game[colour]
+            self.time[name] += elapsed
+            self.nodes[name] += nodes
+            self.moves[name] += moves
+
+    def get_report(self):
+        """Returns a summary of the match results and the speed of each variant."""
+        lines = [
+            f"A: {get_variant_name(self.variants['A'])}",
+            f"B: {get_variant_name(self.variants['B'])}",
+            f"{len(self.games)} games: A won {self.wins}, drew {self.draws}, "
+            f"lost {self.losses}",
+        ]
+        if self.games:
+            difference, margin = get_elo_difference(self.wins, self.draws, self.losses)
+            lines.append(f"Elo difference (A - B): {difference:+.1f} +/- {margin:.1f}")
+            lines.append(
+                "Endings: "
+                + ", ".join(
+                    f"{termination} {count}"
+                    for termination, count in sorted(self.terminations.items())
+                )
+            )
+        for name in ("A", "B"):
+            moves = self.moves[name]
+            elapsed = self.time[name]
+            lines.append(
+                f"{name}: {elapsed / moves * 1000 if moves else 0:.1f} ms per move, "
+                f"{self.nodes[name] / elapsed if elapsed else 0:.0f} nodes/s"
+            )
+        return "\n".join(lines)
+
+    def format_games(self):
+        """Returns the games played in PGN, in the order they were started."""
+        games = sorted(self.games, key=lambda game: (game["round"], game["white_name"]))
+        return "\n".join(
+            format_game(
+                {
+                    "Event": "Self-play tournament",
+                    "Round": game["round"],
+                    "White": get_variant_name(self.variants[game["white_name"]]),
+                    "Black": get_variant_name(self.variants[game["black_name"]]),
+                    "Termination": game["termination"],
+                },
+                game["moves"],
+                game["result"],
+            )
+            for game in games
+        )
+
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+
+    parser = argparse.ArgumentParser(
+        description="Play a match between two AI variants, given as settings "
+        "such as depth=3,backend=bitboard or time_ms=200 or mode=greedy."
+    )
+    parser.add_argument("first", type=parse_variant, help="settings of variant A")
+    parser.add_argument("second", type=parse_variant, help="settings of variant B")
+    parser.add_argument(
+        "--openings-count", type=int, default=10, help="each is played twice"
+    )
+    parser.add_argument("--openings", help="file of opening lines, e.g. openings.txt")
+    parser.add_argument(
+        "--opening-plies", type=int, default=8, help="length of each opening"
+    )
+    parser.add_argument("--seed", type=int, help="seed for choosing the openings")
+    parser.add_argument("--workers", type=int, help="number of worker processes")
+    parser.add_argument("--max-plies", type=int, default=300)
+    parser.add_argument("--adjudicate-score", type=int, default=1000)
+    parser.add_argument("--adjudicate-plies", type=int, default=8)
+    parser.add_argument("--pgn", help="file to write the games to")
+    args = parser.parse_args()
+
+    RNG = random.Random(args.seed)
+    OPENING_LINES = None
+    if args.openings:
+        with open(args.openings) as OPENINGS_FILE:
+            OPENING_LINES = OPENINGS_FILE.readlines()
+    OPENINGS = get_openings(args.openings_count, RNG, OPENING_LINES, args.opening_plies)
+
+    TOURNAMENT = Tournament(
+        args.first,
+        args.second,
+        args.workers,
+        args.max_plies,
+        args.adjudicate_score,
+        args.adjudicate_plies,
+    )
+    TOURNAMENT.play(
+        OPENINGS,
+        RNG.getrandbits(32),
+        lambda game: print(
+            f"round {game['round']} {game['white_name']}-{game['black_name']}: "
+            f"{game['result']} ({game['termination']}, {len(game['moves'])} plies)",
+            file=sys.stderr,
+        ),
+    )
+    print(TOURNAMENT.get_report())
+    if args.pgn:
+        with open(args.pgn, "w") as PGN_FILE:
+            PGN_FILE.write(TOURNAMENT.format_games())